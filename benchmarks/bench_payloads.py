@@ -0,0 +1,59 @@
+"""
+Micro-benchmark for the per-job payload compiler
+Compares the legacy per-contact payload build (dict + str.replace + re.sub +
+json.dumps) with CompiledPayload.render, and checks both produce the same JSON.
+
+Usage: python benchmarks/bench_payloads.py [num_contacts]
+"""
+
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from proxy_server import CompiledPayload, orjson  # noqa: E402
+
+MESSAGE = "Olá {name}, a reunião de pais da turma será amanhã às 19h.\nAtenciosamente, Escola {name}."
+CREDENTIALS = {"phoneNumberId": "123456789012345", "accessToken": "EAAG" + "x" * 180}
+NAMES = ["João Silva", "Maria Araújo", "Pedro Gonçalves", "Ana Conceição", "Lúcia Magalhães", "César Brandão"]
+
+
+def legacy_payload(contact, message, credentials):
+    """send_whatsapp_message's payload as it was before the compiler"""
+    personalized_message = message.replace("{name}", contact.get("name", ""))
+    personalized_message = re.sub(r'[\x00-\x1F\x7F]', '', personalized_message)
+    headers = {"Authorization": f"Bearer {credentials['accessToken']}", "Content-Type": "application/json"}
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": contact["to"],
+        "type": "text",
+        "text": {"body": personalized_message},
+    }
+    # httpx serializa `json=` com a stdlib
+    return headers, json.dumps(payload).encode()
+
+
+def timed(label: str, func, rows: int):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<34} {elapsed * 1000:9.1f} ms   {elapsed / rows * 1e6:7.3f} µs/msg")
+    return result
+
+
+if __name__ == "__main__":
+    num_contacts = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rng = random.Random(42)
+    contacts = [{"to": f"55119{rng.randrange(10**8):08d}", "name": rng.choice(NAMES)} for _ in range(num_contacts)]
+
+    print(f"payload build benchmark ({num_contacts} contacts, orjson: {'yes' if orjson else 'no'})\n")
+    legacy = timed("legacy (dict + re.sub + json)", lambda: [legacy_payload(c, MESSAGE, CREDENTIALS)[1] for c in contacts], num_contacts)
+    compiled = CompiledPayload(MESSAGE, CREDENTIALS)
+    fast = timed("CompiledPayload.render", lambda: [compiled.render(c["to"], c["name"]) for c in contacts], num_contacts)
+
+    assert all(json.loads(a) == json.loads(b) for a, b in zip(legacy, fast)), "compiled payload differs from the legacy one"
+    print("\nPayloads identical to the legacy implementation.")
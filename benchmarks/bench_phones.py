@@ -0,0 +1,56 @@
+"""
+Benchmark for the batch phone normalization engine
+Normalizes a column of mixed-format numbers (the formats in example_data.py)
+with normalize_phones and compares it with a per-row normalize_phone loop.
+
+Usage: python benchmarks/bench_phones.py [num_rows]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from proxy_server import normalize_phone, normalize_phones  # noqa: E402
+
+PHONE_FORMATS = [
+    "({ddd}) 9{a:04d}-{b:04d}",
+    "+55 {ddd} 9{a:04d}-{b:04d}",
+    "55 {ddd} {a:04d}-{b:04d}",
+    "{ddd}9{a:04d}{b:04d}",
+    "0 21 {ddd} 9{a:04d}-{b:04d}",
+    "+1-{ddd}5-555-{b:04d}",
+    "{a:03d}",
+]
+DDDS = [11, 21, 31, 41, 51, 61, 71, 81, 85, 91]
+
+
+def make_phones(num_rows: int, seed: int = 42):
+    rng = random.Random(seed)
+    return [
+        rng.choice(PHONE_FORMATS).format(ddd=rng.choice(DDDS), a=rng.randrange(10000), b=rng.randrange(10000))
+        for _ in range(num_rows)
+    ]
+
+
+def timed(label: str, func, rows: int):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {elapsed * 1000:9.1f} ms   {elapsed / rows * 1e6:7.3f} µs/row")
+    return result
+
+
+if __name__ == "__main__":
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    phones = make_phones(num_rows)
+
+    print(f"phone normalization benchmark ({num_rows} rows)\n")
+    per_row = timed("normalize_phone (per row)", lambda: [normalize_phone(p) for p in phones], num_rows)
+    batch = timed("normalize_phones (one call)", lambda: normalize_phones(phones), num_rows)
+
+    assert per_row == batch, "batch output differs from the per-row API"
+    valid = sum(1 for r in batch if r["status"] == "valid")
+    print(f"\n{valid} valid / {num_rows - valid} invalid. Batch output identical to the per-row API.")
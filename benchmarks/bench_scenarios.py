@@ -0,0 +1,241 @@
+"""
+Load-test scenarios against local fake upstreams
+Starts benchmarks/fake_upstreams.py, points the app at it and runs:
+  send    process_whatsapp_batch (inline job) for 1k, 10k and 100k contacts
+  chat    concurrent /api/chat requests answered by the (fake) LLM
+  detect  concurrent /api/detect-columns requests on ambiguous headers
+For each run it reports msg/s (or req/s), p50/p99 upstream latency as seen by
+the app, Redis round trips and the process peak RSS.
+
+Usage: python benchmarks/bench_scenarios.py [--scenarios send,chat,detect] [--sizes 1000,10000,100000]
+                                            [--latency-ms 50] [--error-rate 0] [--throttle-rate 0]
+                                            [--concurrency 200] [--send-rate 0]
+                                            [--redis-url redis://localhost:6379 | --fake-redis]
+
+Pacing is off by default (--send-rate 0) so the numbers measure the code,
+not the Meta tier. --fake-redis (requires `fakeredis`) counts Redis round
+trips on machines without a Redis server; its latency is not representative
+(and without `lupa` the rate-limit script errors and falls back to the local tier).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+MESSAGE = "Olá {name}, a reunião de pais será amanhã às 19h. Atenciosamente, Escola."
+CREDENTIALS = {"phoneNumberId": "100000000000001", "accessToken": "EAAG" + "x" * 60}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss: KiB no Linux, bytes no macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def fetch_stats(base: str, reset: bool = False) -> Dict[str, int]:
+    request = urllib.request.Request(f"{base}/stats/reset" if reset else f"{base}/stats", method="POST" if reset else "GET")
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def start_fake_upstreams(args: argparse.Namespace) -> subprocess.Popen:
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "fake_upstreams.py"),
+        "--port", str(args.port),
+        "--latency-ms", str(args.latency_ms),
+        "--jitter-ms", str(args.jitter_ms),
+        "--error-rate", str(args.error_rate),
+        "--throttle-rate", str(args.throttle_rate),
+        "--tier-rate", str(args.tier_rate),
+    ])
+    base = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            fetch_stats(base)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("fake_upstreams.py did not start")
+
+
+class Scenario:
+    """Collects upstream latencies (httpx hooks) and Redis round trips for one run"""
+
+    def __init__(self, ps, pool_name: str):
+        self.ps = ps
+        self.latencies: List[float] = []
+        client = ps.get_http_client(pool_name)
+        client.event_hooks["request"].append(self._on_request)
+        client.event_hooks["response"].append(self._on_response)
+        self._client = client
+
+    async def _on_request(self, request) -> None:
+        request.extensions["bench_started"] = time.perf_counter()
+
+    async def _on_response(self, response) -> None:
+        self.latencies.append(time.perf_counter() - response.request.extensions["bench_started"])
+
+    def redis_round_trips(self) -> int:
+        return sum(state[2] for state in self.ps.REDIS_LATENCY.values.values())
+
+    def close(self) -> None:
+        self._client.event_hooks["request"].remove(self._on_request)
+        self._client.event_hooks["response"].remove(self._on_response)
+
+
+def report(name: str, size: int, elapsed: float, unit: str, scenario: Scenario, redis_before: int, extra: str) -> None:
+    print(
+        f"{name:<8} {size:>8} {elapsed:9.2f} s {size / elapsed:10.1f} {unit:<5}"
+        f" p50 {percentile(scenario.latencies, 0.50) * 1000:7.1f} ms"
+        f" p99 {percentile(scenario.latencies, 0.99) * 1000:7.1f} ms"
+        f"  redis {scenario.redis_round_trips() - redis_before:>7}"
+        f"  rss {peak_rss_mb():7.1f} MB  {extra}"
+    )
+
+
+async def run_send(ps, size: int, base: str) -> None:
+    scenario = Scenario(ps, ps.GRAPH_POOL)
+    redis_before = scenario.redis_round_trips()
+    retries_before = sum(ps.WHATSAPP_RETRIES.values.values())
+    contacts = [{"id": i, "phone": f"119{i % 10**8:08d}", "name": f"Aluno {i}"} for i in range(size)]
+    job_id = f"bench_send_{size}_{int(time.time())}"
+
+    started = time.perf_counter()
+    await ps.process_whatsapp_batch(job_id, contacts, MESSAGE, CREDENTIALS)
+    elapsed = time.perf_counter() - started
+
+    job = await ps.redis_client.hmget(ps.job_key(job_id), "completed", "failed") if ps.redis_client else ("?", "?")
+    report("send", size, elapsed, "msg/s", scenario, redis_before, f"ok {job[0]} failed {job[1]}")
+    scenario.close()
+
+    # Um POST por contato (+ novas tentativas): menos que isso é envio pulado
+    # (registro de envios, dedupe) e o msg/s acima não mede nada
+    expected = size + int(sum(ps.WHATSAPP_RETRIES.values.values()) - retries_before)
+    sent = fetch_stats(base).get("graph_requests", 0)
+    if sent != expected:
+        raise SystemExit(f"send {size}: {sent} Graph requests, expected {expected} ({size} contacts + retries)")
+
+
+async def run_requests(ps, name: str, size: int, concurrency: int) -> None:
+    import httpx
+
+    scenario = Scenario(ps, ps.OPENROUTER_POOL)
+    redis_before = scenario.redis_round_trips()
+    statuses: Dict[int, int] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    def body(i: int) -> Dict:
+        if name == "chat":
+            return {"message": f"Qual o horário da reunião {i}?", "history": []}
+        # Cabeçalhos ambíguos e únicos: força a chamada à LLM (sem cache)
+        headers = ["Coluna A", "Coluna B", f"Extra {i}"]
+        return {"headers": headers, "sample_data": [{"Coluna A": "x", "Coluna B": "y", f"Extra {i}": "z"}]}
+
+    path = "/api/chat" if name == "chat" else "/api/detect-columns"
+    transport = httpx.ASGITransport(app=ps.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        async def one(i: int) -> None:
+            async with semaphore:
+                response = await client.post(path, json=body(i))
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(size)))
+        elapsed = time.perf_counter() - started
+
+    report(name, size, elapsed, "req/s", scenario, redis_before, f"status {statuses}")
+    scenario.close()
+
+
+async def main(args: argparse.Namespace) -> None:
+    import proxy_server as ps
+
+    if args.fake_redis:
+        import fakeredis
+
+        fake = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        ps.redis_client = ps.redis_blocking_client = ps.InstrumentedRedis(connection_pool=fake.connection_pool)
+    elif ps.redis_client:
+        try:
+            await ps.redis_client.ping()
+        except Exception as e:
+            raise SystemExit(f"Redis unreachable at {ps.Config.REDIS_URL} ({e}); use --redis-url or --fake-redis")
+    ps.rate_limit_script = ps.redis_client.register_script(ps.RATE_LIMIT_GCRA_SCRIPT) if ps.redis_client else None
+    ps.open_http_clients()
+
+    base = f"http://127.0.0.1:{args.port}"
+    print(f"upstream latency {args.latency_ms} ms ± {args.jitter_ms}, errors {args.error_rate}, "
+          f"429s {args.throttle_rate}, send rate {args.send_rate or 'unpaced'}, concurrency {args.concurrency}\n")
+    try:
+        for name in args.scenarios.split(","):
+            for size in (int(s) for s in args.sizes.split(",")):
+                fetch_stats(base, reset=True)
+                if name == "send":
+                    await run_send(ps, size, base)
+                else:
+                    await run_requests(ps, name, min(size, args.max_requests), args.concurrency)
+                print(f"{'':8} upstream: {fetch_stats(base)}")
+    finally:
+        await ps.close_http_clients()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test scenarios against fake upstreams.")
+    parser.add_argument("--scenarios", default="send,chat,detect")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="contacts per send job / requests per run")
+    parser.add_argument("--max-requests", type=int, default=10000, help="cap for chat/detect runs")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--tier-rate", type=float, default=0.0, help="fake Meta tier (msg/s per number, 0 = unlimited)")
+    parser.add_argument("--concurrency", type=int, default=200, help="in-flight Graph/API requests")
+    parser.add_argument("--send-rate", type=float, default=0.0, help="app pacing in msg/s (0 = unpaced)")
+    parser.add_argument("--redis-url", default=os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379"))
+    parser.add_argument("--fake-redis", action="store_true", help="in-process fakeredis instead of a server")
+    args = parser.parse_args()
+
+    # O proxy_server lê a configuração no import: ambiente primeiro
+    base = f"http://127.0.0.1:{args.port}"
+    os.environ.update({
+        "GRAPH_API_BASE_URL": f"{base}/v18.0",
+        "OPENROUTER_BASE_URL": f"{base}/api/v1",
+        "OPENROUTER_API_KEY": os.getenv("OPENROUTER_API_KEY") or "bench-key",
+        "RATE_LIMIT_REDIS_URL": args.redis_url,
+        "WHATSAPP_SEND_RATE": str(args.send_rate),
+        "WHATSAPP_SEND_BURST": str(max(int(args.send_rate), 1)),
+        "WHATSAPP_SEND_CONCURRENCY": str(args.concurrency),
+        "HTTP_MAX_CONNECTIONS": str(max(args.concurrency, 100)),
+        "HTTP_MAX_KEEPALIVE_CONNECTIONS": str(max(args.concurrency, 20)),
+        "RATE_LIMIT_ROUTES": json.dumps({route: {"requests": 10**9, "window": 1} for route in ("chat", "detect")}),
+        # Toda rodada repete mensagem, credenciais e telefones: com o registro de
+        # envios ligado, a segunda rodada no mesmo Redis pularia todos os contatos
+        "SEND_LEDGER_TTL": "0",
+    })
+
+    upstreams = start_fake_upstreams(args)
+    try:
+        asyncio.run(main(args))
+    finally:
+        upstreams.terminate()
+        upstreams.wait()
@@ -0,0 +1,167 @@
+"""
+Local stand-ins for the WhatsApp Graph API and OpenRouter (load testing)
+Mimics `POST /{version}/{phone_number_id}/messages` and
+`POST /api/v1/chat/completions` (plain and `stream: true`) with configurable
+latency, error rate and 429 throttling, so benchmarks never touch the real
+upstreams.
+
+Usage: python benchmarks/fake_upstreams.py [--port 9100] [--latency-ms 50] [--jitter-ms 10]
+                                           [--error-rate 0.0] [--throttle-rate 0.0] [--tier-rate 0]
+
+Point the app at it with:
+    GRAPH_API_BASE_URL=http://127.0.0.1:9100/v18.0
+    OPENROUTER_BASE_URL=http://127.0.0.1:9100/api/v1
+
+GET /stats returns the request counters, POST /stats/reset clears them.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from collections import Counter
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CHAT_REPLY = "Resposta simulada do modelo para o benchmark de carga, sem tags de busca."
+
+
+class TierBucket:
+    """Messages/s accepted before answering 429, like a Meta messaging tier"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+def graph_error(status: int, code: int, message: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status,
+        content={"error": {"message": f"(#{code}) {message}", "type": "OAuthException", "code": code}},
+        headers={"Retry-After": "1"} if status == 429 else None,
+    )
+
+
+def detect_reply(prompt: str) -> str:
+    """Column detection answer built from the `Cabeçalhos:` line of the prompt"""
+    match = re.search(r"Cabeçalhos:\s*(.*)", prompt)
+    headers = [h.strip() for h in match.group(1).split(",")] if match else []
+    name_key = next((h for h in headers if re.search(r"aluno|nome|name", h, re.I)), "")
+    number_key = next((h for h in headers if re.search(r"tel|cel|fone|phone|whats", h, re.I)), "")
+    return json.dumps({"name_key": name_key, "number_key": number_key})
+
+
+def build_app(latency_ms: float, jitter_ms: float, error_rate: float, throttle_rate: float,
+              tier_rate: float, seed: int) -> FastAPI:
+    app = FastAPI(title="Fake upstreams")
+    rng = random.Random(seed)
+    stats: Counter = Counter()
+    tiers = {}
+
+    async def wait_latency() -> None:
+        delay = max(latency_ms + rng.uniform(-jitter_ms, jitter_ms), 0) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+
+    @app.post("/{version}/{phone_number_id}/messages")
+    async def send_message(version: str, phone_number_id: str, request: Request):
+        payload = await request.json()
+        stats["graph_requests"] += 1
+        await wait_latency()
+
+        if tier_rate > 0:
+            tier = tiers.setdefault(phone_number_id, TierBucket(tier_rate))
+            if not tier.try_acquire():
+                stats["graph_429"] += 1
+                return graph_error(429, 130429, "Rate limit hit")
+        roll = rng.random()
+        if roll < throttle_rate:
+            stats["graph_429"] += 1
+            return graph_error(429, 130429, "Rate limit hit")
+        if roll < throttle_rate + error_rate:
+            stats["graph_5xx"] += 1
+            return graph_error(500, 1, "An unknown error occurred")
+        to = str(payload.get("to", ""))
+        if not to.isdigit():
+            stats["graph_400"] += 1
+            return graph_error(400, 131026, "Message undeliverable")
+
+        stats["graph_200"] += 1
+        return {
+            "messaging_product": "whatsapp",
+            "contacts": [{"input": to, "wa_id": to}],
+            "messages": [{"id": f"wamid.FAKE{stats['graph_200']:012d}"}],
+        }
+
+    @app.post("/api/v1/chat/completions")
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        stats["openrouter_requests"] += 1
+        await wait_latency()
+
+        if rng.random() < throttle_rate:
+            stats["openrouter_429"] += 1
+            return JSONResponse(status_code=429, content={"error": {"code": 429, "message": "Rate limit exceeded"}})
+        if rng.random() < error_rate:
+            stats["openrouter_5xx"] += 1
+            return JSONResponse(status_code=502, content={"error": {"code": 502, "message": "Upstream error"}})
+
+        prompt = payload["messages"][-1]["content"]
+        content = detect_reply(prompt) if "name_key" in prompt else CHAT_REPLY
+        stats["openrouter_200"] += 1
+        if not payload.get("stream"):
+            return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+        async def tokens():
+            for word in re.findall(r"\S+\s*", content):
+                chunk = {"choices": [{"delta": {"content": word}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(0.002)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(tokens(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def get_stats():
+        return dict(stats)
+
+    @app.post("/stats/reset")
+    async def reset_stats():
+        stats.clear()
+        return {}
+
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fake Graph API + OpenRouter for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="mean latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="uniform jitter around the mean")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction answered with 5xx")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction answered with 429")
+    parser.add_argument("--tier-rate", type=float, default=0.0, help="Graph msg/s per phone number before 429 (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_args()
+    app = build_app(args.latency_ms, args.jitter_ms, args.error_rate, args.throttle_rate, args.tier_rate, args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -1,10 +1,23 @@
 """
 Sample data generator for WhatsApp Bulk Contact Manager
 Creates Excel files with sample contacts for testing
+
+Usage:
+    python example_data.py                      # small fixtures (sample_*.xlsx/csv)
+    python example_data.py --rows 1000000 --output school_1m.csv [--seed 42]
+                           [--error-rate 0.02] [--duplicate-rate 0.05] [--chunk-size 100000]
+
+The --rows mode builds school lists (Aluno, Responsável, Turma, Telefone)
+by vectorized sampling, one chunk at a time, and streams them to .csv,
+.xlsx (openpyxl write-only) or .parquet (requires pyarrow), so memory stays
+bounded by the chunk size.
 """
 
+import argparse
+import os
 import pandas as pd
 import random
+import numpy as np
 
 # Sample data for different regions and formats
 BRAZILIAN_NAMES = [
@@ -119,8 +132,127 @@ def create_csv_sample(filename: str, num_contacts: int = 50):
     df.to_csv(filename, index=False)
     print(f"Created {filename} with {num_contacts} contacts")
 
-if __name__ == "__main__":
-    # Create sample files
+# --- High-volume school lists (load tests for ingestion, normalization and search) ---
+FIRST_NAMES = sorted({name.split()[0] for name in BRAZILIAN_NAMES})
+LAST_NAMES = sorted({name.split()[-1] for name in BRAZILIAN_NAMES} | {
+    "Assunção", "Brandão", "Conceição", "Gonçalves", "Magalhães", "Ribeiro", "Simões", "Xavier"
+})
+TURMAS = [f"{year}º Ano {letter}" for year in range(1, 10) for letter in "ABCD"] + ["EJA - Noite", "Infantil II", "Infantil III"]
+# DDDs válidos do Brasil (amostra das capitais e regiões metropolitanas)
+DDDS = np.array([11, 12, 13, 19, 21, 24, 27, 31, 41, 43, 47, 48, 51, 54, 61, 62, 65, 67, 71, 79, 81, 85, 91, 92, 98])
+PHONE_FORMATS = 5  # dígitos, (11) 98765-4321, +55 11 98765-4321, 55 11 98765-4321, 11 98765-4321
+ERROR_TYPES = 4    # sem aluno, sem telefone, telefone curto, telefone com letras
+XLSX_MAX_ROWS = 1_048_575  # limite do Excel, fora o cabeçalho
+SCHOOL_COLUMNS = ["Aluno", "Responsável", "Turma", "Telefone"]
+
+
+def _pick(rng: np.random.Generator, values, size: int) -> np.ndarray:
+    return np.asarray(values)[rng.integers(0, len(values), size=size)]
+
+
+def _format_phones(rng: np.random.Generator, national: np.ndarray) -> np.ndarray:
+    """Render 11-digit national mobile numbers in the formats schools export"""
+    ddd = (national // 10**9).astype(str)
+    prefix = (national // 10**4 % 10**5).astype(str)  # começa com 9: nunca perde zeros
+    suffix = np.char.zfill((national % 10**4).astype(str), 4)
+    local = np.char.add(np.char.add(prefix, "-"), suffix)
+    spaced = np.char.add(np.char.add(ddd, " "), local)
+
+    phones = national.astype(str).astype("<U24")
+    formats = rng.integers(0, PHONE_FORMATS, size=len(national))
+    phones[formats == 1] = np.char.add(np.char.add("(", ddd), np.char.add(") ", local))[formats == 1]
+    phones[formats == 2] = np.char.add("+55 ", spaced)[formats == 2]
+    phones[formats == 3] = np.char.add("55 ", spaced)[formats == 3]
+    phones[formats == 4] = spaced[formats == 4]
+    return phones
+
+
+def generate_school_chunks(num_rows: int, seed: int = 42, chunk_size: int = 100_000,
+                           error_rate: float = 0.02, duplicate_rate: float = 0.05):
+    """Yield DataFrames of synthetic school contacts, `chunk_size` rows at a time
+
+    `duplicate_rate` of the rows are siblings: same guardian and phone number
+    as an earlier row of the chunk (usually in another format). `error_rate`
+    of the rows get a missing student name, a missing phone, a too-short
+    phone or letters around the phone.
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_rows, chunk_size):
+        size = min(chunk_size, num_rows - start)
+        surname = _pick(rng, LAST_NAMES, size)
+        aluno = np.char.add(np.char.add(_pick(rng, FIRST_NAMES, size), " "),
+                            np.char.add(np.char.add(_pick(rng, LAST_NAMES, size), " "), surname))
+        responsavel = np.char.add(np.char.add(_pick(rng, FIRST_NAMES, size), " "), surname)
+        national = _pick(rng, DDDS, size).astype(np.int64) * 10**9 + 9 * 10**8 + rng.integers(0, 10**8, size=size)
+
+        # Irmãos: repetem responsável e telefone de uma linha anterior do lote
+        siblings = np.flatnonzero(rng.random(size) < duplicate_rate)
+        siblings = siblings[siblings > 0]
+        sources = (rng.random(len(siblings)) * siblings).astype(np.int64)
+        national[siblings] = national[sources]
+        responsavel[siblings] = responsavel[sources]
+
+        phones = _format_phones(rng, national).astype(object)
+        aluno = aluno.astype(object)
+        errors = np.flatnonzero(rng.random(size) < error_rate)
+        kinds = rng.integers(0, ERROR_TYPES, size=len(errors))
+        aluno[errors[kinds == 0]] = ""
+        phones[errors[kinds == 1]] = ""
+        phones[errors[kinds == 2]] = "123"
+        phones[errors[kinds == 3]] = ["ABC" + p + "XYZ" for p in phones[errors[kinds == 3]]]
+
+        yield pd.DataFrame({
+            "Aluno": aluno,
+            "Responsável": responsavel,
+            "Turma": _pick(rng, TURMAS, size),
+            "Telefone": phones,
+        })
+
+
+def write_school_dataset(filename: str, num_rows: int, **options) -> None:
+    """Stream a generated school list to .csv, .xlsx or .parquet"""
+    extension = os.path.splitext(filename)[1].lower()
+    chunks = generate_school_chunks(num_rows, **options)
+
+    if extension == ".csv":
+        with open(filename, "w", encoding="utf-8", newline="") as out:
+            for index, chunk in enumerate(chunks):
+                chunk.to_csv(out, header=index == 0, index=False)
+    elif extension == ".xlsx":
+        if num_rows > XLSX_MAX_ROWS:
+            raise SystemExit(f"XLSX holds at most {XLSX_MAX_ROWS} rows; use .csv or .parquet")
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Contatos")
+        sheet.append(SCHOOL_COLUMNS)
+        for chunk in chunks:
+            for row in chunk.itertuples(index=False, name=None):
+                sheet.append(row)
+        workbook.save(filename)
+    elif extension == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet output requires pyarrow (pip install pyarrow)")
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(filename, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        raise SystemExit(f"Unsupported output format: {extension} (use .csv, .xlsx or .parquet)")
+    print(f"Created {filename} with {num_rows} contacts")
+
+
+def create_sample_files():
+    """Small fixtures used for manual testing of the web app"""
     print("Creating sample data files...")
     
     # Main sample files
@@ -140,4 +272,23 @@ if __name__ == "__main__":
     print("- sample_large_5000.xlsx (5000 international contacts)")
     print("- sample_contacts.csv (100 contacts in CSV format)")
     print("- brazilian_contacts.xlsx (100 Brazilian contacts)")
-    print("- international_contacts.xlsx (100 international contacts)")
\ No newline at end of file
+    print("- international_contacts.xlsx (100 international contacts)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate sample contact spreadsheets.")
+    parser.add_argument("--rows", type=int, help="generate one large school list with this many rows")
+    parser.add_argument("--output", default="school_contacts.csv", help=".csv, .xlsx or .parquet")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="rows generated and written at a time")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="fraction of rows with a bad name/phone")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05, help="fraction of rows sharing a sibling's phone")
+    args = parser.parse_args()
+
+    if args.rows:
+        write_school_dataset(
+            args.output, args.rows, seed=args.seed, chunk_size=args.chunk_size,
+            error_rate=args.error_rate, duplicate_rate=args.duplicate_rate,
+        )
+    else:
+        create_sample_files()
@@ -36,6 +36,10 @@ class WhatsAppBulkManager {
             foundDeleteIds: [], // Para "remover turma Y"
         };
 
+        // NOVO: Sessão de contatos no backend (índice da lista inteira).
+        // É invalidada sempre que `processedContacts` muda.
+        this.contactSessionId = null;
+
         this.initializeElements();
         this.bindEvents();
         this.loadSavedState();
@@ -177,8 +181,8 @@ class WhatsAppBulkManager {
         this.aiConfirmSendBtn.addEventListener('click', () => {
             this.hideModal('aiConfirmModal');
             if (this.pendingAiMessage) {
-                // ATUALIZAÇÃO: Inicia a busca paginada em vez de chamar a API diretamente
-                this.startPaginatedAiSearch(this.pendingAiMessage); 
+                // ATUALIZAÇÃO: Busca na lista inteira via sessão (fallback: busca paginada)
+                this.startAiSearch(this.pendingAiMessage); 
                 this.pendingAiMessage = ""; // Limpa a mensagem pendente
             }
         });
@@ -329,6 +333,109 @@ class WhatsAppBulkManager {
         return false; 
     }
     
+    // NOVO: Busca na lista inteira via Sessão de Contatos (uma única chamada)
+
+    async startAiSearch(userMessage) {
+        const sessionId = await this.ensureContactSession();
+        if (sessionId) {
+            this.aiSearchState.running = true;
+            this.chatStatus.classList.remove('hidden');
+            await this.callChatSessionAPI(userMessage, sessionId);
+            return;
+        }
+        // Sem sessão (ex: backend antigo ou erro): usa a busca paginada
+        this.startPaginatedAiSearch(userMessage);
+    }
+
+    async ensureContactSession() {
+        if (this.contactSessionId) return this.contactSessionId;
+        if (this.processedContacts.length === 0) return null;
+
+        // Envia só os campos de busca (sem telefones)
+        const contacts = this.mapContactsForAI(this.processedContacts).map(c => ({
+            id: c.id,
+            aluno: String(c.aluno),
+            responsavel: String(c.responsavel),
+            turma: String(c.turma),
+            status: c.status
+        }));
+
+        try {
+            const response = await fetch(`${API_BASE_URL}/api/contact-session`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ contacts })
+            });
+            if (!response.ok) return null;
+            const data = await response.json();
+            this.contactSessionId = data.sessionId;
+            return this.contactSessionId;
+        } catch (error) {
+            console.warn('Falha ao criar sessão de contatos, usando busca paginada:', error);
+            return null;
+        }
+    }
+
+    async callChatSessionAPI(userMessage, sessionId) {
+        // Primeiro lote como contexto, caso a pergunta vá para a LLM (chat normal)
+        const firstChunk = this.mapContactsForAI(this.processedContacts.slice(0, this.aiSearchState.chunkSize));
+        const payload = {
+            message: userMessage,
+            history: this.chatHistory,
+            session_id: sessionId,
+            stream: true,
+            contact_data_sample: {
+                status: "processing_complete",
+                total_contacts: this.processedContacts.length,
+                contact_sample: firstChunk
+            }
+        };
+
+        try {
+            const response = await fetch(`${API_BASE_URL}/api/chat`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(payload)
+            });
+
+            if (response.status === 404) {
+                // Sessão expirou: recria e tenta de novo na próxima mensagem
+                this.contactSessionId = null;
+                this.addMessage('A sessão da lista expirou. Por favor, envie o comando novamente.', 'ai');
+                return;
+            }
+            if (response.status === 429) {
+                this.addMessage('Desculpe, o limite de taxa para o chatbot foi excedido. Tente novamente em 1 hora.', 'ai');
+                return;
+            }
+            if (!response.ok) {
+                const errorData = await response.json().catch(() => ({ detail: 'Resposta de erro inesperada do servidor.' }));
+                this.addMessage(`Erro da API Chatbot: ${errorData.detail || errorData.error || 'Erro desconhecido.'}`, 'ai');
+                return;
+            }
+
+            const aiResponseText = await this.readChatStream(response);
+
+            const keepMatch = aiResponseText.match(/\[SEARCH_FOUND_KEEP_ID:\s*(\d+)\]/);
+            const deleteMatch = aiResponseText.match(/\[SEARCH_FOUND_DELETE_IDS:\s*([\d,\s]+)\]/);
+
+            this.addMessage(aiResponseText, 'ai');
+            if (keepMatch) {
+                this.finalizeComplexDeletion(parseInt(keepMatch[1]));
+            } else if (deleteMatch) {
+                this.finalizeSimpleDeletion(deleteMatch[1].split(',').map(id => parseInt(id.trim())));
+            } else if (aiResponseText.includes("[SEARCH_PAGE_FAIL]")) {
+                this.addMessage("Busca concluída. Não encontrei nenhum contato correspondente em *toda* a lista.", 'ai');
+            }
+        } catch (error) {
+            console.error('Chat API Error:', error);
+            this.addMessage('Desculpe, não foi possível conectar ao assistente de AI. Verifique se o backend do Render está ativo.', 'ai');
+        } finally {
+            this.aiSearchState.running = false;
+            this.chatStatus.classList.add('hidden');
+        }
+    }
+
     // NOVO: Funções de Busca Paginada
     
     startPaginatedAiSearch(userMessage) {
@@ -510,6 +617,81 @@ class WhatsAppBulkManager {
         this.scrollToBottom();
     }
     
+    // Lê a resposta SSE do /api/chat, mostrando os tokens numa bolha provisória.
+    // Devolve o texto final (com as tags [SEARCH_*]) para o roteamento de sempre.
+    async readChatStream(response) {
+        const contentType = response.headers.get('content-type') || '';
+        if (!contentType.includes('text/event-stream') || !response.body) {
+            const data = await response.json();
+            return data.response;
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let liveText = '';
+        let finalText = null;
+        let liveDiv = null;
+
+        try {
+            while (finalText === null) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+
+                    let eventName = 'message';
+                    let dataLines = [];
+                    for (const line of rawEvent.split('\n')) {
+                        if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+                    }
+                    if (!dataLines.length) continue;
+                    const data = JSON.parse(dataLines.join('\n'));
+
+                    if (eventName === 'token') {
+                        liveText += data.delta;
+                        liveDiv = this.updateLiveMessage(liveDiv, liveText);
+                    } else if (eventName === 'message' || eventName === 'done') {
+                        finalText = data.response;
+                    } else if (eventName === 'error') {
+                        throw new Error(data.error || 'Erro no streaming da AI.');
+                    }
+                }
+            }
+        } finally {
+            reader.cancel().catch(() => {});
+            if (liveDiv) liveDiv.remove(); // A mensagem definitiva entra via addMessage
+        }
+
+        if (finalText === null) {
+            if (!liveText) throw new Error('Stream encerrado sem resposta.');
+            finalText = liveText;
+        }
+        return finalText;
+    }
+
+    // Bolha provisória (fora do histórico) atualizada a cada token
+    updateLiveMessage(liveDiv, text) {
+        this.chatStatus.classList.add('hidden');
+        if (!liveDiv) {
+            liveDiv = document.createElement('div');
+            liveDiv.className = 'flex justify-start';
+            const bubble = document.createElement('div');
+            bubble.className = 'message-bubble ai-message';
+            liveDiv.appendChild(bubble);
+            this.chatMessages.appendChild(liveDiv);
+        }
+        const cleanedText = text.replace(/\[SEARCH_[^\]]*\]?/g, '').replace(/[*#]/g, '');
+        liveDiv.firstChild.innerHTML = this.escapeHtml(cleanedText).replace(/\n/g, '<br>');
+        this.scrollToBottom();
+        return liveDiv;
+    }
+
     scrollToBottom() {
         this.chatMessages.scrollTop = this.chatMessages.scrollHeight;
     }
@@ -549,7 +731,8 @@ class WhatsAppBulkManager {
         const payload = {
             message: userMessage,
             history: historyPayload,
-            contact_data_sample: JSON.stringify(sampleData) // Envia o lote atual
+            contact_data_sample: sampleData, // Envia o lote atual (objeto JSON, sem dupla codificação)
+            stream: true // Resposta token a token (Server-Sent Events)
         };
 
         try {
@@ -572,8 +755,7 @@ class WhatsAppBulkManager {
                  return;
             }
 
-            const data = await response.json();
-            const aiResponseText = data.response;
+            const aiResponseText = await this.readChatStream(response);
             
             this.chatStatus.classList.add('hidden'); // Esconde "digitando..."
 
@@ -1001,6 +1183,8 @@ class WhatsAppBulkManager {
         
         // Junta as listas, colocando inválidos no final
         this.processedContacts = processedList.concat(invalidList);
+        // A lista mudou: a sessão de busca no backend precisa ser recriada
+        this.contactSessionId = null;
     }
 
     showPreview() {
@@ -1622,64 +1806,143 @@ class WhatsAppAPI {
             const jobId = jobData.jobId;
             const totalContacts = jobData.totalContacts;
             
-            // 2. Inicia o Polling para o status do job
-            let status = 'processing';
+            // 2. Acompanha o job: eventos em tempo real (SSE) e, se indisponível, polling
+            try {
+                return await this.watchJobEvents(jobId, totalContacts, onProgress);
+            } catch (sseError) {
+                console.warn(`Progresso em tempo real indisponível (usando polling): ${sseError.message}`);
+                return await this.pollJobStatus(jobId, totalContacts, onProgress);
+            }
+
+        } catch (error) {
+            console.error('API Error during batch send:', error);
+            throw error;
+        }
+    }
+
+    // Progresso por Server-Sent Events: cada evento traz só o delta dos contadores
+    // e os resultados novos. Rejeita (para cair no polling) se nada chegar.
+    static watchJobEvents(jobId, totalContacts, onProgress) {
+        return new Promise((resolve, reject) => {
+            if (typeof EventSource === 'undefined') {
+                reject(new Error('EventSource não suportado pelo navegador.'));
+                return;
+            }
+
+            const source = new EventSource(`${API_BASE_URL}/api/job-events/${encodeURIComponent(jobId)}`);
+            const resultsByIndex = new Map(); // Um resultado por contato (o mais recente vence)
             let totalSent = 0;
             let totalFailed = 0;
-            let results = [];
+            let received = false;
+
+            const report = () => {
+                if (onProgress) {
+                    onProgress({
+                        current: totalSent + totalFailed,
+                        total: totalContacts,
+                        message: `Processados: ${totalSent} com sucesso, ${totalFailed} com falha.`
+                    });
+                }
+            };
 
-            while (status === 'processing') {
-                // Espera 3 segundos antes do próximo poll (reduz o load no Redis e no servidor)
-                await new Promise(resolve => setTimeout(resolve, 3000));
-                
-                try {
-                    const statusResponse = await fetch(`${API_BASE_URL}/api/job-status/${jobId}`);
-                    
-                    // Trata erro 503 (Serviço indisponível, ex: Redis não configurado)
-                    if (statusResponse.status === 503) {
-                         throw new Error('Rastreamento de trabalho (Job tracking) indisponível. Verifique a configuração do Redis no backend.');
-                    }
+            source.addEventListener('progress', (event) => {
+                received = true;
+                const data = JSON.parse(event.data);
+                totalSent += data.completed;
+                totalFailed += data.failed;
+                (data.results || []).forEach((result, i) => {
+                    resultsByIndex.set(result.index ?? `${event.lastEventId}-${i}`, result);
+                });
+                report();
+            });
 
-                    if (!statusResponse.ok) {
-                         const errorDetail = await statusResponse.json().catch(() => ({ detail: 'Erro de rede desconhecido' }));
-                         console.warn(`Falha ao obter status (tentando novamente): ${errorDetail.detail}`);
-                         await new Promise(resolve => setTimeout(resolve, 2000)); // Espera extra
-                         continue; // Tenta o loop novamente
-                    }
-                    
-                    const statusData = await statusResponse.json();
-                    status = statusData.status;
-                    totalSent = statusData.completed || 0;
-                    totalFailed = statusData.failed || 0;
-                    results = statusData.results || [];
-                    
-                    if (onProgress) {
-                        onProgress({
-                            current: totalSent + totalFailed,
-                            total: totalContacts,
-                            message: `Processados: ${totalSent} com sucesso, ${totalFailed} com falha.`
-                        });
-                    }
+            source.addEventListener('done', (event) => {
+                const data = JSON.parse(event.data);
+                source.close();
+                totalSent = data.completed;
+                totalFailed = data.failed;
+                report();
+                resolve({
+                    total: totalContacts,
+                    success: totalSent,
+                    failed: totalFailed,
+                    results: Array.from(resultsByIndex.values())
+                });
+            });
 
-                } catch (pollError) {
-                    console.error("Erro no polling de status:", pollError);
-                    // Continua tentando em caso de falha de rede no polling
-                    await new Promise(resolve => setTimeout(resolve, 5000));
+            source.addEventListener('error', (event) => {
+                // Evento `error` enviado pelo servidor (com dados) ou falha de conexão
+                if (event.data || !received || source.readyState === EventSource.CLOSED) {
+                    source.close();
+                    reject(new Error('Conexão de eventos do job encerrada.'));
                 }
+                // Senão o navegador reconecta sozinho, enviando o Last-Event-ID
+            });
+        });
+    }
+
+    // Fallback: polling de /api/job-status a cada 3 segundos
+    static async pollJobStatus(jobId, totalContacts, onProgress) {
+        let status = 'processing';
+        let totalSent = 0;
+        let totalFailed = 0;
+        let cursor = 0; // Modo delta: cada poll traz só os resultados novos
+        let hasMore = false;
+        const resultsByIndex = new Map();
+
+        while (status === 'processing' || hasMore) {
+            // Espera 3 segundos antes do próximo poll (reduz o load no Redis e no servidor)
+            if (!hasMore) {
+                await new Promise(resolve => setTimeout(resolve, 3000));
             }
             
-            // 3. Retorna o resultado final
-            return {
-                total: totalContacts,
-                success: totalSent,
-                failed: totalFailed,
-                results: results
-            };
+            try {
+                const statusResponse = await fetch(`${API_BASE_URL}/api/job-status/${encodeURIComponent(jobId)}?since=${cursor}&limit=1000`);
+                
+                // Trata erro 503 (Serviço indisponível, ex: Redis não configurado)
+                if (statusResponse.status === 503) {
+                     throw new Error('Rastreamento de trabalho (Job tracking) indisponível. Verifique a configuração do Redis no backend.');
+                }
 
-        } catch (error) {
-            console.error('API Error during batch send:', error);
-            throw error;
+                if (!statusResponse.ok) {
+                     const errorDetail = await statusResponse.json().catch(() => ({ detail: 'Erro de rede desconhecido' }));
+                     console.warn(`Falha ao obter status (tentando novamente): ${errorDetail.detail}`);
+                     await new Promise(resolve => setTimeout(resolve, 2000)); // Espera extra
+                     continue; // Tenta o loop novamente
+                }
+                
+                const statusData = await statusResponse.json();
+                status = statusData.status;
+                totalSent = statusData.completed || 0;
+                totalFailed = statusData.failed || 0;
+                (statusData.results || []).forEach((result, i) => {
+                    resultsByIndex.set(result.index ?? cursor + i, result);
+                });
+                cursor = statusData.nextCursor ?? cursor;
+                hasMore = Boolean(statusData.hasMore);
+                
+                if (onProgress) {
+                    onProgress({
+                        current: totalSent + totalFailed,
+                        total: totalContacts,
+                        message: `Processados: ${totalSent} com sucesso, ${totalFailed} com falha.`
+                    });
+                }
+
+            } catch (pollError) {
+                console.error("Erro no polling de status:", pollError);
+                // Continua tentando em caso de falha de rede no polling
+                await new Promise(resolve => setTimeout(resolve, 5000));
+            }
         }
+        
+        // 3. Retorna o resultado final
+        return {
+            total: totalContacts,
+            success: totalSent,
+            failed: totalFailed,
+            results: Array.from(resultsByIndex.values())
+        };
     }
 }
 
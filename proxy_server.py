@@ -66,20 +66,45 @@ FastAPI implementation for AI column detection, Chatbot, and WhatsApp Cloud API
 ================================================================================
 """
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager, contextmanager
 import httpx
 import os
-from typing import Dict, List, Any, Optional
-import redis
+from typing import Dict, List, Any, Optional, Tuple, Union
+from redis import asyncio as aioredis
 from datetime import datetime
 import json
 import asyncio
 import re
-from pydantic import BaseModel, Field # ATUALIZADO: Importa Field para validação
+import time
+from pydantic import BaseModel, Field, StrictFloat, StrictInt, StrictStr # ATUALIZADO: Importa Field para validação
 import logging 
 import unicodedata # NOVO: Para normalizar texto (remover acentos)
+import secrets
+import random
+import hashlib
+from functools import lru_cache
+from collections import OrderedDict, deque
+import base64
+import bisect
+import codecs
+import csv
+import io
+import zlib
+
+try:
+    # Leitura de .xlsx linha a linha (modo read_only) na ingestão
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+try:
+    # Serialização JSON rápida (payloads de envio); sem ela, usa o `json` da stdlib
+    import orjson
+except ImportError:
+    orjson = None
 
 # --- IMPLEMENTAÇÃO (LGPD: Monitoramento e Auditoria de Logs) ---
 # Configura o sistema de logging do Python para registrar eventos de segurança.
@@ -97,17 +122,456 @@ AI_MODEL = "tngtech/deepseek-r1t2-chimera:free"
 SITE_URL = os.getenv("FRONTEND_URL", "http://localhost:8000") # Use a variável do Render
 SITE_TITLE = "WhatsApp Bulk Manager"
 
+def env_json(name: str) -> Dict[str, Any]:
+    """JSON object from an environment variable; logs and returns {} if malformed"""
+    raw = os.getenv(name, "")
+    if not raw:
+        return {}
+    try:
+        value = json.loads(raw)
+    except ValueError as e:
+        logging.error(f"Variável de ambiente {name} ignorada: JSON inválido ({e}).")
+        return {}
+    if not isinstance(value, dict):
+        logging.error(f"Variável de ambiente {name} ignorada: esperado um objeto JSON.")
+        return {}
+    return value
+
 class Config:
     # NOVO: Variável de ambiente para a API da AI (DeepSeek via OpenRouter)
     OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
+    # Bases dos upstreams (benchmarks apontam para benchmarks/fake_upstreams.py)
+    OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1").rstrip("/")
+    GRAPH_API_BASE_URL = os.getenv("GRAPH_API_BASE_URL", "https://graph.facebook.com/v18.0").rstrip("/")
     # REMOVIDO: GEMINI_API_KEY (substituído por OPENROUTER_API_KEY)
     REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379")
+    # Pool compartilhado do cliente Redis assíncrono
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+    REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "1.0"))  # segundos
+    REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "1.0"))  # segundos
+    REDIS_BLOCKING_SOCKET_TIMEOUT = float(os.getenv("REDIS_BLOCKING_SOCKET_TIMEOUT", "30"))  # segundos, comandos com BLOCK
     CORS_ORIGINS = os.getenv("CORS_ALLOWED_ORIGINS", "*").split(",")
     RATE_LIMIT_REQUESTS = 100
     RATE_LIMIT_WINDOW = 3600  # 1 hour
+    # Limite por rota (custos muito diferentes); rotas fora da lista usam o padrão acima.
+    # Ajuste via JSON, ex: '{"chat": {"requests": 60, "window": 3600}}'
+    RATE_LIMIT_ROUTES = {
+        "chat": {"requests": 100, "window": 3600},   # cada pergunta pode chamar a LLM
+        "detect": {"requests": 100, "window": 3600},
+        "send": {"requests": 30, "window": 3600},    # cada chamada dispara um job inteiro
+        "ingest": {"requests": 30, "window": 3600},  # upload de planilha inteira
+        **env_json("RATE_LIMIT_ROUTES"),
+    }
+    RATE_LIMIT_LOCAL_MAX_KEYS = int(os.getenv("RATE_LIMIT_LOCAL_MAX_KEYS", "10000"))  # baldes (IP, rota) em memória por processo
+    # Pools de conexão HTTP (um por upstream: OpenRouter e Graph API)
+    HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+    HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+    HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))  # segundos
+    HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() in ("1", "true", "yes")
+    # Ritmo de envio por phoneNumberId (padrão = tier padrão da Cloud API: 80 msg/s)
+    WHATSAPP_SEND_RATE = float(os.getenv("WHATSAPP_SEND_RATE", "80"))  # mensagens/segundo
+    WHATSAPP_SEND_BURST = int(os.getenv("WHATSAPP_SEND_BURST", "80"))
+    WHATSAPP_SEND_CONCURRENCY = int(os.getenv("WHATSAPP_SEND_CONCURRENCY", "20"))
+    # Ajuste por número, ex: '{"1234567890": {"rate": 250, "burst": 250, "concurrency": 50}}'
+    WHATSAPP_RATE_OVERRIDES = env_json("WHATSAPP_RATE_OVERRIDES")
+    # Novas tentativas de erros transitórios da Graph API (429, 5xx, códigos de throttling, rede)
+    WHATSAPP_RETRY_MAX_ATTEMPTS = int(os.getenv("WHATSAPP_RETRY_MAX_ATTEMPTS", "4"))  # tentativas por mensagem, incluindo a primeira
+    WHATSAPP_RETRY_BASE_DELAY = float(os.getenv("WHATSAPP_RETRY_BASE_DELAY", "1.0"))  # segundos; dobra a cada tentativa (com jitter)
+    WHATSAPP_RETRY_MAX_DELAY = float(os.getenv("WHATSAPP_RETRY_MAX_DELAY", "60"))  # teto da espera entre tentativas (segundos)
+    # Ritmo adaptativo (AIMD): cada throttling corta o ritmo do número, cada sucesso o recupera aos poucos
+    WHATSAPP_AIMD_DECREASE = float(os.getenv("WHATSAPP_AIMD_DECREASE", "0.5"))  # fator aplicado ao ritmo a cada throttling
+    WHATSAPP_AIMD_INCREASE = float(os.getenv("WHATSAPP_AIMD_INCREASE", "1.0"))  # msg/s recuperadas por segundo sem throttling
+    WHATSAPP_AIMD_MIN_RATE = float(os.getenv("WHATSAPP_AIMD_MIN_RATE", "1.0"))  # piso do ritmo (msg/s)
+    # Contatos com o mesmo telefone viram um único envio. Desligado por padrão: muda o {name} da mensagem
+    WHATSAPP_DEDUPE = os.getenv("WHATSAPP_DEDUPE", "false").lower() in ("1", "true", "yes")
+    # Registro de envios entre jobs: quem já recebeu a mesma mensagem do mesmo número é pulado
+    SEND_LEDGER_TTL = int(os.getenv("SEND_LEDGER_TTL", "86400"))  # segundos lembrados (0 = desativado)
+    SEND_LEDGER_BUCKET = max(1, int(os.getenv("SEND_LEDGER_BUCKET", "3600")))  # segundos por SET do registro (mínimo 1)
+    # Quantos contatos por atualização de progresso do job
+    WHATSAPP_PROGRESS_CHUNK = int(os.getenv("WHATSAPP_PROGRESS_CHUNK", "100"))
+    JOB_TTL = int(os.getenv("JOB_TTL", "3600"))  # retenção do estado do job no Redis (segundos)
+    JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", "120"))  # segundos sem progresso até o job ser considerado parado
+    JOB_EVENTS_BLOCK_MS = int(os.getenv("JOB_EVENTS_BLOCK_MS", "10000"))  # espera do XREAD por eventos novos do job
+    JOB_EVENTS_KEEPALIVE = float(os.getenv("JOB_EVENTS_KEEPALIVE", "15"))  # segundos entre keep-alives do SSE
+    # Execução dos envios: "inline" (task no processo web) ou "queue" (Redis Streams + send_worker.py)
+    SEND_EXECUTION_MODE = os.getenv("SEND_EXECUTION_MODE", "inline").lower()
+    SEND_QUEUE_STREAM = os.getenv("SEND_QUEUE_STREAM", "send_queue")
+    SEND_QUEUE_GROUP = os.getenv("SEND_QUEUE_GROUP", "send_workers")
+    SEND_QUEUE_VISIBILITY_TIMEOUT = float(os.getenv("SEND_QUEUE_VISIBILITY_TIMEOUT", "60"))  # segundos sem heartbeat até outro worker assumir
+    SEND_QUEUE_MAX_DELIVERIES = int(os.getenv("SEND_QUEUE_MAX_DELIVERIES", "5"))  # entregas de um lote antes de desistir
+    SEND_QUEUE_BLOCK_MS = int(os.getenv("SEND_QUEUE_BLOCK_MS", "5000"))  # espera do XREADGROUP por lotes novos
+    SEND_WORKER_COUNT = int(os.getenv("SEND_WORKER_COUNT", "2"))  # processos do send_worker.py neste host
+    # Total de processos de envio na frota (todos os hosts): o ritmo por número é dividido entre eles
+    SEND_WORKER_TOTAL = int(os.getenv("SEND_WORKER_TOTAL", "0")) or SEND_WORKER_COUNT
+    # Sessões de contatos do chat (índice invertido da lista inteira)
+    CONTACT_SESSION_TTL = int(os.getenv("CONTACT_SESSION_TTL", "1800"))  # segundos
+    CONTACT_SESSION_MAX_CONTACTS = int(os.getenv("CONTACT_SESSION_MAX_CONTACTS", "100000"))
+    CONTACT_SESSION_CACHE_SIZE = int(os.getenv("CONTACT_SESSION_CACHE_SIZE", "32"))  # índices em memória por processo
+    NORMALIZE_CACHE_SIZE = int(os.getenv("NORMALIZE_CACHE_SIZE", "8192"))  # entradas do LRU de normalize_text
+    # Cache da detecção de colunas (assinatura dos cabeçalhos -> colunas)
+    DETECT_CACHE_SIZE = int(os.getenv("DETECT_CACHE_SIZE", "1024"))
+    DETECT_CACHE_TTL = int(os.getenv("DETECT_CACHE_TTL", "604800"))  # 7 dias
+    # Confiança mínima do detector por pontuação para dispensar a LLM (0 a 1)
+    DETECT_CONFIDENCE_THRESHOLD = float(os.getenv("DETECT_CONFIDENCE_THRESHOLD", "0.8"))
+    # Normalização de telefones (E.164)
+    PHONE_DEFAULT_COUNTRY = os.getenv("PHONE_DEFAULT_COUNTRY", "55")  # DDI assumido quando o número não tem "+"
+    PHONE_NORMALIZE_MAX = int(os.getenv("PHONE_NORMALIZE_MAX", "100000"))  # telefones por chamada em /api/phones/normalize
+    # Ingestão de planilhas no servidor (/api/ingest)
+    INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "1000"))  # linhas por lote gravado
+    INGEST_DETECT_ROWS = int(os.getenv("INGEST_DETECT_ROWS", "50"))  # linhas usadas na detecção de colunas
+    # Métricas (GET /metrics, formato Prometheus)
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # se definido, exige "Authorization: Bearer <token>"
+    METRICS_THROUGHPUT_WINDOW = float(os.getenv("METRICS_THROUGHPUT_WINDOW", "60"))  # segundos da média de msg/s
+    SEND_WORKER_METRICS_PORT = int(os.getenv("SEND_WORKER_METRICS_PORT", "0"))  # 0 = desativado; processo i usa porta + i
+    # Codificação do estado dos jobs no Redis (resultados e lotes da fila): "json" ou "zlib"
+    JOB_STATE_CODEC = os.getenv("JOB_STATE_CODEC", "json").lower()
+    JOB_STATE_COMPRESS_MIN = int(os.getenv("JOB_STATE_COMPRESS_MIN", "512"))  # bytes; valores menores ficam em JSON puro
+
+# --- Métricas (formato de exposição do Prometheus) ---
+# Registro mínimo em memória, por processo: contadores, gauges e histogramas
+# com rótulos, expostos em GET /metrics (formato texto 0.0.4). Cada processo
+# tem os próprios valores; os workers de envio expõem os seus em
+# SEND_WORKER_METRICS_PORT.
+#
+# --- LGPD (Minimização de Dados) ---
+# Os rótulos são só rotas (templates), comandos, upstreams e códigos de
+# status: nunca IPs, telefones, IDs de job ou conteúdo de mensagens.
+# -------------------------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+REDIS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0)
+
+metrics_registry: List["Metric"] = []
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """One metric family: a value per combination of label values"""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], Any] = {}
+        metrics_registry.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in list(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {float(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = float(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # [contagem por bucket (não cumulativa), soma, contagem total]
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        position = bisect.bisect_left(self.buckets, value)
+        if position < len(self.buckets):
+            state[0][position] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class ThroughputMeter:
+    """Events per second over a sliding window"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.events: "deque[Tuple[float, int]]" = deque()
+
+    def add(self, count: int) -> None:
+        self.events.append((time.monotonic(), count))
+        self._prune()
+
+    def _prune(self) -> None:
+        cutoff = time.monotonic() - self.window
+        while self.events and self.events[0][0] < cutoff:
+            self.events.popleft()
+
+    def rate(self) -> float:
+        self._prune()
+        return sum(count for _, count in self.events) / self.window
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "Requisições HTTP por rota, método e status.", ("route", "method", "status"))
+HTTP_ERRORS = Counter("http_request_errors_total", "Respostas 5xx e exceções não tratadas por rota.", ("route", "method"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Latência das rotas até o início da resposta.", ("route", "method"))
+UPSTREAM_LATENCY = Histogram("upstream_request_duration_seconds", "Latência das chamadas à OpenRouter e à Graph API.", ("upstream", "operation"))
+UPSTREAM_ERRORS = Counter("upstream_request_errors_total", "Chamadas a upstreams com status >= 400 ou erro de transporte.", ("upstream", "operation", "reason"))
+REDIS_LATENCY = Histogram("redis_command_duration_seconds", "Latência dos comandos Redis (pipelines contam como um comando).", ("command",), REDIS_LATENCY_BUCKETS)
+REDIS_ERRORS = Counter("redis_command_errors_total", "Comandos Redis que falharam.", ("command",))
+RATE_LIMIT_REJECTIONS = Counter("rate_limit_rejections_total", "Requisições recusadas pelo rate limit (429) por rota e camada (local ou redis).", ("route", "tier"))
+CHAT_ANSWERS = Counter("chat_answers_total", "Respostas do chat por motor (regras ou LLM).", ("engine",))
+CHAT_RULE_HIT_RATIO = Gauge("chat_rule_engine_hit_ratio", "Fração das respostas do chat resolvidas pelo motor de regras.")
+COLUMN_DETECTIONS = Counter("column_detections_total", "Detecções de colunas por endpoint e método (score, cache, llm, heuristic, manual).", ("endpoint", "method"))
+WHATSAPP_MESSAGES = Counter("whatsapp_messages_total", "Contatos do WhatsApp processados por resultado (um por contato, como no job).", ("result",))
+WHATSAPP_THROUGHPUT = Gauge("whatsapp_send_throughput_messages_per_second", "Mensagens processadas por segundo (média na janela METRICS_THROUGHPUT_WINDOW).")
+WHATSAPP_RETRIES = Counter("whatsapp_send_retries_total", "Novas tentativas de envio por motivo (status HTTP, código da Graph API ou erro de rede).", ("reason",))
+WHATSAPP_SEND_RATE_CURRENT = Gauge("whatsapp_send_rate_messages_per_second", "Ritmo atual do pacer por número, após o ajuste AIMD.", ("phone_number_id",))
+SEND_PACER_WAIT = Histogram("whatsapp_pacer_wait_seconds", "Espera por um slot do pacer do número (concorrência + token bucket).")
+SEND_QUEUE_DEPTH = Gauge("send_queue_entries", "Lotes na fila de envio: no stream e pendentes (entregues, sem XACK).", ("state",))
+
+send_throughput = ThroughputMeter(Config.METRICS_THROUGHPUT_WINDOW)
+
+@contextmanager
+def track_upstream(upstream: str, operation: str):
+    """Time one upstream call; set `call["status"]` to count HTTP errors"""
+    call: Dict[str, Optional[int]] = {"status": None}
+    started = time.perf_counter()
+    try:
+        yield call
+    except Exception as e:
+        UPSTREAM_ERRORS.inc(upstream=upstream, operation=operation, reason=type(e).__name__)
+        raise
+    else:
+        if call["status"] is not None and call["status"] >= 400:
+            UPSTREAM_ERRORS.inc(upstream=upstream, operation=operation, reason=str(call["status"]))
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream=upstream, operation=operation)
+
+@contextmanager
+def track_redis(command: str):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        REDIS_ERRORS.inc(command=command)
+        raise
+    finally:
+        REDIS_LATENCY.observe(time.perf_counter() - started, command=command)
+
+
+class InstrumentedPipeline(aioredis.client.Pipeline):
+    """Pipeline timed as a single round trip (MULTI or PIPELINE)"""
+
+    async def execute(self, raise_on_error: bool = True):
+        with track_redis("MULTI" if self.is_transaction else "PIPELINE"):
+            return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(aioredis.Redis):
+    """redis.asyncio client that records latency/errors of every command"""
+
+    async def execute_command(self, *args, **options):
+        with track_redis(str(args[0]).upper()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+async def refresh_metrics() -> None:
+    """Update the gauges that are computed at scrape time"""
+    WHATSAPP_THROUGHPUT.set(send_throughput.rate())
+    rules = CHAT_ANSWERS.values.get(("rules",), 0.0)
+    answers = rules + CHAT_ANSWERS.values.get(("llm",), 0.0)
+    CHAT_RULE_HIT_RATIO.set(rules / answers if answers else 0.0)
+    if redis_client:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.xlen(Config.SEND_QUEUE_STREAM)
+                pipe.xpending(Config.SEND_QUEUE_STREAM, Config.SEND_QUEUE_GROUP)
+                length, pending = await pipe.execute(raise_on_error=False)
+            SEND_QUEUE_DEPTH.set(length if isinstance(length, int) else 0, state="stream")
+            SEND_QUEUE_DEPTH.set(pending["pending"] if isinstance(pending, dict) else 0, state="pending")
+        except Exception as e:
+            logging.warning(f"Falha ao ler a profundidade da fila de envio para as métricas: {e}")
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines: List[str] = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# --- Codecs (respostas JSON e estado dos jobs no Redis) ---
+# JSON rápido (orjson, quando instalado) em todo lugar: respostas da API,
+# eventos SSE, payloads de envio e valores no Redis. O estado dos jobs passa
+# por um codec plugável (JOB_STATE_CODEC): "json" grava JSON compacto; "zlib"
+# comprime valores grandes (lotes da fila, resultados com erros longos). Os
+# valores comprimidos levam o prefixo "z:" e ficam em base64 (o cliente Redis
+# usa decode_responses), então a leitura reconhece os dois formatos e trocar
+# o codec não invalida jobs em andamento.
+DefaultJSONResponse = ORJSONResponse if orjson is not None else JSONResponse
+COMPRESSED_PREFIX = "z:"
+
+def json_bytes(value: Any) -> bytes:
+    """Compact UTF-8 JSON (orjson when installed)"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+def json_text(value: Any) -> str:
+    return json_bytes(value).decode()
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _encode_json_value(value: Any) -> str:
+    return json_text(value)
+
+def _encode_zlib_value(value: Any) -> str:
+    raw = json_bytes(value)
+    if len(raw) < Config.JOB_STATE_COMPRESS_MIN:
+        return raw.decode()
+    return COMPRESSED_PREFIX + base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+
+JOB_STATE_CODECS = {"json": _encode_json_value, "zlib": _encode_zlib_value}
+
+def encode_job_value(value: Any) -> str:
+    """Encode a job result/queue chunk for Redis with JOB_STATE_CODEC"""
+    return JOB_STATE_CODECS.get(Config.JOB_STATE_CODEC, _encode_json_value)(value)
+
+def decode_job_value(raw: str) -> Any:
+    """Decode a value written by any of the job-state codecs"""
+    if raw.startswith(COMPRESSED_PREFIX):
+        return json_loads(zlib.decompress(base64.b64decode(raw[len(COMPRESSED_PREFIX):])))
+    return json_loads(raw)
+
+# --- Pools de Conexão HTTP (Keep-Alive) ---
+# Um `httpx.AsyncClient` por upstream, aberto uma única vez no lifespan do app.
+# Antes, cada lote de envio e cada chamada de chat/detecção abria um cliente
+# novo, pagando um handshake TLS completo com graph.facebook.com/openrouter.ai.
+OPENROUTER_POOL = "openrouter"
+GRAPH_POOL = "graph"
+
+http_clients: Dict[str, httpx.AsyncClient] = {}
+http_pool_requests: Dict[str, int] = {OPENROUTER_POOL: 0, GRAPH_POOL: 0}
+
+def _make_request_counter(pool_name: str):
+    async def count_request(request: httpx.Request) -> None:
+        http_pool_requests[pool_name] = http_pool_requests.get(pool_name, 0) + 1
+    return count_request
+
+def open_http_clients() -> None:
+    """Create the shared upstream clients (idempotent)"""
+    http2 = Config.HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401 (dependência opcional do httpx para HTTP/2)
+        except ImportError:
+            logging.warning("HTTP2_ENABLED=true, mas o pacote `h2` não está instalado. Usando HTTP/1.1.")
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=Config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=Config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY,
+    )
+    for pool_name in (OPENROUTER_POOL, GRAPH_POOL):
+        client = http_clients.get(pool_name)
+        if client is None or client.is_closed:
+            http_clients[pool_name] = httpx.AsyncClient(
+                limits=limits,
+                http2=http2,
+                timeout=30.0,
+                event_hooks={"request": [_make_request_counter(pool_name)]},
+            )
+
+async def close_http_clients() -> None:
+    """Close the shared upstream clients"""
+    clients = list(http_clients.values())
+    http_clients.clear()
+    for client in clients:
+        await client.aclose()
+
+def get_http_client(pool_name: str) -> httpx.AsyncClient:
+    """Return the shared client for an upstream, opening the pools if needed"""
+    client = http_clients.get(pool_name)
+    if client is None or client.is_closed:
+        # Fora do lifespan (ex: scripts) os pools são abertos sob demanda
+        open_http_clients()
+        client = http_clients[pool_name]
+    return client
+
+def http_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Connection usage of each upstream pool (for /api/health)"""
+    stats = {}
+    for pool_name, client in http_clients.items():
+        # O httpx não expõe o pool publicamente; lemos o pool do httpcore com cautela
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+        idle = sum(1 for conn in connections if conn.is_idle())
+        stats[pool_name] = {
+            "connections": len(connections),
+            "active": len(connections) - idle,
+            "idle": idle,
+            "max_connections": Config.HTTP_MAX_CONNECTIONS,
+            "max_keepalive_connections": Config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            "requests": http_pool_requests.get(pool_name, 0),
+            "closed": client.is_closed,
+        }
+    return stats
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    open_http_clients()
+    logging.info("Pools de conexão HTTP (OpenRouter, Graph API) abertos.")
+    try:
+        yield
+    finally:
+        await close_http_clients()
+        logging.info("Pools de conexão HTTP fechados.")
+        for client in (redis_client, redis_blocking_client):
+            if client:
+                await client.aclose()
 
 # Initialize FastAPI app
-app = FastAPI(title="WhatsApp Bulk Manager API", version="1.2.0") # Versão atualizada
+# Respostas com orjson por padrão (JSONResponse da stdlib se o orjson não estiver instalado)
+app = FastAPI(title="WhatsApp Bulk Manager API", version="1.2.0", lifespan=lifespan, default_response_class=DefaultJSONResponse) # Versão atualizada
 
 # CORS middleware
 app.add_middleware(
@@ -118,17 +582,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Latency and status of every request, labeled by route template"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Template da rota ("/api/job-status/{job_id}"), nunca o caminho real (cardinalidade/LGPD)
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        HTTP_LATENCY.observe(time.perf_counter() - started, route=route, method=request.method)
+        HTTP_REQUESTS.inc(route=route, method=request.method, status=status)
+        if status >= 500:
+            HTTP_ERRORS.inc(route=route, method=request.method)
+
 # Redis client for rate limiting
+# Cliente ASSÍNCRONO (redis.asyncio) com um pool compartilhado: nenhuma chamada
+# ao Redis bloqueia o event loop, e os timeouts de socket garantem que um Redis
+# lento não congele os chats e envios em andamento.
 redis_client = None
 if Config.REDIS_URL:
     try:
-        redis_client = redis.from_url(Config.REDIS_URL, decode_responses=True)
+        redis_client = InstrumentedRedis.from_url(
+            Config.REDIS_URL,
+            decode_responses=True,
+            max_connections=Config.REDIS_MAX_CONNECTIONS,
+            socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=Config.REDIS_CONNECT_TIMEOUT,
+            health_check_interval=30,
+        )
     except Exception as e:
         print(f"Redis connection failed: {e}")
         # --- LGPD (Monitoramento / Resposta a Incidentes) ---
         logging.critical(f"Falha CRÍTICA ao conectar ao Redis: {e}. O rastreamento de jobs não funcionará.")
         # --------------------------------------------------
 
+# Cliente separado para comandos bloqueantes (XREADGROUP/XREAD com BLOCK): o
+# socket_timeout curto do pool principal cortaria a espera no meio.
+redis_blocking_client = None
+if redis_client:
+    redis_blocking_client = InstrumentedRedis.from_url(
+        Config.REDIS_URL,
+        decode_responses=True,
+        max_connections=Config.REDIS_MAX_CONNECTIONS,
+        socket_timeout=Config.REDIS_BLOCKING_SOCKET_TIMEOUT,
+        socket_connect_timeout=Config.REDIS_CONNECT_TIMEOUT,
+        health_check_interval=30,
+    )
+
 # --- Modelos de Requisição (com Validação de Segurança) ---
 # COMENTÁRIO DE SEGURANÇA (Anti-Hacking: Validação de Entrada)
 # Usamos Pydantic para validar estritamente o formato de TODAS as
@@ -150,6 +654,14 @@ class WhatsAppSendRequest(BaseModel):
     contacts: List[Dict[str, Any]]
     message: str
     credentials: WhatsAppCredentials # Usa o modelo validado
+    dedupe: bool = Config.WHATSAPP_DEDUPE # Um envio por telefone (irmãos com o mesmo responsável)
+    merge_names: bool = True # Com dedupe: {name} vira "Ana, Pedro e João"
+    force_resend: bool = False # True: ignora o registro de envios (reenvia a quem já recebeu)
+
+class JobResumeRequest(WhatsAppSendRequest):
+    # A mesma lista do envio original (conferida pela impressão digital do job)
+    retry_failed: bool = False # True: reenvia também os contatos que falharam
+    retry_unknown: bool = False # True: reenvia também os de entrega incerta (podem receber em dobro)
 
 class ChatMessage(BaseModel):
     role: str
@@ -158,44 +670,125 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     message: str
     history: List[ChatMessage]
-    contact_data_sample: Optional[str] = None # JSON stringified contact data sample
+    # Amostra dos contatos: objeto JSON (ou, em clientes antigos, o mesmo objeto como string)
+    contact_data_sample: Optional[Union[Dict[str, Any], str]] = None
+    session_id: Optional[str] = None # Sessão criada em /api/contact-session (lista inteira)
+    stream: bool = False # True: resposta em Server-Sent Events (token a token)
+
+class SessionContact(BaseModel):
+    # Apenas os campos usados na busca (Minimização: nenhum telefone)
+    id: int
+    aluno: str = ""
+    responsavel: str = ""
+    turma: str = ""
+    status: str = ""
+
+class ContactSessionRequest(BaseModel):
+    contacts: List[SessionContact]
+
+class PhoneNormalizeRequest(BaseModel):
+    # Strict: sem isso o pydantic converte o float do Excel em "5511987654321.0"
+    phones: List[Optional[Union[StrictStr, StrictInt, StrictFloat]]]
+    default_country: str = Field(Config.PHONE_DEFAULT_COUNTRY, regex=r"^[1-9]\d{0,2}$") # DDI sem "+"
 
 class HealthResponse(BaseModel):
     status: str
     timestamp: datetime
     services: Dict[str, str]
+    pools: Dict[str, Dict[str, Any]] = {}
+    caches: Dict[str, Dict[str, Any]] = {}
 
 # --- Fim dos Modelos ---
 
-# Rate limiting decorator
-async def check_rate_limit(client_ip: str) -> bool:
-    """Check if client has exceeded rate limit"""
-    if not redis_client:
+# --- Rate Limit (GCRA atômico no Redis + token bucket local) ---
+# Uma única ida ao Redis por requisição: o script Lua lê e grava o "TAT"
+# (theoretical arrival time) do par (rota, IP) atomicamente, sempre com TTL.
+# Na frente dele, um token bucket por processo (LRU limitado) recusa rajadas
+# sem tocar no Redis e continua aplicando o limite quando o Redis cai.
+RATE_LIMIT_GCRA_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + interval
+if new_tat - now > window then
+    return {0, new_tat - window - now}
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', math.max(1, math.ceil(new_tat - now)))
+return {1, 0}
+"""
+
+rate_limit_buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+rate_limit_script = redis_client.register_script(RATE_LIMIT_GCRA_SCRIPT) if redis_client else None
+
+def rate_limit_rule(route: str) -> Tuple[int, float]:
+    """(requests, window seconds) allowed for a route"""
+    rule = Config.RATE_LIMIT_ROUTES.get(route, {})
+    return int(rule.get("requests", Config.RATE_LIMIT_REQUESTS)), float(rule.get("window", Config.RATE_LIMIT_WINDOW))
+
+def _local_rate_limit_bucket(route: str, client_ip: str) -> "TokenBucket":
+    key = (route, client_ip)
+    bucket = rate_limit_buckets.get(key)
+    if bucket is None:
+        requests, window = rate_limit_rule(route)
+        bucket = rate_limit_buckets[key] = TokenBucket(rate=requests / window, burst=requests)
+        if len(rate_limit_buckets) > Config.RATE_LIMIT_LOCAL_MAX_KEYS:
+            rate_limit_buckets.popitem(last=False)
+    else:
+        rate_limit_buckets.move_to_end(key)
+    return bucket
+
+def _reject_rate_limit(client_ip: str, route: str, tier: str) -> bool:
+    RATE_LIMIT_REJECTIONS.inc(route=route, tier=tier)
+    # --- LGPD (Monitoramento) ---
+    # Registra um evento de segurança crítico.
+    logging.warning(f"RATE LIMIT EXCEDIDO (Medida Anti-Hacking/DDOS) pelo IP: {client_ip} (rota: {route})")
+    # ------------------------------
+    return False
+
+async def check_rate_limit(client_ip: str, route: str = "default") -> bool:
+    """Check if client has exceeded the rate limit of a route"""
+    requests, window = rate_limit_rule(route)
+    # "requests": 0 (ou negativo) bloqueia a rota inteira, nunca a libera
+    if requests <= 0 or window <= 0:
+        return _reject_rate_limit(client_ip, route, "local")
+
+    # 1. Tier local: rajadas acima do limite nem chegam ao Redis
+    if not _local_rate_limit_bucket(route, client_ip).try_acquire():
+        return _reject_rate_limit(client_ip, route, "local")
+
+    if not rate_limit_script:
         return True
-    
-    key = f"rate_limit:{client_ip}"
+
     try:
-        # Permite 100 requisições por hora
-        current = redis_client.incr(key)
-        if current == 1:
-            redis_client.expire(key, Config.RATE_LIMIT_WINDOW)
-        
-        is_limited = current > Config.RATE_LIMIT_REQUESTS
-        
-        if is_limited:
-            # --- LGPD (Monitoramento) ---
-            # Registra um evento de segurança crítico.
-            logging.warning(f"RATE LIMIT EXCEDIDO (Medida Anti-Hacking/DDOS) pelo IP: {client_ip}")
-            # ------------------------------
-        
-        return not is_limited
+        # 2. Tier global (todos os processos): GCRA em um único EVALSHA
+        allowed, _ = await rate_limit_script(
+            keys=[f"rate_limit:{route}:{client_ip}"],
+            args=[window * 1000 / requests, window * 1000],
+        )
     except Exception as e:
         # --- LGPD (Monitoramento) ---
-        logging.error(f"Erro no Redis (Rate Limit): {e}. Permitindo passagem (fail-open).")
+        logging.error(f"Erro no Redis (Rate Limit): {e}. Aplicando só o limite local deste processo.")
         # ------------------------------
-        # Em caso de erro do Redis, continua sem limitação (fail-open)
+        # O tier local já aprovou: o limite continua valendo, por processo
         return True
 
+    if not allowed:
+        return _reject_rate_limit(client_ip, route, "redis")
+    return True
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    """Prometheus scrape endpoint"""
+    if Config.METRICS_TOKEN and not secrets.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {Config.METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=401, detail="Token de métricas inválido")
+    await refresh_metrics()
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Health check endpoint
 @app.get("/api/health", response_model=HealthResponse)
 async def health_check():
@@ -208,33 +801,190 @@ async def health_check():
     
     if redis_client:
         try:
-            redis_client.ping()
+            await redis_client.ping()
         except Exception:
             services_status["redis"] = "unhealthy"
     
     return HealthResponse(
         status="healthy",
         timestamp=datetime.utcnow(),
-        services=services_status
+        services=services_status,
+        pools=http_pool_stats(),
+        caches={"detect_columns": column_cache_summary()}
     )
 
 
 # --- ATUALIZAÇÃO: Nova Lógica de Normalização de Texto ---
+# Motor rápido: a mesma dobra (minúsculas, NFD, sem acentos, sem símbolos) mas
+# sem regex: os símbolos são removidos com uma tabela pré-compilada de
+# `bytes.translate`, valores repetidos vêm de um cache LRU e `normalize_texts`
+# normaliza uma coluna inteira numa única passada em C.
+NORMALIZE_STRIP_SYMBOLS = b".,()/-"  # "º" e "ª" não são ASCII: já caem no encode
+NORMALIZE_CACHE_MAX_LEN = 64  # textos maiores (ex: linha concatenada) não entram no cache
+NORMALIZE_BATCH_SEPARATOR = "\x00"  # sobrevive intacto ao NFD e ao encode ASCII
+
+def _fold_text(text: str) -> str:
+    # NFD: Decompõe caracteres (ex: 'ç' -> 'c' + '̧')
+    # encode('ascii', 'ignore'): Remove caracteres não-ascii (acentos decompostos)
+    # translate(None, ...): Remove símbolos comuns
+    return (
+        unicodedata.normalize("NFD", text.lower())
+        .encode("ascii", "ignore")
+        .translate(None, NORMALIZE_STRIP_SYMBOLS)
+        .decode("ascii")
+    )
+
+@lru_cache(maxsize=Config.NORMALIZE_CACHE_SIZE)
+def _fold_text_cached(text: str) -> str:
+    # Valores repetidos (turmas, status, cabeçalhos) saem direto do cache LRU
+    return _fold_text(text).strip()
+
 def normalize_text(text: Optional[str]) -> str:
     if not text:
         return ""
     try:
-        # NFD: Decompõe caracteres (ex: 'ç' -> 'c' + '̧')
-        text = unicodedata.normalize("NFD", text.lower())
-        # a.encode('ascii', 'ignore'): Remove caracteres não-ascii (acentos decompostos)
-        # b.decode('utf-8'): Converte de volta para string
-        text = text.encode("ascii", "ignore").decode("utf-8")
-        # Remove símbolos comuns
-        text = re.sub(r"[ºª.,()/-]", "", text)
-        return text.strip()
+        if len(text) > NORMALIZE_CACHE_MAX_LEN:
+            return _fold_text(text).strip()
+        return _fold_text_cached(text)
     except Exception:
         return "" # Retorna vazio em caso de falha
 
+def normalize_texts(values: List[Any]) -> List[str]:
+    """Normalize a whole column in one call (same output as normalize_text)"""
+    # Valores vazios/não-texto seguem a regra de `normalize_text` (-> "")
+    texts = [value if isinstance(value, str) else "" for value in values]
+    if not texts:
+        return []
+    unique = list(dict.fromkeys(texts))  # cada valor distinto é dobrado uma vez
+    joined = NORMALIZE_BATCH_SEPARATOR.join(unique)
+    if joined.count(NORMALIZE_BATCH_SEPARATOR) != len(unique) - 1:
+        # Algum valor já contém o separador: normaliza um a um
+        return [normalize_text(text) for text in texts]
+    folded = _fold_text(joined).split(NORMALIZE_BATCH_SEPARATOR)
+    lookup = {text: value.strip() for text, value in zip(unique, folded)}
+    return [lookup[text] for text in texts]
+
+# --- Motor de Normalização de Telefones (E.164, em lote) ---
+# A limpeza era feita contato a contato em vários lugares (`.replace("+", "")`,
+# `isdigit()`, checagem de tamanho). Aqui a coluna inteira é limpa numa única
+# passada: os valores distintos são unidos com um separador, os caracteres que
+# não são dígitos/"+" saem com um `bytes.translate` (em C) e só então cada
+# valor distinto é classificado (DDI, DDD, 9º dígito). Telefones repetidos
+# (irmãos com o mesmo responsável) são classificados uma vez só.
+DEFAULT_PHONE_COUNTRY = Config.PHONE_DEFAULT_COUNTRY
+PHONE_BATCH_SEPARATOR = "\x00"
+_PHONE_DELETE_BYTES = bytes(b for b in range(256) if b not in b"0123456789+\x00")
+_INVALID_PHONE = {"e164": "", "status": "invalid", "kind": ""}
+
+
+def _phone_text(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if value != value: # NaN de células vazias (pandas)
+            return ""
+        # O Excel guarda telefones como float (5511987654321.0)
+        value = int(value) if value.is_integer() else value
+    return str(value)
+
+
+def _brazilian_phone(national: str) -> Dict[str, str]:
+    # DDD (2 dígitos, sem zero) + 8 ou 9 dígitos
+    if len(national) not in (10, 11) or national[0] == "0" or national[1] == "0":
+        return _INVALID_PHONE
+    ddd, number = national[:2], national[2:]
+    if len(number) == 9:
+        if number[0] != "9":
+            return _INVALID_PHONE
+        kind = "mobile"
+    elif number[0] in "6789":
+        # Celular antigo de 8 dígitos: recebe o 9º dígito
+        number, kind = "9" + number, "mobile"
+    elif number[0] in "2345":
+        kind = "landline" # Fixo: mantido como está
+    else:
+        return _INVALID_PHONE
+    return {"e164": f"+55{ddd}{number}", "status": "valid", "kind": kind}
+
+
+def _foreign_phone(digits: str) -> Dict[str, str]:
+    if digits.startswith("1"):
+        # NANP (EUA/Canadá): 1 + 10 dígitos, código de área não começa com 0/1
+        valid = len(digits) == 11 and digits[1] not in "01"
+    else:
+        valid = 8 <= len(digits) <= 15 and digits[0] != "0"
+    if not valid:
+        return _INVALID_PHONE
+    return {"e164": f"+{digits}", "status": "valid", "kind": "international"}
+
+
+def _classify_phone(cleaned: str, default_country: str) -> Dict[str, str]:
+    international = cleaned.startswith("+")
+    digits = cleaned.replace("+", "")
+    if not digits:
+        return _INVALID_PHONE
+    if not international and digits.startswith("00"):
+        digits, international = digits[2:], True # Prefixo internacional de discagem
+
+    if international:
+        return _brazilian_phone(digits[2:]) if digits.startswith("55") else _foreign_phone(digits)
+
+    if digits.startswith("0"):
+        # Discagem de longa distância: 0 + operadora (2 dígitos) + DDD + número
+        digits = digits[1:]
+        if len(digits) in (12, 13) and not digits.startswith("55"):
+            digits = digits[2:]
+
+    if default_country == "55":
+        if len(digits) in (12, 13) and digits.startswith("55"):
+            digits = digits[2:] # DDI sem "+": "55 61 9...."
+        return _brazilian_phone(digits)
+    return _foreign_phone(default_country + digits)
+
+
+def normalize_phones(values: List[Any], default_country: str = DEFAULT_PHONE_COUNTRY) -> List[Dict[str, str]]:
+    """Normalize a whole phone column to E.164 ({"e164", "status", "kind"} per row)"""
+    texts = [_phone_text(value) for value in values]
+    if not texts:
+        return []
+    unique = list(dict.fromkeys(texts))
+    joined = PHONE_BATCH_SEPARATOR.join(unique)
+    if joined.count(PHONE_BATCH_SEPARATOR) != len(unique) - 1:
+        # Algum valor já contém o separador: limpa um a um
+        cleaned = [text.encode("ascii", "ignore").translate(None, _PHONE_DELETE_BYTES + b"\x00").decode("ascii") for text in unique]
+    else:
+        cleaned = joined.encode("ascii", "ignore").translate(None, _PHONE_DELETE_BYTES).decode("ascii").split(PHONE_BATCH_SEPARATOR)
+    lookup = {text: _classify_phone(digits, default_country) for text, digits in zip(unique, cleaned)}
+    # As linhas compartilham o dict do valor distinto: trate como somente leitura
+    return [lookup[text] for text in texts]
+
+
+def normalize_phone(value: Any, default_country: str = DEFAULT_PHONE_COUNTRY) -> Dict[str, str]:
+    """Normalize a single phone number (see normalize_phones)"""
+    return dict(normalize_phones([value], default_country)[0])
+
+
+@app.post("/api/phones/normalize")
+async def normalize_phones_endpoint(request: PhoneNormalizeRequest, client_request: Request):
+    """Bulk-normalize a phone column to E.164"""
+    client_ip = client_request.client.host
+
+    if not await check_rate_limit(client_ip, route="phones"):
+        raise HTTPException(status_code=429, detail="Limite de taxa excedido. Tente novamente mais tarde.")
+    if len(request.phones) > Config.PHONE_NORMALIZE_MAX:
+        raise HTTPException(status_code=413, detail=f"Lista grande demais (máximo de {Config.PHONE_NORMALIZE_MAX} telefones).")
+
+    # --- LGPD (Minimização de Dados) ---
+    # Os números são apenas transformados e devolvidos: nada é gravado nem logado.
+    # -------------------------------------
+    results = await asyncio.to_thread(normalize_phones, request.phones, request.default_country)
+    valid = sum(1 for result in results if result["status"] == "valid")
+    return {
+        "results": results,
+        "valid": valid,
+        "invalid": len(results) - valid
+    }
+
 # --- ATUALIZAÇÃO: Novo Prompt de Sistema para Busca Paginada ---
 SYSTEM_INSTRUCTION = """
 Você é o "Ajudante Geral a AI que pensa por você", um assistente de IA focado em ajudar o usuário a gerenciar listas de contatos.
@@ -280,6 +1030,90 @@ OPÇÃO 4: O usuário pediu algo perigoso ou fora do escopo (hacking, engenharia
 """
 
 # --- ATUALIZAÇÃO: Nova Função de Lógica Interna da AI ---
+# Palavras-chave para deleção
+DELETE_KEYWORDS = ["remover", "apagar", "deletar", "excluir"]
+# Palavras-chave para "todos exceto"
+EXCEPT_KEYWORDS = ["exceto", "menos", "deixando", "manter apenas"]
+# ATUALIZAÇÃO: Adiciona "aluno" e "responsavel" à lista de remoção
+# para que "aluno felipe" seja tratado como "felipe" (idem "turma 3a" -> "3a",
+# já que a coluna turma costuma conter só o código da turma)
+CONTEXT_KEYWORDS = ["aluno", "aluna", "responsavel", "turma", "do", "da", "o", "a"]
+COMMAND_STOP_WORDS = set(
+    DELETE_KEYWORDS + CONTEXT_KEYWORDS + ["todos", "os", "contatos"]
+    + [kw for kw in EXCEPT_KEYWORDS if " " not in kw]
+)
+
+def parse_delete_command(query: str) -> Optional[Dict[str, Any]]:
+    """Parse a delete / "all except" chat command; None if it is normal chat"""
+    norm_query = normalize_text(query)
+
+    is_delete_query = any(keyword in norm_query for keyword in DELETE_KEYWORDS)
+    is_except_query = any(keyword in norm_query for keyword in EXCEPT_KEYWORDS)
+
+    if not is_delete_query:
+        return None
+
+    # Remove as palavras-chave de deleção e exceção para encontrar o "alvo".
+    # A remoção é feita por PALAVRA inteira: substituir "a " dentro do texto
+    # transformava "turma 3a" em "turm3a" e nenhum contato era encontrado.
+    search_query = norm_query
+    for phrase in (kw for kw in EXCEPT_KEYWORDS if " " in kw):
+        search_query = search_query.replace(phrase, " ") # Ex: "manter apenas"
+    search_query = " ".join(word for word in search_query.split() if word not in COMMAND_STOP_WORDS) # Ex: "paulo sergio 3 ds" ou "turma 3a" ou "invalidos" ou "felipe vinicius"
+
+    return {
+        "is_except": is_except_query,
+        "search_query": search_query,
+        # Separa o alvo em palavras-chave
+        "keywords": [k for k in search_query.split() if len(k) > 1], # ignora "e", "o"
+    }
+
+def format_delete_result(command: Dict[str, Any], found_ids: List[Any], found_names: List[str], scope: str = "neste lote") -> str:
+    """Turn the matched contacts into the reply (with [SEARCH_*] tags)"""
+    search_query = command["search_query"]
+
+    if command["is_except"]:
+        # --- OPÇÃO 2: "Todos Exceto X" ---
+        if len(found_ids) == 0:
+            # Não encontrou a exceção neste lote
+            return "[SEARCH_PAGE_FAIL]"
+        elif len(found_ids) == 1:
+            # Encontrou a exceção!
+            keep_id = found_ids[0]
+            contact_nome = found_names[0] or f"ID {keep_id}"
+            return f"Busca encerrada. Encontrei o contato para manter: '{contact_nome}' (ID {keep_id}). [SEARCH_FOUND_KEEP_ID: {keep_id}]"
+        else:
+            # Ambiguidade
+            return f"Sua busca por '{search_query}' (para *manter*) é ambígua, pois encontrei {len(found_ids)} contatos {scope}. Por favor, seja mais específico."
+
+    # --- OPÇÃO 3: "Remover Específicos" ---
+    if len(found_ids) == 0:
+        # Não encontrou alvos neste lote
+        return "[SEARCH_PAGE_FAIL]"
+    # Encontrou alvos para deletar neste lote
+    delete_list_str = ",".join(map(str, found_ids))
+    return f"Encontrei {len(found_ids)} contato(s) correspondente(s) a '{search_query}' {scope}. [SEARCH_FOUND_DELETE_IDS: {delete_list_str}]"
+
+def match_contacts(contact_sample: List[Dict[str, Any]], keywords: List[str]) -> Tuple[List[Any], List[str]]:
+    """Evaluate the keyword conjunction over a whole sample; returns (ids, names)"""
+    # Amostra avulsa (sem sessão): uma varredura filtrando candidatos sai mais
+    # barata que montar o índice invertido da ContactIndex, que só compensa
+    # quando a mesma lista recebe vários comandos (~12 ms contra ~35 ms em
+    # 10k contatos). O texto de busca é o mesmo do índice.
+    # ATENÇÃO: É aqui que a busca é feita em todos os campos.
+    searchable_texts = ContactIndex.searchable_texts(contact_sample)
+
+    candidates = range(len(searchable_texts))
+    for keyword in keywords:
+        # Lógica de correspondência: todas as palavras-chave devem estar no texto
+        candidates = [i for i in candidates if keyword in searchable_texts[i]]
+        if not candidates:
+            break
+
+    found_ids = [contact_sample[i].get("id") for i in candidates]
+    found_names = [ContactIndex.display_name(contact_sample[i]) for i in candidates]
+    return found_ids, found_names
+
 # Esta função simula a lógica que a IA deve executar, tornando-a mais robusta
 # do que apenas confiar no prompt.
 def process_ai_logic(query: str, sample_data: Dict[str, Any]) -> str:
@@ -292,92 +1126,615 @@ def process_ai_logic(query: str, sample_data: Dict[str, Any]) -> str:
         logging.error(f"Falha ao decodificar contact_data_sample: {e}")
         return "[SEARCH_PAGE_FAIL]" # Falha segura
 
-    
-    norm_query = normalize_text(query)
-    
-    # Palavras-chave para deleção
-    delete_keywords = ["remover", "apagar", "deletar", "excluir"]
-    # Palavras-chave para "todos exceto"
-    except_keywords = ["exceto", "menos", "deixando", "manter apenas"]
+    command = parse_delete_command(query)
 
-    is_delete_query = any(keyword in norm_query for keyword in delete_keywords)
-    is_except_query = any(keyword in norm_query for keyword in except_keywords)
-
-    if not is_delete_query:
+    if command is None:
         # Não é um comando de deleção, deixa a IA responder normalmente (Opção 1)
         # Retornamos None para que a função principal `handle_chat_query`
         # saiba que deve prosseguir com a chamada real à LLM.
         return None 
 
     # --- É um comando de deleção ---
-    
-    # ATUALIZAÇÃO: Adiciona "aluno" e "responsavel" à lista de remoção
-    # para que "aluno felipe" seja tratado como "felipe"
-    context_keywords = ["aluno", "aluna", "responsavel", "do", "da", "o", "a"]
-    
-    # Remove as palavras-chave de deleção e exceção para encontrar o "alvo"
-    search_query = norm_query
-    for kw in delete_keywords + except_keywords + context_keywords + ["todos", "os", "contatos"]:
-        search_query = search_query.replace(f" {kw} ", " ") # Remove com espaços
-        search_query = search_query.replace(f"{kw} ", "") # Remove no início
-        search_query = search_query.replace(f" {kw}", "") # Remove no fim
-    
-    search_query = search_query.strip() # Ex: "paulo sergio 3 ds" ou "turma 3a" ou "invalidos" ou "felipe vinicius"
-
-    # Separa o alvo em palavras-chave
-    search_keywords = [k for k in search_query.split() if len(k) > 1] # ignora "e", "o"
+    search_keywords = command["keywords"]
 
     if not search_keywords:
          # Pedido de deleção vago, ex: "apagar"
          return "Por favor, especifique *quais* contatos você deseja apagar (ex: 'apagar turma 3A', 'remover inválidos')."
 
     # --- Inicia a busca na amostra ---
-    
-    found_contacts = [] # Lista de IDs (inteiros)
-
-    for contact in contact_sample:
-        # Constrói um "texto de busca" para cada contato
-        # ATENÇÃO: É aqui que a busca é feita em todos os campos.
-        searchable_text = normalize_text(
-            f"{contact.get('aluno', '')} {contact.get('responsavel', '')} {contact.get('turma', '')} {contact.get('status', '')}"
-        )
-        
-        # Lógica de correspondência: todas as palavras-chave devem estar no texto
-        if all(keyword in searchable_text for keyword in search_keywords):
-            found_contacts.append(contact.get("id"))
+    found_contacts, found_names = match_contacts(contact_sample, search_keywords)
 
     # --- Analisa os resultados da busca ---
-    
-    if is_except_query:
-        # --- OPÇÃO 2: "Todos Exceto X" ---
-        if len(found_contacts) == 0:
-            # Não encontrou a exceção neste lote
-            return "[SEARCH_PAGE_FAIL]"
-        elif len(found_contacts) == 1:
-            # Encontrou a exceção!
-            keep_id = found_contacts[0]
-            # Encontra o nome do contato para a mensagem
-            contact_nome = "contato"
-            for c in contact_sample:
-                if c.get("id") == keep_id:
-                    contact_nome = c.get('aluno') or c.get('responsavel') or f"ID {keep_id}"
-                    break
-            
-            return f"Busca encerrada. Encontrei o contato para manter: '{contact_nome}' (ID {keep_id}). [SEARCH_FOUND_KEEP_ID: {keep_id}]"
-        
-        else:
-            # Ambiguidade
-            return f"Sua busca por '{search_query}' (para *manter*) é ambígua, pois encontrei {len(found_contacts)} contatos neste lote. Por favor, seja mais específico."
+    return format_delete_result(command, found_contacts, found_names)
+
+
+# --- Sessão de Contatos com Índice Invertido ---
+# O frontend envia a lista (já normalizada e mapeada) UMA vez e recebe um
+# `session_id`. Cada comando do chat ("apagar turma 3A", "todos exceto X") é
+# então resolvido sobre a lista inteira com uma busca no índice, em vez de
+# dezenas de chamadas HTTP+LLM paginadas de 200 em 200.
+#
+# --- LGPD (Minimização e Retenção de Dados) ---
+# Guardamos apenas id/aluno/responsavel/turma/status (nenhum telefone), com
+# expiração curta (CONTACT_SESSION_TTL) e exclusão imediata via DELETE.
+# -------------------------------------------------
+class ContactIndex:
+    """Inverted token index over the aluno/responsavel/turma/status fields"""
+
+    INDEXED_FIELDS = ("aluno", "responsavel", "turma", "status")
+
+    def __init__(self):
+        self.ids: List[Any] = []
+        self.names: List[str] = []
+        self.postings: Dict[str, set] = {}  # token normalizado -> posições
+        self._keyword_cache: Dict[str, set] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def searchable_texts(cls, contacts: List[Dict[str, Any]]) -> List[str]:
+        """Normalized search text of each contact (one batch normalization)"""
+        return normalize_texts([
+            " ".join(str(contact.get(field, "")) for field in cls.INDEXED_FIELDS)
+            for contact in contacts
+        ])
+
+    @staticmethod
+    def display_name(contact: Dict[str, Any]) -> str:
+        return contact.get("aluno") or contact.get("responsavel") or ""
+
+    def add_contacts(self, contacts: List[Dict[str, Any]]) -> None:
+        searchable_texts = self.searchable_texts(contacts)
+        for contact, searchable_text in zip(contacts, searchable_texts):
+            position = len(self.ids)
+            self.ids.append(contact.get("id"))
+            self.names.append(self.display_name(contact))
+            for token in set(searchable_text.split()):
+                self.postings.setdefault(token, set()).add(position)
+        self._keyword_cache.clear()
+
+    def _positions(self, keyword: str) -> set:
+        # Mesma semântica de `keyword in searchable_text`: as palavras-chave não
+        # têm espaços, então casam como substring de algum token do contato.
+        positions = self._keyword_cache.get(keyword)
+        if positions is None:
+            positions = set()
+            for token, token_positions in self.postings.items():
+                if keyword in token:
+                    positions |= token_positions
+            self._keyword_cache[keyword] = positions
+        return positions
+
+    def search(self, keywords: List[str]) -> List[int]:
+        """Positions of the contacts matching ALL keywords, in list order"""
+        if not keywords:
+            return []
+        candidate_sets = sorted((self._positions(k) for k in keywords), key=len)
+        matches = set(candidate_sets[0])
+        for positions in candidate_sets[1:]:
+            matches &= positions
+            if not matches:
+                break
+        return sorted(matches)
+
+
+def process_session_logic(query: str, index: ContactIndex) -> Optional[str]:
+    """Resolve a delete command against a whole contact session"""
+    command = parse_delete_command(query)
+    if command is None:
+        return None # Chat normal: segue para a LLM
+    if not command["keywords"]:
+        return "Por favor, especifique *quais* contatos você deseja apagar (ex: 'apagar turma 3A', 'remover inválidos')."
+
+    positions = index.search(command["keywords"])
+    found_ids = [index.ids[p] for p in positions]
+    found_names = [index.names[p] for p in positions]
+    return format_delete_result(command, found_ids, found_names, scope="na lista completa")
+
+
+def contact_session_key(session_id: str) -> str:
+    return f"contact_session:{session_id}"
+
+# Cache LRU por processo dos índices já construídos (session_id -> (índice, expira_em))
+contact_sessions: "OrderedDict[str, tuple]" = OrderedDict()
+
+def _cache_contact_session(session_id: str, index: ContactIndex) -> None:
+    contact_sessions[session_id] = (index, time.monotonic() + Config.CONTACT_SESSION_TTL)
+    contact_sessions.move_to_end(session_id)
+    while len(contact_sessions) > Config.CONTACT_SESSION_CACHE_SIZE:
+        contact_sessions.popitem(last=False)
+
+async def get_contact_session(session_id: str) -> Optional[ContactIndex]:
+    """Return the session index from memory, rebuilding it from Redis on a miss"""
+    cached = contact_sessions.get(session_id)
+    if cached and cached[1] > time.monotonic():
+        contact_sessions.move_to_end(session_id)
+        return cached[0]
+    contact_sessions.pop(session_id, None)
+
+    if not redis_client:
+        return None
+    # Outro worker criou a sessão (ou o cache local expirou): reconstrói o índice
+    raw_contacts = await redis_client.lrange(contact_session_key(session_id), 0, -1)
+    if not raw_contacts:
+        return None
+    index = ContactIndex()
+    index.add_contacts([json_loads(c) for c in raw_contacts])
+    _cache_contact_session(session_id, index)
+    return index
+
+
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+@app.post("/api/contact-session")
+async def create_contact_session(request: ContactSessionRequest, client_request: Request):
+    """Upload the contact list once and index it for whole-list chat commands"""
+    client_ip = client_request.client.host
+
+    if not await check_rate_limit(client_ip, route="session"):
+        raise HTTPException(status_code=429, detail="Limite de taxa excedido. Tente novamente mais tarde.")
+
+    if not request.contacts:
+        raise HTTPException(status_code=400, detail="Nenhum contato fornecido")
+    if len(request.contacts) > Config.CONTACT_SESSION_MAX_CONTACTS:
+        raise HTTPException(status_code=413, detail=f"Lista grande demais (máximo de {Config.CONTACT_SESSION_MAX_CONTACTS} contatos).")
 
+    session_id = secrets.token_urlsafe(16)
+    contacts = [contact.dict() for contact in request.contacts]
+
+    index = ContactIndex()
+    index.add_contacts(contacts)
+
+    if redis_client:
+        try:
+            key = contact_session_key(session_id)
+            async with redis_client.pipeline(transaction=True) as pipe:
+                for i in range(0, len(contacts), 1000):
+                    pipe.rpush(key, *(json_text(c) for c in contacts[i:i + 1000]))
+                pipe.expire(key, Config.CONTACT_SESSION_TTL)
+                await pipe.execute()
+        except Exception as e:
+            # A sessão continua válida neste processo (cache em memória)
+            logging.error(f"Falha ao gravar sessão de contatos no Redis: {e}")
+
+    _cache_contact_session(session_id, index)
+
+    # --- LGPD (Monitoramento) ---
+    logging.info(f"Sessão de contatos criada (IP: {client_ip}) com {len(contacts)} contatos.")
+    # ------------------------------
+
+    return {
+        "sessionId": session_id,
+        "totalContacts": len(contacts),
+        "expiresIn": Config.CONTACT_SESSION_TTL
+    }
+
+@app.delete("/api/contact-session/{session_id}")
+async def delete_contact_session(session_id: str):
+    """Delete a contact session immediately (LGPD: direito de exclusão)"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        raise HTTPException(status_code=400, detail="Session ID inválido")
+
+    contact_sessions.pop(session_id, None)
+    if redis_client:
+        try:
+            await redis_client.delete(contact_session_key(session_id))
+        except Exception as e:
+            logging.error(f"Falha ao apagar sessão de contatos no Redis: {e}")
+            raise HTTPException(status_code=500, detail="Falha ao apagar a sessão de contatos")
+
+    return {"deleted": True}
+
+
+# --- Ingestão de Planilhas no Servidor (Streaming) ---
+# O navegador fazia `XLSX.read` do arquivo inteiro e enviava todos os contatos
+# como JSON; com as exportações de 100k linhas isso travava a aba. Aqui o
+# arquivo é lido linha a linha (csv / openpyxl read_only) e gravado em lotes
+# de INGEST_CHUNK_SIZE numa sessão de contatos, sem materializar a planilha.
+#
+# --- LGPD (Minimização e Retenção de Dados) ---
+# Só as colunas mapeadas (aluno, responsavel, turma, telefone) são guardadas,
+# com o mesmo TTL curto e a mesma exclusão imediata das sessões de contatos.
+# -------------------------------------------------
+INGEST_CSV_EXTENSIONS = (".csv", ".txt")
+INGEST_XLSX_EXTENSIONS = (".xlsx", ".xlsm")
+INGEST_SNIFF_BYTES = 64 * 1024
+RESPONSAVEL_COLUMN_PATTERNS = ["responsavel", "nome resp", "mae", "pai"]
+TURMA_COLUMN_PATTERNS = ["turma", "classe", "serie", "sala", "class"]
+
+
+def _cell_text(value: Any) -> str:
+    # O Excel guarda telefones como float (5511999999999.0): volta para inteiro
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return "" if value is None else str(value).strip()
+
+
+def _open_csv_rows(raw_file):
+    sample = raw_file.read(INGEST_SNIFF_BYTES)
+    raw_file.seek(0)
+    try:
+        # final=False: um caractere cortado no fim da amostra não é erro
+        codecs.getincrementaldecoder("utf-8-sig")().decode(sample, final=False)
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1252" # Exportações antigas do Excel/Windows em pt-BR
+
+    text_sample = sample.decode(encoding, errors="ignore")
+    try:
+        dialect = csv.Sniffer().sniff(text_sample, delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel # Uma coluna só, ou amostra sem delimitador claro
+
+    text_file = io.TextIOWrapper(raw_file, encoding=encoding, errors="replace", newline="")
+    for row in csv.reader(text_file, dialect):
+        yield row
+
+
+def _open_xlsx_rows(raw_file):
+    # read_only: o openpyxl lê as células sob demanda, sem carregar a planilha
+    workbook = openpyxl.load_workbook(raw_file, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def iter_sheet_rows(raw_file, filename: str):
+    """Yield the rows of an uploaded CSV/XLSX one at a time, as lists of str"""
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in INGEST_CSV_EXTENSIONS:
+        rows = _open_csv_rows(raw_file)
+    elif extension in INGEST_XLSX_EXTENSIONS:
+        if openpyxl is None:
+            raise HTTPException(status_code=501, detail="Leitura de .xlsx indisponível no servidor (openpyxl não instalado).")
+        rows = _open_xlsx_rows(raw_file)
     else:
-        # --- OPÇÃO 3: "Remover Específicos" ---
-        if len(found_contacts) == 0:
-            # Não encontrou alvos neste lote
-            return "[SEARCH_PAGE_FAIL]"
-        else:
-            # Encontrou alvos para deletar neste lote
-            delete_list_str = ",".join(map(str, found_contacts))
-            return f"Encontrei {len(found_contacts)} contato(s) correspondente(s) a '{search_query}' neste lote. [SEARCH_FOUND_DELETE_IDS: {delete_list_str}]"
+        raise HTTPException(status_code=415, detail="Formato não suportado. Envie .csv ou .xlsx.")
+
+    for row in rows:
+        values = [_cell_text(value) for value in row]
+        if any(values): # Pula linhas totalmente vazias
+            yield values
+
+
+def _take_rows(rows, count: int) -> List[List[str]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= count:
+            break
+    return batch
+
+
+def _header_names(header_row: List[str]) -> List[str]:
+    headers = []
+    for position, header in enumerate(header_row):
+        header = header or f"Coluna {position + 1}"
+        while header in headers: # Cabeçalhos repetidos viram chaves distintas
+            header = f"{header} ({position + 1})"
+        headers.append(header)
+    return headers
+
+
+def _find_column(headers: List[str], patterns: List[str], exclude: Tuple[str, ...] = ()) -> str:
+    normalized_headers = [h.replace("_", " ") for h in normalize_texts(headers)]
+    for pattern in patterns:
+        for header, header_norm in zip(headers, normalized_headers):
+            # Casa no início de uma palavra ("nome resp" sim, "empaia" não)
+            if header not in exclude and f" {pattern}" in f" {header_norm}":
+                return header
+    return ""
+
+
+async def detect_ingest_columns(headers: List[str], detect_rows: List[List[str]],
+                                name_column: Optional[str], phone_column: Optional[str]) -> Dict[str, Any]:
+    """Map aluno/telefone/responsavel/turma columns from the first rows"""
+    sample_data = [dict(zip(headers, row)) for row in detect_rows]
+    scored = score_column_detection(headers, sample_data)
+    name_key, number_key = scored["name_key"], scored["number_key"]
+    method = "score"
+
+    if scored["confidence"] < Config.DETECT_CONFIDENCE_THRESHOLD:
+        # Sem LLM aqui (caminho de volume): cache de detecções validadas, depois heurística
+        cached = await get_cached_column_detection(headers)
+        if cached is not None:
+            name_key, number_key, method = cached["name_key"], cached["number_key"], "cache"
+        elif not name_key or not number_key:
+            heuristic = await heuristic_column_detection(headers)
+            name_key = name_key or heuristic["name_key"]
+            number_key = number_key or heuristic["number_key"]
+            method = "heuristic"
+
+    # Mapeamento explícito do usuário sempre vence
+    for override in (name_column, phone_column):
+        if override and override not in headers:
+            raise HTTPException(status_code=400, detail=f"Coluna '{override}' não existe na planilha")
+    if name_column or phone_column:
+        name_key, number_key, method = name_column or name_key, phone_column or number_key, "manual"
+
+    COLUMN_DETECTIONS.inc(endpoint="ingest", method=method)
+    responsavel_key = _find_column(headers, RESPONSAVEL_COLUMN_PATTERNS, exclude=(name_key, number_key))
+    turma_key = _find_column(headers, TURMA_COLUMN_PATTERNS, exclude=(name_key, number_key, responsavel_key))
+    return {
+        "aluno": name_key,
+        "telefone": number_key,
+        "responsavel": responsavel_key,
+        "turma": turma_key,
+        "confidence": round(scored["confidence"], 3),
+        "method": method,
+    }
+
+
+def build_ingest_contacts(rows: List[List[str]], positions: Dict[str, int], first_id: int) -> List[Dict[str, Any]]:
+    """Turn raw rows into normalized contact records (ids follow the sheet order)"""
+    def column(row: List[str], field: str) -> str:
+        position = positions.get(field, -1)
+        return row[position] if 0 <= position < len(row) else ""
+
+    raw_phones = [column(row, "telefone") for row in rows]
+    phones = normalize_phones(raw_phones) # Coluna inteira de uma vez
+    contacts = []
+    for offset, (row, raw_phone, phone) in enumerate(zip(rows, raw_phones, phones)):
+        contacts.append({
+            "id": first_id + offset,
+            "aluno": " ".join(column(row, "aluno").split()) or "Não Informado",
+            "responsavel": " ".join(column(row, "responsavel").split()),
+            "turma": " ".join(column(row, "turma").split()),
+            "telefone": phone["e164"] or raw_phone, # Inválido: mantém o original para correção
+            "status": phone["status"],
+        })
+    return contacts
+
+
+@app.post("/api/ingest")
+async def ingest_spreadsheet(
+    client_request: Request,
+    file: UploadFile = File(...),
+    name_column: Optional[str] = Form(None),
+    phone_column: Optional[str] = Form(None),
+):
+    """Stream-parse a CSV/XLSX upload into a contact session, chunk by chunk"""
+    client_ip = client_request.client.host
+
+    if not await check_rate_limit(client_ip, route="ingest"):
+        raise HTTPException(status_code=429, detail="Limite de taxa excedido. Tente novamente mais tarde.")
+
+    rows = iter_sheet_rows(file.file, file.filename or "")
+    try:
+        # O parsing é CPU puro: roda em thread, um lote por vez, sem travar o event loop
+        first_rows = await asyncio.to_thread(_take_rows, rows, Config.INGEST_DETECT_ROWS + 1)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.warning(f"Falha ao ler planilha enviada (IP: {client_ip}): {e}")
+        raise HTTPException(status_code=400, detail="Não foi possível ler o arquivo. Verifique se é um .csv ou .xlsx válido.")
+
+    if len(first_rows) < 2:
+        raise HTTPException(status_code=400, detail="A planilha não tem cabeçalho e dados")
+
+    headers = _header_names(first_rows[0])
+    columns = await detect_ingest_columns(headers, first_rows[1:], name_column, phone_column)
+    if not columns["telefone"]:
+        raise HTTPException(status_code=422, detail="Não foi possível identificar a coluna de telefone. Informe 'phone_column'.")
+    positions = {field: headers.index(columns[field]) for field in ("aluno", "telefone", "responsavel", "turma") if columns[field]}
+
+    session_id = secrets.token_urlsafe(16)
+    key = contact_session_key(session_id)
+    # Com o Redis, só o lote atual fica na memória: o índice da sessão é montado
+    # sob demanda (get_contact_session) no primeiro comando do chat. Sem o
+    # Redis, a sessão vive só neste processo e o índice é montado aqui mesmo
+    # (limitado por CONTACT_SESSION_MAX_CONTACTS).
+    index = None if redis_client else ContactIndex()
+    total = valid = 0
+    pending_rows = first_rows[1:]
+
+    try:
+        while pending_rows:
+            contacts = build_ingest_contacts(pending_rows, positions, first_id=total + 1)
+            total += len(contacts)
+            if total > Config.CONTACT_SESSION_MAX_CONTACTS:
+                raise HTTPException(status_code=413, detail=f"Lista grande demais (máximo de {Config.CONTACT_SESSION_MAX_CONTACTS} contatos).")
+            valid += sum(1 for c in contacts if c["status"] == "valid")
+
+            if index is None:
+                try:
+                    async with redis_client.pipeline(transaction=False) as pipe:
+                        pipe.rpush(key, *(json_text(c) for c in contacts))
+                        pipe.expire(key, Config.CONTACT_SESSION_TTL)
+                        await pipe.execute()
+                except Exception as e:
+                    if total > len(contacts):
+                        # Lotes anteriores só existem no Redis: a sessão ficaria incompleta
+                        logging.error(f"Falha ao gravar ingestão no Redis no meio do arquivo: {e}")
+                        raise HTTPException(status_code=503, detail="Redis indisponível durante a ingestão. Tente novamente.")
+                    # Primeiro lote: segue só em memória, como em /api/contact-session
+                    logging.error(f"Falha ao gravar ingestão no Redis (sessão só em memória): {e}")
+                    index = ContactIndex()
+            if index is not None:
+                index.add_contacts(contacts)
+
+            pending_rows = await asyncio.to_thread(_take_rows, rows, Config.INGEST_CHUNK_SIZE)
+    except HTTPException:
+        await _discard_ingest(key)
+        raise
+    except Exception as e:
+        await _discard_ingest(key)
+        logging.error(f"Falha na ingestão de planilha (IP: {client_ip}): {e}")
+        raise HTTPException(status_code=500, detail="Falha ao processar a planilha")
+    finally:
+        await file.close()
+
+    if index is not None:
+        _cache_contact_session(session_id, index)
+
+    # --- LGPD (Monitoramento) ---
+    logging.info(f"Planilha ingerida (IP: {client_ip}): {total} contatos, {valid} válidos, colunas via {columns['method']}.")
+    # ------------------------------
+
+    return {
+        "sessionId": session_id,
+        "totalContacts": total,
+        "validContacts": valid,
+        "invalidContacts": total - valid,
+        "columns": {field: columns[field] for field in ("aluno", "telefone", "responsavel", "turma")},
+        "detection": {"method": columns["method"], "confidence": columns["confidence"]},
+        "expiresIn": Config.CONTACT_SESSION_TTL
+    }
+
+async def _discard_ingest(key: str) -> None:
+    if redis_client:
+        try:
+            await redis_client.delete(key)
+        except Exception as e:
+            logging.error(f"Falha ao descartar ingestão parcial no Redis: {e}")
+
+
+@app.get("/api/contact-session/{session_id}/contacts")
+async def get_contact_session_page(session_id: str, offset: int = 0, limit: int = 1000):
+    """Page through the stored contacts of a session (e.g. after /api/ingest)"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        raise HTTPException(status_code=400, detail="Session ID inválido")
+    if offset < 0 or not 1 <= limit <= 5000:
+        raise HTTPException(status_code=400, detail="Paginação inválida (offset >= 0, limit entre 1 e 5000)")
+    if not redis_client:
+        raise HTTPException(status_code=503, detail="Redis indisponível")
+
+    key = contact_session_key(session_id)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.llen(key)
+            pipe.lrange(key, offset, offset + limit - 1)
+            total, raw_contacts = await pipe.execute()
+    except Exception as e:
+        logging.error(f"Falha ao ler sessão de contatos no Redis: {e}")
+        raise HTTPException(status_code=500, detail="Falha ao ler a sessão de contatos")
+
+    if not total:
+        raise HTTPException(status_code=404, detail="Sessão de contatos não encontrada ou expirada")
+
+    next_offset = offset + len(raw_contacts)
+    return {
+        "contacts": [json_loads(c) for c in raw_contacts],
+        "offset": offset,
+        "nextOffset": next_offset if next_offset < total else None,
+        "totalContacts": total
+    }
+
+
+# --- Chamadas à OpenRouter e Streaming (SSE) do Chat ---
+OPENROUTER_CHAT_URL = f"{Config.OPENROUTER_BASE_URL}/chat/completions"
+SEARCH_KEEP_TAG = re.compile(r"\[SEARCH_FOUND_KEEP_ID:\s*(\d+)\]")
+SEARCH_DELETE_TAG = re.compile(r"\[SEARCH_FOUND_DELETE_IDS:\s*([\d,\s]+)\]")
+
+def openrouter_headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {Config.OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": SITE_URL,
+        "X-Title": SITE_TITLE,
+    }
+
+def build_chat_messages(request: "ChatRequest") -> List[Dict[str, str]]:
+    """System prompt + history, with the contact sample appended to the last turn"""
+    # Constrói o histórico de mensagens para a API OpenRouter
+    messages = []
+    messages.append({"role": "system", "content": SYSTEM_INSTRUCTION})
+    for message in request.history:
+        role = "user" if message.role == "user" else "assistant"
+        messages.append({"role": role, "content": message.text})
+    
+    last_user_prompt = messages[-1]["content"]
+    if request.contact_data_sample:
+        sample = request.contact_data_sample
+        sample_text = sample if isinstance(sample, str) else json_text(sample)
+        data_context = f"\n\n--- DADOS DE CONTEXTO DO EXCEL (JSON stringified) ---\n{sample_text}\n--- FIM DOS DADOS DE CONTEXTO ---\n"
+        last_user_prompt += data_context
+    messages[-1]["content"] = last_user_prompt
+    return messages
+
+def parse_search_tags(text: str) -> Dict[str, Any]:
+    """Extract the [SEARCH_*] control tags from a final answer"""
+    keep_match = SEARCH_KEEP_TAG.search(text)
+    delete_match = SEARCH_DELETE_TAG.search(text)
+    return {
+        "keep_id": int(keep_match.group(1)) if keep_match else None,
+        "delete_ids": [int(i) for i in re.findall(r"\d+", delete_match.group(1))] if delete_match else [],
+        "page_fail": "[SEARCH_PAGE_FAIL]" in text,
+    }
+
+def sse_event(event: str, data: Any, event_id: Optional[str] = None) -> str:
+    # `data` pode vir já serializado (eventos de job guardados no Redis)
+    payload = data if isinstance(data, str) else json_text(data)
+    prefix = f"id: {event_id}\n" if event_id else ""
+    return f"{prefix}event: {event}\ndata: {payload}\n\n"
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        # Desliga cache e buffering de proxies (Render/Nginx) para o SSE fluir
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def stream_rule_answer(ai_response: str):
+    yield sse_event("message", {"response": ai_response})
+    yield sse_event("done", {"response": ai_response, "tags": parse_search_tags(ai_response)})
+
+async def stream_llm_answer(payload: Dict[str, Any], client_ip: str):
+    """Proxy OpenRouter `stream: true` deltas as `token` events, then `done`"""
+    chunks: List[str] = []
+    try:
+        client = get_http_client(OPENROUTER_POOL)
+        # Latência medida até o fim do stream (tempo total da resposta)
+        with track_upstream("openrouter", "chat_stream") as call:
+            async with client.stream(
+                "POST",
+                OPENROUTER_CHAT_URL,
+                headers=openrouter_headers(),
+                json={**payload, "stream": True},
+                timeout=60.0
+            ) as response:
+                call["status"] = response.status_code
+                if response.status_code != 200:
+                    error_body = (await response.aread()).decode("utf-8", "replace")
+                    logging.error(f"Erro da API OpenRouter (IP: {client_ip}): {response.status_code} - {error_body}")
+                    yield sse_event("error", {"error": f"Erro ao comunicar com a AI. Código: {response.status_code}"})
+                    return
+
+                async for line in response.aiter_lines():
+                    # Ignora linhas vazias e comentários SSE (ex: ": OPENROUTER PROCESSING")
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json_loads(data)
+                    except ValueError:
+                        continue
+                    if chunk.get("error"):
+                        logging.error(f"Erro da API OpenRouter no stream (IP: {client_ip}): {chunk['error']}")
+                        yield sse_event("error", {"error": "A AI interrompeu a resposta."})
+                        return
+                    # Modelos de raciocínio também enviam `reasoning`; só o `content` vai ao usuário
+                    delta = (chunk.get("choices") or [{}])[0].get("delta", {}).get("content")
+                    if delta:
+                        chunks.append(delta)
+                        yield sse_event("token", {"delta": delta})
+    except Exception as e:
+        logging.critical(f"Exceção inesperada no Chatbot (LLM Stream) (IP: {client_ip}): {e}")
+        yield sse_event("error", {"error": "Erro interno do servidor ao transmitir a resposta da AI."})
+        return
+
+    ai_response = "".join(chunks)
+    if not ai_response:
+        yield sse_event("error", {"error": "A AI retornou uma resposta inesperada."})
+        return
+    # As tags [SEARCH_*] só são confiáveis no texto completo
+    yield sse_event("done", {"response": ai_response, "tags": parse_search_tags(ai_response)})
 
 
 # Função principal do Chatbot
@@ -390,7 +1747,7 @@ async def handle_chat_query(request: ChatRequest, client_request: Request):
         logging.error(f"Tentativa de uso do Chat (IP: {client_ip}) falhou: OPENROUTER_API_KEY não configurada.")
         raise HTTPException(status_code=503, detail="OPENROUTER_API_KEY não configurada. Por favor, defina a variável de ambiente.")
 
-    if not await check_rate_limit(client_ip):
+    if not await check_rate_limit(client_ip, route="chat"):
         raise HTTPException(status_code=429, detail="Limite de taxa excedido. Tente novamente mais tarde.")
     
     logging.info(f"Consulta ao Chatbot recebida do IP: {client_ip}")
@@ -400,15 +1757,31 @@ async def handle_chat_query(request: ChatRequest, client_request: Request):
     
     # 1. Tenta decodificar os dados da amostra primeiro
     sample_data = {}
-    if request.contact_data_sample:
+    if isinstance(request.contact_data_sample, dict):
+        sample_data = request.contact_data_sample
+    elif request.contact_data_sample:
+        # Clientes antigos enviam a amostra como string JSON (dupla codificação)
         try:
-            sample_data = json.loads(request.contact_data_sample)
-        except json.JSONDecodeError:
+            sample_data = json_loads(request.contact_data_sample)
+        except ValueError:
             logging.warning(f"JSON de amostra inválido recebido do IP: {client_ip}")
             sample_data = {} # Falha segura
 
-    # 2. Tenta executar a lógica de regras (process_ai_logic)
-    if sample_data:
+    # 2. Com uma sessão de contatos, resolve o comando na lista inteira (índice)
+    if request.session_id:
+        if not SESSION_ID_PATTERN.match(request.session_id):
+            raise HTTPException(status_code=400, detail="Session ID inválido")
+        try:
+            index = await get_contact_session(request.session_id)
+        except Exception as e:
+            logging.error(f"Falha ao carregar sessão de contatos do Redis: {e}")
+            index = None
+        if index is None:
+            raise HTTPException(status_code=404, detail="Sessão de contatos não encontrada ou expirada. Envie a lista novamente.")
+        ai_response = process_session_logic(request.message, index)
+
+    # 2b. Senão, tenta executar a lógica de regras sobre o lote (process_ai_logic)
+    elif sample_data:
         try:
             # `process_ai_logic` tentará traduzir o comando
             # Se retornar `None`, significa que é um chat normal e a IA deve ser chamada
@@ -419,51 +1792,39 @@ async def handle_chat_query(request: ChatRequest, client_request: Request):
             ai_response = None # Força a chamada à LLM
 
     # 3. Se a lógica de regras não tratou (retornou None), chama a LLM real
+    CHAT_ANSWERS.inc(engine="llm" if ai_response is None else "rules")
     if ai_response is None:
         logging.info(f"Lógica de regras não ativada. Chamando LLM para: '{request.message}'")
-        # Constrói o histórico de mensagens para a API OpenRouter
-        messages = []
-        messages.append({"role": "system", "content": SYSTEM_INSTRUCTION})
-        for message in request.history:
-            role = "user" if message.role == "user" else "assistant"
-            messages.append({"role": role, "content": message.text})
-        
-        last_user_prompt = messages[-1]["content"]
-        if request.contact_data_sample:
-            data_context = f"\n\n--- DADOS DE CONTEXTO DO EXCEL (JSON stringified) ---\n{request.contact_data_sample}\n--- FIM DOS DADOS DE CONTEXTO ---\n"
-            last_user_prompt += data_context
-        messages[-1]["content"] = last_user_prompt
-
         payload = {
             "model": AI_MODEL,
-            "messages": messages,
+            "messages": build_chat_messages(request),
             "temperature": 0.5,
         }
-        
-        headers = {
-            "Authorization": f"Bearer {Config.OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": SITE_URL,
-            "X-Title": SITE_TITLE,
-        }
+
+        # Modo streaming: repassa os tokens da OpenRouter como Server-Sent Events
+        if request.stream:
+            return sse_response(stream_llm_answer(payload, client_ip))
 
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
+            client = get_http_client(OPENROUTER_POOL)
+            with track_upstream("openrouter", "chat") as call:
                 response = await client.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers=headers,
-                    json=payload
+                    OPENROUTER_CHAT_URL,
+                    headers=openrouter_headers(),
+                    json=payload,
+                    timeout=60.0
                 )
-                
-                if response.status_code != 200:
-                    logging.error(f"Erro da API OpenRouter (IP: {client_ip}): {response.status_code} - {response.text}")
-                    raise HTTPException(status_code=500, detail=f"Erro ao comunicar com a AI. Código: {response.status_code}")
+                call["status"] = response.status_code
+            
+            if response.status_code != 200:
+                logging.error(f"Erro da API OpenRouter (IP: {client_ip}): {response.status_code} - {response.text}")
+                raise HTTPException(status_code=500, detail=f"Erro ao comunicar com a AI. Código: {response.status_code}")
 
-                result = response.json()
-                ai_response = result.get("choices", [{}])[0].get("message", {}).get("content")
-                
-                if not ai_response:
-                    raise HTTPException(status_code=500, detail="A AI retornou uma resposta inesperada.")
+            result = response.json()
+            ai_response = result.get("choices", [{}])[0].get("message", {}).get("content")
+            
+            if not ai_response:
+                raise HTTPException(status_code=500, detail="A AI retornou uma resposta inesperada.")
         
         except HTTPException:
             raise
@@ -472,17 +1833,204 @@ async def handle_chat_query(request: ChatRequest, client_request: Request):
             raise HTTPException(status_code=500, detail=f"Erro interno do servidor: {str(e)}")
 
     # 4. Retorna a resposta (seja da lógica de regras ou da LLM)
+    if request.stream:
+        # Respostas do motor de regras saem como um único evento
+        return sse_response(stream_rule_answer(ai_response))
     return {"response": ai_response}
 
 
+# --- Cache da Detecção de Colunas (LRU em memória + Redis com TTL) ---
+# As escolas enviam sempre os mesmos layouts de exportação. A chave é a lista
+# ORDENADA de cabeçalhos normalizados; o valor guarda as POSIÇÕES das colunas
+# validadas pela AI, para devolver os nomes exatos da planilha atual mesmo
+# quando só mudam acentos/maiúsculas ("Telefone" vs "TELEFONE").
+column_detection_cache: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+column_cache_stats: Dict[str, int] = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+def column_cache_key(headers: List[str]) -> str:
+    signature = json.dumps(normalize_texts(headers), ensure_ascii=False)
+    return "detect_columns:" + hashlib.sha256(signature.encode("utf-8")).hexdigest()
+
+def _remember_column_detection(key: str, entry: Dict[str, int]) -> None:
+    column_detection_cache[key] = entry
+    column_detection_cache.move_to_end(key)
+    while len(column_detection_cache) > Config.DETECT_CACHE_SIZE:
+        column_detection_cache.popitem(last=False)
+
+def _resolve_column_entry(entry: Dict[str, int], headers: List[str]) -> Dict[str, str]:
+    def header_at(index: int) -> str:
+        return headers[index] if 0 <= index < len(headers) else ""
+    return {"name_key": header_at(entry.get("name_index", -1)), "number_key": header_at(entry.get("number_index", -1))}
+
+async def get_cached_column_detection(headers: List[str]) -> Optional[Dict[str, str]]:
+    """Look the header signature up in the local LRU, then in Redis"""
+    key = column_cache_key(headers)
+
+    entry = column_detection_cache.get(key)
+    if entry is not None:
+        column_detection_cache.move_to_end(key)
+        column_cache_stats["local_hits"] += 1
+        return _resolve_column_entry(entry, headers)
+
+    if redis_client:
+        try:
+            raw_entry = await redis_client.get(key)
+            if raw_entry:
+                entry = json_loads(raw_entry)
+                if not isinstance(entry, dict) or not all(isinstance(entry.get(f), int) for f in ("name_index", "number_index")):
+                    raise ValueError("formato desconhecido")
+        except ValueError as e:
+            # JSON corrompido ou de um formato antigo: vale como miss e a chave é descartada
+            logging.warning(f"Entrada inválida no cache de detecção de colunas: {e}")
+            entry = None
+            try:
+                await redis_client.delete(key)
+            except Exception:
+                pass
+        except Exception as e:
+            logging.warning(f"Falha ao ler cache de detecção de colunas no Redis: {e}")
+            entry = None
+        if entry is not None:
+            _remember_column_detection(key, entry)
+            column_cache_stats["redis_hits"] += 1
+            return _resolve_column_entry(entry, headers)
+
+    column_cache_stats["misses"] += 1
+    return None
+
+async def store_column_detection(headers: List[str], detected: Dict[str, str]) -> None:
+    """Cache a validated AI detection (both tiers)"""
+    if not detected.get("name_key") and not detected.get("number_key"):
+        return # AI incerta: não cacheia, a próxima tentativa pode acertar
+
+    key = column_cache_key(headers)
+    entry = {
+        "name_index": headers.index(detected["name_key"]) if detected.get("name_key") else -1,
+        "number_index": headers.index(detected["number_key"]) if detected.get("number_key") else -1,
+    }
+    _remember_column_detection(key, entry)
+    if redis_client:
+        try:
+            await redis_client.setex(key, Config.DETECT_CACHE_TTL, json.dumps(entry))
+        except Exception as e:
+            logging.warning(f"Falha ao gravar cache de detecção de colunas no Redis: {e}")
+
+def column_cache_summary() -> Dict[str, Any]:
+    lookups = sum(column_cache_stats.values())
+    hits = column_cache_stats["local_hits"] + column_cache_stats["redis_hits"]
+    return {
+        **column_cache_stats,
+        "entries": len(column_detection_cache),
+        "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+    }
+
+
+# --- Detector de Colunas por Pontuação (roda ANTES da AI) ---
+# Pontua cada cabeçalho como "nome" e "telefone" combinando o TEXTO do
+# cabeçalho (padrões em ordem de prioridade: 'aluno' primeiro) com o FORMATO
+# dos valores da amostra (densidade de dígitos de telefone, cara de nome).
+# Se os dois papéis passarem do limiar de confiança, a chamada à OpenRouter
+# é dispensada; a LLM fica só para planilhas ambíguas.
+NAME_COLUMN_PATTERNS = ['aluno', 'nome aluno', 'nome_aluno', 'responsavel', 'responsável', 'nome resp', 'name', 'nome', 'full_name', 'full name', 'customer_name', 'customer name', 'contact_name', 'contact name']
+PHONE_COLUMN_PATTERNS = ['phone', 'telefone', 'mobile', 'cell', 'whatsapp', 'phone_number', 'phone number', 'celular']
+
+# Padrões já normalizados (uma vez só), preservando a prioridade
+_NAME_PATTERNS_NORM = list(dict.fromkeys(p.replace("_", " ") for p in normalize_texts(NAME_COLUMN_PATTERNS)))
+_PHONE_PATTERNS_NORM = list(dict.fromkeys(p.replace("_", " ") for p in normalize_texts(PHONE_COLUMN_PATTERNS)))
+
+DETECT_AMBIGUITY_MARGIN = 0.05  # diferença mínima para o 2º colocado
+NAME_VALUE_PATTERN = re.compile(r"^[^\W\d_]+(?:[ '.-]+[^\W\d_]+)*\.?$")
+
+def _header_match(header_norm: str, patterns: List[str]) -> Tuple[int, float]:
+    """(priority rank, match strength) of a header; rank == len(patterns) if none"""
+    for rank, pattern in enumerate(patterns):
+        if header_norm == pattern:
+            return rank, 1.0  # match exato
+    for rank, pattern in enumerate(patterns):
+        if pattern in header_norm:
+            return rank, 0.8  # o padrão aparece dentro do cabeçalho (ex: "nome do aluno")
+    return len(patterns), 0.0
+
+def _phone_value_score(values: List[str]) -> float:
+    hits = 0
+    for value in values:
+        digits = sum(ch.isdigit() for ch in value)
+        significant = sum(not ch.isspace() for ch in value)
+        if 10 <= digits <= 13 and significant and digits / significant >= 0.7:
+            hits += 1
+    return hits / len(values)
+
+def _name_value_score(values: List[str]) -> float:
+    total = 0.0
+    for value in values:
+        if NAME_VALUE_PATTERN.match(value):
+            total += 1.0 if " " in value else 0.5  # "Ana Costa" > "Ativo"
+    return total / len(values)
+
+def _pick_column(headers: List[str], header_matches: List[Tuple[int, float]], column_values: List[List[str]], value_scorer, exclude: str = "") -> Tuple[str, float]:
+    """Best header for one role and its confidence (0 to 1)"""
+    candidates = []
+    for header, (rank, strength), values in zip(headers, header_matches, column_values):
+        if header == exclude:
+            continue
+        value_score = value_scorer(values) if values else None
+        if value_score is None:
+            score = 0.8 * strength  # sem amostra: confia menos só no cabeçalho
+        else:
+            score = 0.6 * strength + 0.4 * value_score
+        candidates.append((rank, -score, header, score))
+    if not candidates:
+        return "", 0.0
+
+    # A prioridade do padrão decide primeiro ('aluno' antes de 'responsavel'
+    # antes de 'nome'); sem nenhum cabeçalho reconhecido, vale só o formato
+    # dos valores (no máximo 0.4: sempre abaixo do limiar -> LLM).
+    candidates.sort()
+    best_rank, _, best_header, best_score = candidates[0]
+    if best_score <= 0:
+        return "", 0.0
+    rivals = [c for c in candidates[1:] if c[0] == best_rank and best_score - c[3] < DETECT_AMBIGUITY_MARGIN]
+    # Empate técnico com outro cabeçalho = ambíguo: derruba a confiança
+    confidence = best_score / 2 if rivals else best_score
+    return best_header, round(confidence, 4)
+
+def score_column_detection(headers: List[str], sample_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Pick name/phone columns by header and sample shape, with a confidence"""
+    normalized_headers = [h.replace("_", " ") for h in normalize_texts(headers)]
+    sample_rows = sample_data[:20]
+    column_values = [
+        [str(row.get(header)).strip() for row in sample_rows if row.get(header) not in (None, "")]
+        for header in headers
+    ]
+
+    number_key, number_confidence = _pick_column(
+        headers, [_header_match(h, _PHONE_PATTERNS_NORM) for h in normalized_headers], column_values, _phone_value_score
+    )
+    name_key, name_confidence = _pick_column(
+        headers, [_header_match(h, _NAME_PATTERNS_NORM) for h in normalized_headers], column_values, _name_value_score,
+        exclude=number_key
+    )
+    return {
+        "name_key": name_key,
+        "number_key": number_key,
+        "name_confidence": name_confidence,
+        "number_confidence": number_confidence,
+        "confidence": min(name_confidence, number_confidence),
+    }
+
+
 # AI Column Detection Endpoint (Modificado para usar DeepSeek R1T2 ou Heuristic)
+def count_column_detection(method: str, detected: Dict[str, str], endpoint: str = "detect_columns") -> Dict[str, str]:
+    COLUMN_DETECTIONS.inc(endpoint=endpoint, method=method)
+    return detected
+
 @app.post("/api/detect-columns")
 async def detect_columns(request: ColumnDetectionRequest, client_request: Request):
     """Detect name and phone columns using AI or heuristic fallback"""
     client_ip = client_request.client.host
     
     # Rate limiting
-    if not await check_rate_limit(client_ip):
+    if not await check_rate_limit(client_ip, route="detect"):
         raise HTTPException(
             status_code=429,
             detail="Limite de taxa excedido. Tente novamente mais tarde."
@@ -492,8 +2040,18 @@ async def detect_columns(request: ColumnDetectionRequest, client_request: Reques
     logging.info(f"Detecção de colunas iniciada pelo IP: {client_ip}")
     # ------------------------------
     
-    # Tenta usar a AI para detecção de colunas se a chave estiver configurada
+    # 1. Detector por pontuação: resolve a maioria das planilhas em < 1ms
+    scored = score_column_detection(request.headers, request.sample_data)
+    if scored["confidence"] >= Config.DETECT_CONFIDENCE_THRESHOLD:
+        return count_column_detection("score", {"name_key": scored["name_key"], "number_key": scored["number_key"]})
+
+    # 2. Planilha ambígua: tenta usar a AI se a chave estiver configurada
     if Config.OPENROUTER_API_KEY:
+        # Cache na frente da AI: o mesmo layout de planilha não paga outra chamada à LLM
+        cached = await get_cached_column_detection(request.headers)
+        if cached is not None:
+            return count_column_detection("cache", cached)
+
         try:
             # Prepare data for AI analysis
             headers_text = ", ".join(request.headers)
@@ -529,76 +2087,76 @@ async def detect_columns(request: ColumnDetectionRequest, client_request: Reques
                 {"role": "user", "content": user_prompt}
             ]
 
-            headers = {
-                "Authorization": f"Bearer {Config.OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": SITE_URL,
-                "X-Title": SITE_TITLE,
-            }
-            
-            async with httpx.AsyncClient(timeout=30.0) as client:
+            client = get_http_client(OPENROUTER_POOL)
+            with track_upstream("openrouter", "detect_columns") as call:
                 response = await client.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers=headers,
+                    OPENROUTER_CHAT_URL,
+                    headers=openrouter_headers(),
                     json={
                         "model": AI_MODEL,
                         "messages": messages,
                         "temperature": 0.1,
                         # ATUALIZAÇÃO: Linha `max_tokens` removida completamente
-                    }
+                    },
+                    timeout=30.0
                 )
+                call["status"] = response.status_code
+            
+            if response.status_code != 200:
+                # Fallback para o heuristic se a chamada da AI falhar
+                return count_column_detection("heuristic", await heuristic_column_detection(request.headers))
+            
+            result = response.json()
+            content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+            
+            # Tenta extrair e carregar o JSON (OpenRouter nem sempre garante JSON puro)
+            try:
+                json_match = re.search(r'\{[^}]+\}', content)
+                if json_match:
+                    ai_result = json.loads(json_match.group())
+                else:
+                    raise json.JSONDecodeError("JSON não encontrado", content, 0)
                 
-                if response.status_code != 200:
-                    # Fallback para o heuristic se a chamada da AI falhar
-                    return await heuristic_column_detection(request.headers)
+                # Validação final para garantir que as chaves retornadas são válidas
+                name_key = ai_result.get("name_key", "")
+                number_key = ai_result.get("number_key", "")
                 
-                result = response.json()
-                content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+                if name_key not in request.headers: name_key = ""
+                if number_key not in request.headers: number_key = ""
                 
-                # Tenta extrair e carregar o JSON (OpenRouter nem sempre garante JSON puro)
-                try:
-                    json_match = re.search(r'\{[^}]+\}', content)
-                    if json_match:
-                        ai_result = json.loads(json_match.group())
-                    else:
-                        raise json.JSONDecodeError("JSON não encontrado", content, 0)
-                    
-                    # Validação final para garantir que as chaves retornadas são válidas
-                    name_key = ai_result.get("name_key", "")
-                    number_key = ai_result.get("number_key", "")
-                    
-                    if name_key not in request.headers: name_key = ""
-                    if number_key not in request.headers: number_key = ""
-                    
-                    return {"name_key": name_key, "number_key": number_key}
-                        
-                except (json.JSONDecodeError, KeyError) as e:
-                    print(f"AI JSON parsing failed, using heuristic: {e}")
-                    logging.warning(f"AI JSON parsing failed, using heuristic: {e}")
-                    return await heuristic_column_detection(request.headers)
+                detected = {"name_key": name_key, "number_key": number_key}
+                await store_column_detection(request.headers, detected)
+                return count_column_detection("llm", detected)
                     
+            except (json.JSONDecodeError, KeyError) as e:
+                print(f"AI JSON parsing failed, using heuristic: {e}")
+                logging.warning(f"AI JSON parsing failed, using heuristic: {e}")
+                return count_column_detection("heuristic", await heuristic_column_detection(request.headers))
+                
         except Exception as e:
             print(f"AI column detection (OpenRouter) error: {e}")
             logging.error(f"AI column detection (OpenRouter) error: {e}")
-            return await heuristic_column_detection(request.headers)
+            return count_column_detection("heuristic", await heuristic_column_detection(request.headers))
             
     # Fallback para o heuristic se OPENROUTER_API_KEY não estiver configurada
-    return await heuristic_column_detection(request.headers)
+    return count_column_detection("heuristic", await heuristic_column_detection(request.headers))
 
 
 async def heuristic_column_detection(headers: List[str]) -> Dict[str, str]:
     """Fallback heuristic column detection"""
     # *** ATUALIZADO: Prioriza 'aluno' na heurística também ***
-    name_patterns = ['aluno', 'nome aluno', 'nome_aluno', 'responsavel', 'responsável', 'nome resp', 'name', 'nome', 'full_name', 'full name', 'customer_name', 'customer name', 'contact_name', 'contact name']
-    phone_patterns = ['phone', 'telefone', 'mobile', 'cell', 'whatsapp', 'phone_number', 'phone number', 'celular']
+    name_patterns = NAME_COLUMN_PATTERNS
+    phone_patterns = PHONE_COLUMN_PATTERNS
     
     name_key = ""
     number_key = ""
+    # Normaliza os cabeçalhos uma única vez (e não a cada padrão testado)
+    normalized_headers = normalize_texts(headers)
     
     # Busca por nome (com prioridade)
     for pattern in name_patterns:
-        for header in headers:
-            header_lower_simple = normalize_text(header).replace("_", " ") # Usa o normalizador
+        for header, header_norm in zip(headers, normalized_headers):
+            header_lower_simple = header_norm.replace("_", " ") # Usa o normalizador
             if pattern == header_lower_simple:
                 name_key = header
                 break
@@ -617,8 +2175,7 @@ async def heuristic_column_detection(headers: List[str]) -> Dict[str, str]:
 
     # Fallback (se a busca exata falhou, tenta 'in')
     if not name_key:
-        for header in headers:
-            header_lower = normalize_text(header) # Usa o normalizador
+        for header, header_lower in zip(headers, normalized_headers): # Usa o normalizador
             for pattern in name_patterns:
                 if pattern in header_lower:
                     name_key = header
@@ -645,7 +2202,7 @@ async def send_whatsapp_batch(request: WhatsAppSendRequest, client_request: Requ
     client_ip = client_request.client.host
     
     # Rate limiting
-    if not await check_rate_limit(client_ip):
+    if not await check_rate_limit(client_ip, route="send"):
         raise HTTPException(
             status_code=429,
             detail="Limite de taxa excedido. Tente novamente mais tarde."
@@ -673,210 +2230,1036 @@ async def send_whatsapp_batch(request: WhatsAppSendRequest, client_request: Requ
     logging.info(f"Iniciando Job de Envio (IP: {client_ip}): {job_id} para {len(request.contacts)} contatos.")
     # ------------------------------
     
-    # Start background task
-    asyncio.create_task(process_whatsapp_batch(
-        job_id, request.contacts, request.message, credentials.dict() # Converte Pydantic model para dict
-    ))
+    # Ritmo total do número (somando todos os workers, no modo fila)
+    send_rate = get_send_pacer(credentials.phoneNumberId).bucket.rate / send_rate_share
+
+    if Config.SEND_EXECUTION_MODE == "queue":
+        if not redis_client:
+            raise HTTPException(status_code=503, detail="Fila de envio indisponível sem Redis configurado.")
+        try:
+            # Durável: os lotes sobrevivem a reinícios do processo web
+            send_contacts = await enqueue_send_job(
+                job_id, request.contacts, request.message, credentials.dict(),
+                dedupe=request.dedupe, merge_names=request.merge_names, force_resend=request.force_resend
+            )
+        except Exception as e:
+            logging.error(f"Falha ao enfileirar Job de Envio {job_id}: {e}")
+            raise HTTPException(status_code=503, detail="Falha ao enfileirar o envio. Tente novamente.")
+    else:
+        # O estado do job já existe quando o front abrir /api/job-events
+        send_contacts = await start_job_state(job_id, request.contacts, dedupe=request.dedupe, merge_names=request.merge_names)
+        # Start background task
+        asyncio.create_task(process_whatsapp_batch(
+            job_id, send_contacts, request.message, credentials.dict(), # Converte Pydantic model para dict
+            prepared=True, force_resend=request.force_resend
+        ))
     
     return {
         "jobId": job_id,
         "status": "processing",
         "totalContacts": len(request.contacts),
-        "estimatedTime": len(request.contacts) * 0.1  # 100ms per message estimate
+        "messages": len(send_contacts), # chamadas à Graph API após a deduplicação
+        "deduplicated": len(request.contacts) - len(send_contacts),
+        "estimatedTime": len(send_contacts) / send_rate if send_rate > 0 else 0  # segundos, pelo ritmo do número
     }
 
-async def process_whatsapp_batch(job_id: str, contacts: List[Dict], message: str, credentials: Dict):
-    """Process WhatsApp messages in background"""
-    
-    # --- LGPD (Prevenção contra Perda / Resposta a Incidentes) ---
-    # O status do job é salvo no Redis (um banco de dados rápido).
-    # Se o servidor cair, o status do job (quantos faltam) pode ser
-    # recuperado se o Redis tiver persistência.
-    # Usamos `setex` (com expiração) para que os dados não fiquem para sempre
-    # (Princípio da Retenção de Dados).
-    # -------------------------------------------------------------
+# --- Motor de Ritmo de Envio (Token Bucket por phoneNumberId) ---
+# Substitui o antigo "lote de 10 + sleep de 1s": as mensagens saem em paralelo
+# (limitadas por um semáforo) e no ritmo permitido pelo tier da Meta para o número.
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens/s, holding at most `burst` tokens"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Take tokens without waiting; returns False if the bucket is short"""
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """Wait until tokens are available (FIFO between waiters)"""
+        if self.rate <= 0:
+            return  # rate <= 0 desativa o ritmo
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class SendPacer:
+    """Bounded concurrency + token bucket for one WhatsApp phoneNumberId
+
+    The bucket rate follows AIMD: a throttling answer multiplies it by
+    WHATSAPP_AIMD_DECREASE (once per THROTTLE_COOLDOWN, since the requests
+    already in flight get the same answer), and each success adds back
+    WHATSAPP_AIMD_INCREASE/rate, i.e. about WHATSAPP_AIMD_INCREASE msg/s per
+    second, up to the configured rate.
+    """
+    THROTTLE_COOLDOWN = 1.0  # segundos
+
+    def __init__(self, rate: float, burst: float, concurrency: int, phone_number_id: str = ""):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_rate = self.bucket.rate
+        self.min_rate = min(Config.WHATSAPP_AIMD_MIN_RATE, self.max_rate)
+        self.concurrency = max(int(concurrency), 1)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.phone_number_id = phone_number_id
+        self.last_throttle = 0.0
+
+    def _set_rate(self, rate: float) -> None:
+        self.bucket._refill()  # tokens acumulados até agora contam no ritmo antigo
+        self.bucket.rate = rate
+        WHATSAPP_SEND_RATE_CURRENT.set(rate, phone_number_id=self.phone_number_id)
+
+    def record_success(self) -> None:
+        rate = self.bucket.rate
+        if 0 < rate < self.max_rate:
+            self._set_rate(min(self.max_rate, rate + Config.WHATSAPP_AIMD_INCREASE / rate))
+
+    def record_throttle(self) -> None:
+        now = time.monotonic()
+        if self.bucket.rate <= 0 or now - self.last_throttle < self.THROTTLE_COOLDOWN:
+            return  # sem ritmo configurado, ou o corte desta rajada já foi feito
+        self.last_throttle = now
+        rate = max(self.min_rate, self.bucket.rate * Config.WHATSAPP_AIMD_DECREASE)
+        logging.warning(f"Throttling da Graph API no número {self.phone_number_id}: ritmo reduzido para {rate:.1f} msg/s.")
+        self._set_rate(rate)
+
+    @asynccontextmanager
+    async def slot(self):
+        started = time.perf_counter()
+        async with self.semaphore:
+            await self.bucket.acquire()
+            SEND_PACER_WAIT.observe(time.perf_counter() - started)
+            yield
+
+
+send_pacers: Dict[str, SendPacer] = {}
+# Fração do ritmo do número que cabe a este processo (send_worker.py usa 1/SEND_WORKER_TOTAL)
+send_rate_share = 1.0
+
+def get_send_pacer(phone_number_id: str) -> SendPacer:
+    """Return the pacer shared by every job sending from this phoneNumberId"""
+    pacer = send_pacers.get(phone_number_id)
+    if pacer is None:
+        override = Config.WHATSAPP_RATE_OVERRIDES.get(phone_number_id, {})
+        pacer = SendPacer(
+            rate=override.get("rate", Config.WHATSAPP_SEND_RATE) * send_rate_share,
+            burst=max(override.get("burst", Config.WHATSAPP_SEND_BURST) * send_rate_share, 1),
+            concurrency=override.get("concurrency", Config.WHATSAPP_SEND_CONCURRENCY),
+            phone_number_id=phone_number_id,
+        )
+        send_pacers[phone_number_id] = pacer
+    return pacer
+
+# --- Deduplicação de Contatos por Telefone ---
+# Listas escolares repetem o telefone do responsável para cada filho, e cada
+# repetição custava uma chamada à Graph API. Com `dedupe`, contatos com o
+# mesmo número (E.164, já normalizado pelo job) viram UM envio: o primeiro da
+# lista leva os demais em `merged` e, com `merge_names`, o {name} da mensagem
+# vira "Ana, Pedro e João". Cada contato continua com o seu resultado (com
+# `mergedInto`), então contadores, /resume e relatório seguem por contato.
+def join_names(names: List[str]) -> str:
+    """'Ana', 'Pedro', 'João' -> 'Ana, Pedro e João' (repeated names once)"""
+    unique: Dict[str, str] = {}
+    for name in names:
+        name = name.strip()
+        if name:
+            unique.setdefault(normalize_text(name), name)
+    names = list(unique.values())
+    if len(names) <= 1:
+        return names[0] if names else ""
+    return f"{', '.join(names[:-1])} e {names[-1]}"
+
+def dedupe_send_contacts(contacts: List[Dict], merge_names: bool = True) -> List[Dict]:
+    """Collapse prepared contacts sharing a phone into one send each (list order kept)"""
+    groups: Dict[str, List[Dict]] = {}
+    for contact in contacts:
+        if contact.get("to"):
+            groups.setdefault(contact["to"], []).append(contact)
+
+    send_contacts = []
+    for contact in contacts:
+        group = groups.get(contact.get("to"))
+        if not group or len(group) == 1:
+            send_contacts.append(contact)
+        elif group[0] is contact:
+            # --- LGPD (Minimização de Dados) ---
+            # Dos contatos agrupados só vai o necessário para registrar o resultado
+            primary = {**contact, "merged": [
+                {"id": c.get("id"), "cleanedPhone": c.get("cleanedPhone"), "index": c.get("index")}
+                for c in group[1:]
+            ]}
+            if merge_names:
+                primary["name"] = join_names([str(c.get("name") or "") for c in group])
+            send_contacts.append(primary)
+    return send_contacts
+
+def expand_merged_results(contacts: List[Dict], results: List[Dict]) -> List[Dict]:
+    """Per-contact results: each merged contact gets its primary's outcome"""
+    expanded = []
+    for contact, result in zip(contacts, results):
+        result["index"] = contact.get("index")
+        expanded.append(result)
+        for merged in contact.get("merged", ()):
+            expanded.append({
+                **result,
+                "contact_id": merged["id"],
+                "phone": merged["cleanedPhone"],
+                "index": merged["index"],
+                "mergedInto": contact.get("id"),
+            })
+    return expanded
+
+# --- Registro de Envios entre Jobs (Idempotência) ---
+# Repetir uma campanha reenviava a mensagem a todos (uma chamada à Graph API
+# e uma conversa cobrada pela Meta por contato). Cada envio bem-sucedido entra
+# em `send_ledger:{campanha}:{período}`, um SET por SEND_LEDGER_BUCKET segundos
+# com TTL; campanha = hash(phoneNumberId, mensagem/template). Antes de cada
+# lote um SMISMEMBER por período vivo (um único round trip) diz quem já recebeu.
+#
+# --- LGPD (Minimização de Dados) ---
+# O registro não guarda telefones: só um hash de 8 bytes por destinatário,
+# com chave da campanha, e tudo expira com o TTL.
+# -------------------------------------------------
+def send_ledger_campaign(message: str, credentials: Dict) -> str:
+    """Idempotency scope of a send: phoneNumberId + message or template"""
+    identity = [
+        credentials["phoneNumberId"],
+        credentials.get("templateName") or "",
+        credentials.get("languageCode") or "",
+        message,
+    ]
+    return hashlib.sha256(json_bytes(identity)).hexdigest()[:32]
+
+def _ledger_member(campaign: str, phone: str) -> str:
+    return hashlib.blake2b(phone.encode(), key=campaign.encode(), digest_size=8).hexdigest()
+
+def send_ledger_keys(campaign: str) -> List[str]:
+    """Keys of the periods still inside SEND_LEDGER_TTL, newest first"""
+    current = int(time.time() // Config.SEND_LEDGER_BUCKET)
+    periods = -(-Config.SEND_LEDGER_TTL // Config.SEND_LEDGER_BUCKET)
+    return [f"send_ledger:{campaign}:{period}" for period in range(current, current - periods - 1, -1)]
+
+async def check_send_ledger(campaign: str, contacts: List[Dict]) -> List[bool]:
+    """True for each contact this campaign already reached (one round trip)"""
+    delivered = [False] * len(contacts)
+    positions = [i for i, c in enumerate(contacts) if c.get("to")]
+    if not redis_client or Config.SEND_LEDGER_TTL <= 0 or not positions:
+        return delivered
+    members = [_ledger_member(campaign, contacts[i]["to"]) for i in positions]
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in send_ledger_keys(campaign):
+                pipe.smismember(key, members)
+            replies = await pipe.execute()
+    except Exception as e:
+        # Sem o registro o lote sai inteiro (como antes): melhor reenviar que não enviar
+        logging.error(f"Falha ao consultar o registro de envios: {e}")
+        return delivered
+    for reply in replies:
+        for i, found in zip(positions, reply):
+            delivered[i] = delivered[i] or bool(found)
+    return delivered
+
+async def record_send_ledger(campaign: str, contacts: List[Dict]) -> None:
+    """Add the contacts just delivered to the current period's set"""
+    if not redis_client or Config.SEND_LEDGER_TTL <= 0 or not contacts:
+        return
+    try:
+        key = send_ledger_keys(campaign)[0]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.sadd(key, *(_ledger_member(campaign, c["to"]) for c in contacts))
+            # Vive um período a mais: a entrada mais nova do SET ainda cumpre o TTL inteiro
+            pipe.expire(key, Config.SEND_LEDGER_TTL + Config.SEND_LEDGER_BUCKET)
+            await pipe.execute()
+    except Exception as e:
+        logging.error(f"Falha ao gravar o registro de envios: {e}")
+
+def skipped_send_result(contact: Dict) -> Dict:
+    return {
+        "contact_id": contact.get("id"),
+        "phone": contact.get("cleanedPhone"),
+        "success": True,
+        "skipped": True,
+        "detail": "Mensagem já entregue a este número por um envio anterior (registro de envios).",
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+# --- Estado Incremental do Job no Redis ---
+# `job:{id}`          -> HASH com status/total/completed/failed (HINCRBY por lote)
+# `job:{id}:results`  -> LIST com um resultado JSON por contato (RPUSH por lote)
+# Cada lote grava só o que mudou: O(lote) em vez de reescrever o blob inteiro.
+def job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+def job_results_key(job_id: str) -> str:
+    return f"job:{job_id}:results"
+
+def job_outcomes_key(job_id: str) -> str:
+    return f"job:{job_id}:outcomes"
+
+def job_outcome(result: Dict) -> int:
+    """1 delivered, 0 failed, 2 failed with unknown delivery (not resent by retry_failed)"""
+    if result.get("success"):
+        return 1
+    return 2 if result.get("deliveryUnknown") else 0
+
+def job_failures_key(job_id: str) -> str:
+    return f"job:{job_id}:failures"
+
+def job_events_key(job_id: str) -> str:
+    return f"job:{job_id}:events"
+
+def add_job_event(pipe, job_id: str, event: str, data: Dict[str, Any]) -> None:
+    """Queue an XADD on the job's event stream (read by /api/job-events)"""
+    # Sempre JSON puro: o SSE repassa o campo `data` sem decodificar
+    pipe.xadd(job_events_key(job_id), {"event": event, "data": json_text(data)})
+    pipe.expire(job_events_key(job_id), Config.JOB_TTL)
+
+async def init_job_state(job_id: str, total: int, fingerprint: str = "", messages: Optional[int] = None) -> None:
+    """Create the job hash and an empty results list (`messages`: sends after dedupe)"""
+    now = datetime.utcnow().isoformat()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(job_key(job_id), job_results_key(job_id), job_failures_key(job_id), job_outcomes_key(job_id), job_events_key(job_id))
+        pipe.hset(job_key(job_id), mapping={
+            "status": "processing",
+            "total": total,
+            "completed": 0,
+            "failed": 0,
+            "skipped": 0,
+            "messages": total if messages is None else messages,
+            "checkpoint": -1,
+            "fingerprint": fingerprint,
+            "created_at": now,
+            "updated_at": now,
+        })
+        pipe.expire(job_key(job_id), Config.JOB_TTL)
+        await pipe.execute()
+
+async def record_job_progress(job_id: str, batch_results: List[Dict], chunk_index: Optional[int] = None) -> Optional[Dict[str, int]]:
+    """Add one batch's counters and results to the job state; returns the totals
+
+    In queue mode (`chunk_index`) the write only happens if the chunk is not
+    in `chunks_done` yet; returns None when another worker already recorded it.
+    """
+    completed = sum(1 for r in batch_results if r.get("success"))
+    failed = len(batch_results) - completed
+    skipped = sum(1 for r in batch_results if r.get("skipped"))
+    # Modo inline (lotes em ordem): último índice enviado (os agrupados vêm de qualquer ponto da lista)
+    sent_indexes = [] if chunk_index is not None else [
+        r["index"] for r in batch_results if r.get("index") is not None and "mergedInto" not in r
+    ]
+    async with redis_client.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                raise_checkpoint = False
+                if chunk_index is not None:
+                    # Um lote reassumido (XAUTOCLAIM) pode terminar em dois workers:
+                    # WATCH + SISMEMBER + MULTI garante que só o primeiro grava
+                    await pipe.watch(job_chunks_key(job_id))
+                    if await pipe.sismember(job_chunks_key(job_id), chunk_index):
+                        await pipe.reset()
+                        return None
+                    pipe.multi()
+                elif sent_indexes:
+                    # Após um /resume os lotes trazem índices abaixo do checkpoint:
+                    # WATCH + HGET + MULTI para o checkpoint só subir
+                    await pipe.watch(job_key(job_id))
+                    stored = await pipe.hget(job_key(job_id), "checkpoint")
+                    raise_checkpoint = stored is None or int(stored) < max(sent_indexes)
+                    pipe.multi()
+                pipe.hincrby(job_key(job_id), "completed", completed)
+                pipe.hincrby(job_key(job_id), "failed", failed)
+                if skipped:
+                    # Já recebidos em outro job: contam como concluídos, sem chamada à Graph API
+                    pipe.hincrby(job_key(job_id), "skipped", skipped)
+                pipe.hset(job_key(job_id), "updated_at", datetime.utcnow().isoformat())
+                if batch_results:
+                    encoded_results = [encode_job_value(r) for r in batch_results]
+                    pipe.rpush(job_results_key(job_id), *encoded_results)
+                    # Cópia só das falhas: ?failures_only não varre a lista inteira
+                    encoded_failures = [e for r, e in zip(batch_results, encoded_results) if not r.get("success")]
+                    if encoded_failures:
+                        pipe.rpush(job_failures_key(job_id), *encoded_failures)
+                        pipe.expire(job_failures_key(job_id), Config.JOB_TTL)
+                # Delta para quem acompanha via SSE: contadores do lote + resultados novos
+                add_job_event(pipe, job_id, "progress", {"completed": completed, "failed": failed, "results": batch_results})
+                # Resultado por índice do contato: base do /resume (o que falta / o que falhou)
+                outcomes = {r["index"]: job_outcome(r) for r in batch_results if r.get("index") is not None}
+                if outcomes:
+                    pipe.hset(job_outcomes_key(job_id), mapping=outcomes)
+                    pipe.expire(job_outcomes_key(job_id), Config.JOB_TTL)
+                if chunk_index is not None:
+                    # Modo fila: marca o lote como gravado (reentregas viram só XACK)
+                    pipe.sadd(job_chunks_key(job_id), chunk_index)
+                    pipe.expire(job_chunks_key(job_id), Config.JOB_TTL)
+                elif raise_checkpoint:
+                    pipe.hset(job_key(job_id), "checkpoint", max(sent_indexes))
+                pipe.expire(job_key(job_id), Config.JOB_TTL)
+                pipe.expire(job_results_key(job_id), Config.JOB_TTL)
+                pipe.hmget(job_key(job_id), "completed", "failed", "total")
+                results = await pipe.execute()
+                break
+            except aioredis.WatchError:
+                # Outro lote (ou o heartbeat) mexeu no job entre o WATCH e o EXEC: confere de novo
+                continue
+    total_completed, total_failed, total = results[-1]
+    return {"completed": int(total_completed or 0), "failed": int(total_failed or 0), "total": int(total or 0)}
+
+async def finish_job_state(job_id: str, status: str = "completed") -> Dict[str, int]:
+    """Mark the job as finished and return its final counters"""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(job_key(job_id), mapping={"status": status, "updated_at": datetime.utcnow().isoformat()})
+        pipe.hmget(job_key(job_id), "completed", "failed")
+        _, (completed, failed) = await pipe.execute()
+    counters = {"completed": int(completed or 0), "failed": int(failed or 0)}
+    async with redis_client.pipeline(transaction=False) as pipe:
+        add_job_event(pipe, job_id, "done", {"status": status, **counters})
+        await pipe.execute()
+    return counters
+
+async def load_job_state(job_id: str) -> Optional[Dict[str, Any]]:
+    """Assemble the job status (counters + results) or None if unknown"""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(job_key(job_id))
+        pipe.lrange(job_results_key(job_id), 0, -1)
+        job_hash, raw_results = await pipe.execute()
+    if not job_hash:
+        return None
+
+    # Após um /resume com retry_failed o mesmo índice aparece de novo: vale o último
+    results_by_index: Dict[Tuple[str, int], Dict] = {}
+    for position, raw_result in enumerate(raw_results):
+        result = decode_job_value(raw_result)
+        key = ("position", position) if result.get("index") is None else ("index", result["index"])
+        results_by_index.pop(key, None)
+        results_by_index[key] = result
+
+    return {**job_summary(job_hash), "results": list(results_by_index.values())}
+
+def job_summary(job_hash: Dict[str, str]) -> Dict[str, Any]:
+    total = int(job_hash.get("total", 0))
+    messages = int(job_hash.get("messages", total))
+    return {
+        "status": job_hash.get("status", "processing"),
+        "total": total,
+        "messages": messages,
+        "deduplicated": total - messages,
+        "completed": int(job_hash.get("completed", 0)),
+        "failed": int(job_hash.get("failed", 0)),
+        "skipped": int(job_hash.get("skipped", 0)),
+        "checkpoint": int(job_hash.get("checkpoint", -1)),
+        "stale": is_job_stale(job_hash),
+    }
+
+async def load_job_page(job_id: str, cursor: Optional[int], limit: int, failures_only: bool = False) -> Optional[Dict[str, Any]]:
+    """Counters plus, with a cursor, one page of results: O(limit), not O(job)"""
+    results_key = job_failures_key(job_id) if failures_only else job_results_key(job_id)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(job_key(job_id))
+        pipe.llen(results_key)
+        if cursor is not None:
+            pipe.lrange(results_key, cursor, cursor + limit - 1)
+        replies = await pipe.execute()
+    job_hash, results_count = replies[0], replies[1]
+    if not job_hash:
+        return None
+
+    page = job_summary(job_hash)
+    page["resultsCount"] = results_count
+    if cursor is not None:
+        # Entradas na ordem em que foram gravadas; após um retry_failed a
+        # entrada mais nova de um mesmo `index` substitui a anterior
+        page["results"] = [decode_job_value(r) for r in replies[2]]
+        page["cursor"] = cursor
+        page["nextCursor"] = cursor + len(replies[2])
+        page["hasMore"] = page["nextCursor"] < results_count
+    return page
+
+async def keep_job_alive(job_id: str) -> None:
+    """Touch `updated_at` while a chunk is in flight (cancel when it ends)"""
+    # Um lote pode levar minutos (ritmo reduzido pelo AIMD, esperas de retry)
+    # sem gravar progresso; sem este sinal o job pareceria parado e o /resume
+    # reenviaria contatos que ainda estão em andamento.
+    interval = max(Config.JOB_STALE_AFTER / 3, 1)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await redis_client.hset(job_key(job_id), "updated_at", datetime.utcnow().isoformat())
+        except Exception as e:
+            logging.error(f"Falha no heartbeat do job {job_id}: {e}")
+
+def is_job_stale(job_hash: Dict[str, str]) -> bool:
+    """A 'processing' job with no progress for JOB_STALE_AFTER seconds (its worker died)"""
+    if job_hash.get("status") != "processing" or not job_hash.get("updated_at"):
+        return False
+    updated_at = datetime.fromisoformat(job_hash["updated_at"])
+    return (datetime.utcnow() - updated_at).total_seconds() > Config.JOB_STALE_AFTER
+
+# --- Fila Durável de Envio (Redis Streams + Consumer Group) ---
+# No modo "queue" o endpoint não roda o job com `asyncio.create_task` (que
+# morria junto com o processo web): ele grava o job em lotes no stream
+# SEND_QUEUE_STREAM e os processos de `send_worker.py` consomem os lotes
+# via XREADGROUP. Cada lote só sai da fila com XACK depois de gravado; se o
+# worker cair, o lote fica pendente e outro worker o recupera com XAUTOCLAIM
+# após SEND_QUEUE_VISIBILITY_TIMEOUT segundos sem sinal de vida.
+#
+# --- LGPD (Minimização e Retenção de Dados) ---
+# Mensagem e credenciais ficam UMA vez por job em `job:{id}:payload`, com o
+# TTL do job, e são apagadas assim que o último lote é concluído.
+# -------------------------------------------------
+def job_payload_key(job_id: str) -> str:
+    return f"job:{job_id}:payload"
+
+def job_chunks_key(job_id: str) -> str:
+    return f"job:{job_id}:chunks_done"
+
+async def ensure_send_queue_group() -> None:
+    """Create the stream and its consumer group if they don't exist yet"""
+    try:
+        await redis_client.xgroup_create(Config.SEND_QUEUE_STREAM, Config.SEND_QUEUE_GROUP, id="0", mkstream=True)
+    except aioredis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def prepare_send_contacts(contacts: List[Dict]) -> str:
+    """Normalize every phone of the job once and number the contacts; returns the list fingerprint"""
+    phones = normalize_phones([c.get("cleanedPhone", c.get("phone", "")) for c in contacts])
+    digest = hashlib.sha256()
+    for index, (contact, phone) in enumerate(zip(contacts, phones)):
+        contact["to"] = phone["e164"][1:] # E.164 sem "+", ou "" se inválido
+        contact["index"] = index # Posição na lista do job (checkpoint / resume)
+        digest.update(f"{contact.get('id')}:{contact['to']}\n".encode())
+    return digest.hexdigest()
+
+async def enqueue_send_job(job_id: str, contacts: List[Dict], message: str, credentials: Dict, resume: bool = False,
+                           dedupe: bool = False, merge_names: bool = True, force_resend: bool = False) -> List[Dict]:
+    """Split the job into chunks on the send stream; returns the contacts queued (one per send)"""
+    total = len(contacts)
+    if not resume:
+        fingerprint = prepare_send_contacts(contacts)
+        if dedupe:
+            contacts = dedupe_send_contacts(contacts, merge_names)
+    chunk_size = Config.WHATSAPP_PROGRESS_CHUNK
+    chunks = [contacts[i:i + chunk_size] for i in range(0, len(contacts), chunk_size)]
+
+    await ensure_send_queue_group()
+    if resume:
+        # Numeração dos lotes continua de onde parou (os antigos já estão em chunks_done)
+        first_chunk = await redis_client.hincrby(job_key(job_id), "chunks", len(chunks)) - len(chunks)
+    else:
+        await init_job_state(job_id, total, fingerprint, messages=len(contacts))
+        first_chunk = 0
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(job_key(job_id), "mode", "queue")
+        if not resume:
+            pipe.hset(job_key(job_id), "chunks", len(chunks))
+        pipe.hset(job_payload_key(job_id), mapping={
+            "message": message,
+            "credentials": json_text(credentials),
+            "force_resend": int(force_resend),
+        })
+        pipe.expire(job_payload_key(job_id), Config.JOB_TTL)
+        for chunk_index, chunk in enumerate(chunks, start=first_chunk):
+            pipe.xadd(Config.SEND_QUEUE_STREAM, {
+                "job_id": job_id,
+                "chunk": chunk_index,
+                "contacts": encode_job_value(chunk),
+            })
+        await pipe.execute()
+    return contacts
+
+async def _keep_entry_visible(entry_id: str, consumer: str) -> None:
+    """Heartbeat of a chunk in flight; returns when another worker owns it"""
+    # XCLAIM do próprio lote zera o tempo ocioso, para que um lote longo
+    # (ritmo baixo) não seja "roubado" por outro worker no meio do envio. Se
+    # mesmo assim o lote já foi reassumido (pausa longa, rede), não o toma de
+    # volta: retorna, e quem chamou para de enviar.
+    interval = max(Config.SEND_QUEUE_VISIBILITY_TIMEOUT / 3, 1)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            pending = await redis_client.xpending_range(
+                Config.SEND_QUEUE_STREAM, Config.SEND_QUEUE_GROUP, min=entry_id, max=entry_id, count=1
+            )
+            if not pending or pending[0]["consumer"] != consumer:
+                return
+            await redis_client.xclaim(
+                Config.SEND_QUEUE_STREAM, Config.SEND_QUEUE_GROUP, consumer,
+                min_idle_time=0, message_ids=[entry_id], justid=True
+            )
+        except Exception as e:
+            # Falha transitória do Redis: tenta de novo no próximo intervalo
+            logging.error(f"Falha no heartbeat do lote {entry_id} ({consumer}): {e}")
+
+async def _ack_entry(entry_id: str) -> None:
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.xack(Config.SEND_QUEUE_STREAM, Config.SEND_QUEUE_GROUP, entry_id)
+        pipe.xdel(Config.SEND_QUEUE_STREAM, entry_id)
+        await pipe.execute()
+
+async def start_job_state(job_id: str, contacts: List[Dict], dedupe: bool = False, merge_names: bool = True) -> List[Dict]:
+    """Normalize the job's phones once and create its state in Redis; returns the contacts to send"""
+    # Telefones limpos uma única vez para o job inteiro
+    fingerprint = prepare_send_contacts(contacts)
+    send_contacts = dedupe_send_contacts(contacts, merge_names) if dedupe else contacts
     if redis_client:
         try:
-            redis_client.setex(f"job:{job_id}", 3600, json.dumps({
-                "status": "processing",
-                "total": len(contacts),
-                "completed": 0,
-                "failed": 0,
-                "results": []
-            }))
+            await init_job_state(job_id, len(contacts), fingerprint, messages=len(send_contacts))
         except Exception as e:
             # --- LGPD (Monitoramento / Resposta a Incidentes) ---
             logging.error(f"Falha ao escrever Job inicial no Redis (Job: {job_id}): {e}")
             # --------------------------------------------------
             # O job continuará, mas não será rastreável
             pass 
+    return send_contacts
+
+async def process_send_queue_entry(entry_id: str, fields: Dict[str, str], consumer: str, reclaimed: bool = False) -> None:
+    """Send one queued chunk, record it and acknowledge it"""
+    job_id = fields["job_id"]
+    chunk_index = int(fields["chunk"])
+
+    # Lote já gravado (o worker caiu entre a gravação e o XACK): só confirma
+    if await redis_client.sismember(job_chunks_key(job_id), chunk_index):
+        await _ack_entry(entry_id)
+        return
+
+    payload = await redis_client.hgetall(job_payload_key(job_id))
+    if not payload:
+        # Job expirado (JOB_TTL) ou já finalizado: descarta o lote
+        logging.warning(f"Lote {chunk_index} do job {job_id} descartado: payload não encontrado.")
+        await _ack_entry(entry_id)
+        return
+
+    contacts = decode_job_value(fields["contacts"])
+    if reclaimed:
+        pending = await redis_client.xpending_range(
+            Config.SEND_QUEUE_STREAM, Config.SEND_QUEUE_GROUP, min=entry_id, max=entry_id, count=1
+        )
+        deliveries = pending[0]["times_delivered"] if pending else 1
+        if deliveries > Config.SEND_QUEUE_MAX_DELIVERIES:
+            # Lote "venenoso" (derruba o worker toda vez): marca como falha e segue
+            logging.error(f"Lote {chunk_index} do job {job_id} desistido após {deliveries} entregas.")
+            now = datetime.utcnow().isoformat()
+            batch_results = expand_merged_results(contacts, [{
+                "contact_id": contact.get("id"),
+                "phone": contact.get("cleanedPhone"),
+                "success": False,
+                "error": "Lote abandonado após falhas repetidas do worker de envio.",
+                "timestamp": now
+            } for contact in contacts])
+            await _finish_queue_chunk(job_id, chunk_index, batch_results, entry_id)
+            return
+
+    heartbeat = asyncio.create_task(_keep_entry_visible(entry_id, consumer))
+    job_heartbeat = asyncio.create_task(keep_job_alive(job_id))
+    send = asyncio.create_task(send_whatsapp_batch_api(
+        contacts, payload["message"], json_loads(payload["credentials"]),
+        force_resend=payload.get("force_resend") == "1"
+    ))
+    try:
+        await asyncio.wait({send, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+        if not send.done():
+            # O heartbeat terminou: o lote agora é de outro worker, que o envia inteiro
+            logging.warning(f"Lote {chunk_index} do job {job_id} assumido por outro worker: envio interrompido ({consumer}).")
+            return
+        batch_results = send.result()
+    finally:
+        heartbeat.cancel()
+        job_heartbeat.cancel()
+        send.cancel()
+    await _finish_queue_chunk(job_id, chunk_index, batch_results, entry_id)
+
+async def _finish_queue_chunk(job_id: str, chunk_index: int, batch_results: List[Dict], entry_id: str) -> None:
+    counters = await record_job_progress(job_id, batch_results, chunk_index=chunk_index)
+    await _ack_entry(entry_id)
+    if counters is None:
+        # Outro worker gravou este lote primeiro: nada a contar nem a finalizar
+        return
+
+    if counters["completed"] + counters["failed"] >= counters["total"]:
+        # Último lote do job (em qualquer worker): finaliza e apaga as credenciais
+        await finish_job_state(job_id)
+        await redis_client.delete(job_payload_key(job_id))
+        # --- LGPD (Monitoramento) ---
+        logging.info(f"Job de Envio Concluído (fila): {job_id}. Sucesso: {counters['completed']}, Falhas: {counters['failed']}")
+        # ------------------------------
+
+async def run_send_queue_consumer(consumer: str, stop: asyncio.Event) -> None:
+    """Consume send chunks until `stop` is set (one chunk at a time)"""
+    await ensure_send_queue_group()
+    visibility_ms = int(Config.SEND_QUEUE_VISIBILITY_TIMEOUT * 1000)
+
+    while not stop.is_set():
+        try:
+            # 1. Lotes pendentes de workers mortos (sem heartbeat além do timeout)
+            _, claimed, *_ = await redis_client.xautoclaim(
+                Config.SEND_QUEUE_STREAM, Config.SEND_QUEUE_GROUP, consumer,
+                min_idle_time=visibility_ms, start_id="0-0", count=1
+            )
+            entries = [(entry_id, fields, True) for entry_id, fields in claimed if fields]
+
+            # 2. Lotes novos (bloqueia até SEND_QUEUE_BLOCK_MS esperando trabalho)
+            if not entries:
+                response = await redis_blocking_client.xreadgroup(
+                    Config.SEND_QUEUE_GROUP, consumer, {Config.SEND_QUEUE_STREAM: ">"},
+                    count=1, block=Config.SEND_QUEUE_BLOCK_MS
+                )
+                entries = [(entry_id, fields, False) for _, stream_entries in response for entry_id, fields in stream_entries]
+
+            for entry_id, fields, reclaimed in entries:
+                await process_send_queue_entry(entry_id, fields, consumer, reclaimed=reclaimed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # O lote continua pendente e volta via XAUTOCLAIM
+            logging.error(f"Erro no consumidor da fila de envio ({consumer}): {e}")
+            await asyncio.sleep(1)
+
+async def process_whatsapp_batch(job_id: str, contacts: List[Dict], message: str, credentials: Dict, prepared: bool = False,
+                                 force_resend: bool = False):
+    """Process WhatsApp messages in background
+
+    With `prepared`, the contacts are already normalized/numbered and the job
+    state exists (started by the endpoint, or pending contacts of a resume).
+    """
+    
+    # --- LGPD (Prevenção contra Perda / Resposta a Incidentes) ---
+    # O status do job é salvo no Redis (um banco de dados rápido).
+    # Se o servidor cair, o status do job (quantos faltam) pode ser
+    # recuperado se o Redis tiver persistência.
+    # Todas as chaves do job têm expiração (JOB_TTL) para que os dados
+    # não fiquem para sempre (Princípio da Retenção de Dados).
+    # -------------------------------------------------------------
+    if not prepared:
+        contacts = await start_job_state(job_id, contacts)
     
-    results = []
-    batch_size = 10
-    delay_ms = 1000  # 1 second between batches
+    completed = 0
+    failed = 0
+    # O ritmo é controlado pelo pacer do número; o lote só define a frequência
+    # de atualização do progresso no Redis.
+    batch_size = Config.WHATSAPP_PROGRESS_CHUNK
+    # Esqueleto do payload montado uma vez para o job inteiro
+    compiled = CompiledPayload(message, credentials)
     
     for i in range(0, len(contacts), batch_size):
         batch = contacts[i:i + batch_size]
-        batch_results = await send_whatsapp_batch_api(batch, message, credentials)
-        results.extend(batch_results)
+        heartbeat = asyncio.create_task(keep_job_alive(job_id)) if redis_client else None
+        try:
+            batch_results = await send_whatsapp_batch_api(batch, message, credentials, compiled, force_resend)
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+        batch_completed = sum(1 for r in batch_results if r.get("success"))
+        completed += batch_completed
+        failed += len(batch_results) - batch_completed
         
         # Update progress
         if redis_client:
             try:
-                completed = len([r for r in results if r.get("success")])
-                failed = len([r for r in results if not r.get("success")])
-                
-                redis_client.setex(f"job:{job_id}", 3600, json.dumps({
-                    "status": "processing",
-                    "total": len(contacts),
-                    "completed": completed,
-                    "failed": failed,
-                    "results": results # Armazena resultados parciais
-                }))
+                await record_job_progress(job_id, batch_results)
             except Exception as e:
                  logging.error(f"Falha ao atualizar Job no Redis (Job: {job_id}): {e}")
-        
-        # Wait before next batch
-        if i + batch_size < len(contacts):
-            await asyncio.sleep(delay_ms / 1000)
+    
+    # --- LGPD (Monitoramento) ---
+    logging.info(f"Job de Envio Concluído: {job_id}. Sucesso: {completed}, Falhas: {failed}")
+    # ------------------------------
     
     # Mark job as completed
     if redis_client:
         try:
-            completed = len([r for r in results if r.get("success")])
-            failed = len([r for r in results if not r.get("success")])
-            
-            # --- LGPD (Monitoramento) ---
-            logging.info(f"Job de Envio Concluído: {job_id}. Sucesso: {completed}, Falhas: {failed}")
-            # ------------------------------
-            
-            redis_client.setex(f"job:{job_id}", 3600, json.dumps({
-                "status": "completed",
-                "total": len(contacts),
-                "completed": completed,
-                "failed": failed,
-                "results": results
-            }))
+            await finish_job_state(job_id)
         except Exception as e:
              logging.error(f"Falha ao finalizar Job no Redis (Job: {job_id}): {e}")
 
 
-async def send_whatsapp_batch_api(contacts: List[Dict], message: str, credentials: Dict) -> List[Dict]:
-    """Send WhatsApp messages via Cloud API"""
+# --- Compilador de Payload por Job ---
+# O esqueleto da requisição à Graph API (texto vs template, idioma, URL e
+# headers) é montado e serializado UMA vez por job. Por contato só entram o
+# `to` e o nome, já escapados, entre segmentos de bytes prontos, e o corpo
+# vai como `content=` (sem o `json` da stdlib dentro do httpx).
+CONTROL_CHARS_TABLE = dict.fromkeys([*range(0x20), 0x7F])
+PAYLOAD_TO_SLOT = "\x00to\x00"
+PAYLOAD_NAME_SLOT = "\x00name\x00"
+
+def _json_fragment(text: str) -> bytes:
+    # Escape JSON é por caractere: o trecho pode ser concatenado dentro de uma string
+    return json_bytes(text)[1:-1]
+
+
+class CompiledPayload:
+    """Graph API request of one job, pre-serialized around the per-contact fields"""
+
+    def __init__(self, message: str, credentials: Dict):
+        self.url = f"{Config.GRAPH_API_BASE_URL}/{credentials['phoneNumberId']}/messages"
+        # --- LGPD (Criptografia e Comunicação Segura) ---
+        # O `access_token` vai no Header (padrão OAuth), montado uma vez por job.
+        # ------------------------------------------------
+        self.headers = {
+            "Authorization": f"Bearer {credentials['accessToken']}",
+            "Content-Type": "application/json"
+        }
+        template_name = credentials.get("templateName", "")
+        language_code = credentials.get("languageCode", "pt_BR")
+
+        # Se houver template name, envia como template. Senão, envia como mensagem de texto.
+        self.is_template = bool(template_name and template_name.strip() and template_name != 'hello_world')
+        if self.is_template:
+            skeleton = {
+                "messaging_product": "whatsapp",
+                "to": PAYLOAD_TO_SLOT,
+                "type": "template",
+                "template": {
+                    "name": template_name,
+                    "language": {"code": language_code},
+                    "components": [{
+                        "type": "body",
+                        "parameters": [{"type": "text", "text": PAYLOAD_NAME_SLOT}]
+                    }]
+                }
+            }
+        else:
+            # COMENTÁRIO DE SEGURANÇA (Anti-Hacking: Higienização de Saída)
+            # Caracteres de controle saem da mensagem uma vez (e de cada nome no render)
+            parts = [part.translate(CONTROL_CHARS_TABLE) for part in message.split("{name}")]
+            skeleton = {
+                "messaging_product": "whatsapp",
+                "to": PAYLOAD_TO_SLOT,
+                "type": "text",
+                "text": {"body": PAYLOAD_NAME_SLOT.join(parts)}
+            }
+
+        slots = {_json_fragment(PAYLOAD_TO_SLOT): "to", _json_fragment(PAYLOAD_NAME_SLOT): "name"}
+        pattern = b"(" + b"|".join(re.escape(slot) for slot in slots) + b")"
+        # Segmentos alternados: bytes fixos nas posições pares, campos do contato nas ímpares
+        self.segments = re.split(pattern, json_bytes(skeleton))
+        self.to_positions = [i for i in range(1, len(self.segments), 2) if slots[self.segments[i]] == "to"]
+        self.name_positions = [i for i in range(1, len(self.segments), 2) if slots[self.segments[i]] == "name"]
+
+    def render(self, phone: str, name: str) -> bytes:
+        """JSON body for one contact"""
+        if not self.is_template:
+            name = name.translate(CONTROL_CHARS_TABLE)
+        segments = list(self.segments)
+        phone_fragment = _json_fragment(phone)
+        name_fragment = _json_fragment(name)
+        for i in self.to_positions:
+            segments[i] = phone_fragment
+        for i in self.name_positions:
+            segments[i] = name_fragment
+        return b"".join(segments)
+
+
+# --- Novas Tentativas (erros transitórios da Graph API) ---
+# Antes, qualquer resposta diferente de 200 virava falha definitiva, e uma
+# rajada de 429 gerava centenas de "falhas" a reenviar à mão. Agora cada erro
+# é classificado: transitórios (429, 5xx, códigos de throttling/indisponível,
+# erros de rede) voltam a tentar com espera exponencial com jitter (respeitando
+# o Retry-After), fora do slot do pacer; os de throttling também reduzem o
+# ritmo do número (AIMD no SendPacer). Os demais (número inválido, template
+# reprovado, token expirado...) falham na hora, como antes.
+GRAPH_RETRYABLE_CODES = {
+    4,       # limite de chamadas do app
+    80007,   # limite de chamadas da conta WhatsApp Business
+    130429,  # limite de throughput da Cloud API
+    131056,  # limite de mensagens para o mesmo destinatário (par remetente/destinatário)
+    133004,  # servidor temporariamente indisponível
+}
+# Códigos que indicam ritmo alto demais para o NÚMERO (131056 é por destinatário)
+GRAPH_THROTTLE_CODES = {4, 80007, 130429}
+
+def graph_error_code(response: httpx.Response) -> Optional[int]:
+    """`error.code` of a Graph API error body, if any"""
+    try:
+        code = json_loads(response.content).get("error", {}).get("code")
+        return int(code) if code is not None else None
+    except Exception:
+        return None
+
+def classify_graph_error(status: int, code: Optional[int]) -> Tuple[bool, bool]:
+    """(retryable, throttled) for one Graph API error answer"""
+    throttled = status == 429 or code in GRAPH_THROTTLE_CODES
+    retryable = throttled or status >= 500 or code in GRAPH_RETRYABLE_CODES
+    return retryable, throttled
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(float(value), 0.0) if value else None
+    except ValueError:
+        return None  # formato de data HTTP: fica com o backoff
+
+def retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than Retry-After"""
+    ceiling = min(Config.WHATSAPP_RETRY_MAX_DELAY, Config.WHATSAPP_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    delay = random.uniform(0, ceiling)
+    return max(delay, retry_after) if retry_after is not None else delay
+
+
+async def send_whatsapp_batch_api(contacts: List[Dict], message: str, credentials: Dict,
+                                  compiled: Optional[CompiledPayload] = None, force_resend: bool = False) -> List[Dict]:
+    """Send WhatsApp messages via Cloud API (concurrently, paced per phoneNumberId)
+
+    Contacts this message already reached (send ledger) are skipped unless
+    `force_resend` is set.
+    """
     
-    results = []
+    client = get_http_client(GRAPH_POOL)
+    pacer = get_send_pacer(credentials["phoneNumberId"])
+    # Jobs inline compilam uma vez e reaproveitam entre os lotes
+    compiled = compiled or CompiledPayload(message, credentials)
+    campaign = send_ledger_campaign(message, credentials)
+    delivered = [False] * len(contacts) if force_resend else await check_send_ledger(campaign, contacts)
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        for contact in contacts:
-            try:
-                # Prepare phone number (remove leading '+')
-                phone = contact.get("cleanedPhone", contact.get("phone", "")).replace("+", "")
-                
-                # Validação extra de segurança
-                if not phone.isdigit() or len(phone) < 10:
-                    results.append({
-                        "contact_id": contact.get("id"),
-                        "phone": contact.get("cleanedPhone"),
-                        "success": False,
-                        "error": "Número de telefone inválido (não numérico ou curto demais) no lado do servidor.",
-                        "timestamp": datetime.utcnow().isoformat()
-                    })
-                    continue
-
-                # Determine API endpoint
-                phone_number_id = credentials["phoneNumberId"]
-                access_token = credentials["accessToken"]
-                template_name = credentials.get("templateName", "")
-                language_code = credentials.get("languageCode", "pt_BR")
-                
-                # Substitui placeholders na mensagem de texto
-                personalized_message = message.replace("{name}", contact.get("name", ""))
-                
-                # COMENTÁRIO DE SEGURANÇA (Anti-Hacking: Higienização de Saída)
-                # Embora o Facebook deva lidar com isso, higienizamos a mensagem
-                # para remover caracteres de controle que poderiam bugar o JSON.
-                personalized_message = re.sub(r'[\x00-\x1F\x7F]', '', personalized_message)
+    # `gather` preserva a ordem: sent[i] corresponde ao i-ésimo contato não entregue
+    sent = iter(await asyncio.gather(*(
+        send_whatsapp_message(client, pacer, contact, compiled)
+        for contact, done in zip(contacts, delivered) if not done
+    )))
+    results = [skipped_send_result(contact) if done else next(sent) for contact, done in zip(contacts, delivered)]
+    await record_send_ledger(campaign, [
+        contact for contact, result in zip(contacts, results)
+        if result.get("success") and not result.get("skipped") and contact.get("to")
+    ])
+
+    send_throughput.add(len(results) - sum(delivered))
+    # Um resultado por contato (inclusive os agrupados no mesmo envio)
+    expanded = expand_merged_results(contacts, results)
+    # Contado por contato, como os contadores do job: um envio agrupado conta para cada contato
+    skipped = sum(1 for r in expanded if r.get("skipped"))
+    succeeded = sum(1 for r in expanded if r.get("success")) - skipped
+    WHATSAPP_MESSAGES.inc(succeeded, result="success")
+    WHATSAPP_MESSAGES.inc(len(expanded) - skipped - succeeded, result="failure")
+    WHATSAPP_MESSAGES.inc(skipped, result="skipped")
+    return expanded
+
+
+async def send_whatsapp_message(client: httpx.AsyncClient, pacer: SendPacer, contact: Dict, compiled: CompiledPayload) -> Dict:
+    """Send one WhatsApp message, waiting for a slot of the number's pacer
+
+    Transient errors are retried up to WHATSAPP_RETRY_MAX_ATTEMPTS times;
+    failed results carry `retryable` and `attempts`. Network errors after the
+    request left are not retried and are flagged `deliveryUnknown`.
+    """
+    try:
+        # Número já normalizado pelo job (`to`); chamadas avulsas normalizam aqui
+        phone = contact.get("to")
+        if phone is None:
+            phone = normalize_phone(contact.get("cleanedPhone", contact.get("phone", "")))["e164"][1:]
+        
+        # Validação extra de segurança
+        if not phone:
+            return {
+                "contact_id": contact.get("id"),
+                "phone": contact.get("cleanedPhone"),
+                "success": False,
+                "error": "Número de telefone inválido (não normalizável para E.164) no lado do servidor.",
+                "timestamp": datetime.utcnow().isoformat()
+            }
 
-                
-                # Se houver template name, tenta enviar como template. Senão, envia como mensagem de texto.
-                if template_name and template_name.strip() and template_name != 'hello_world':
-                    # Tenta enviar como Template message
-                    payload = {
-                        "messaging_product": "whatsapp",
-                        "to": phone,
-                        "type": "template",
-                        "template": {
-                            "name": template_name,
-                            "language": {
-                                "code": language_code
-                            },
-                            "components": [
-                                {
-                                    "type": "body",
-                                    "parameters": [
-                                        {"type": "text", "text": contact.get("name", "")}
-                                    ]
-                                }
-                            ]
-                        }
-                    }
-                else:
-                    # Custom text message (padrão)
-                    payload = {
-                        "messaging_product": "whatsapp",
-                        "to": phone,
-                        "type": "text",
-                        "text": {
-                            "body": personalized_message
-                        }
-                    }
-                
+        body = compiled.render(phone, str(contact.get("name") or ""))
+        
+        for attempt in range(1, max(Config.WHATSAPP_RETRY_MAX_ATTEMPTS, 1) + 1):
+            retry_after = None
+            delivery_unknown = False
+            try:
                 # --- LGPD (Criptografia e Comunicação Segura) ---
                 # A chamada é feita para `https://graph.facebook.com`, garantindo SSL/TLS.
-                # O `access_token` vai no Header (padrão OAuth).
                 # ------------------------------------------------
-                response = await client.post(
-                    f"https://graph.facebook.com/v18.0/{phone_number_id}/messages",
-                    headers={
-                        "Authorization": f"Bearer {access_token}",
-                        "Content-Type": "application/json"
-                    },
-                    json=payload
-                )
-                
+                async with pacer.slot():
+                    with track_upstream("graph", "send_message") as call:
+                        response = await client.post(compiled.url, headers=compiled.headers, content=body)
+                        call["status"] = response.status_code
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # A requisição nem saiu (conexão recusada / sem conexão livre): reenviar não duplica
+                error, retryable, throttled, reason = str(e) or type(e).__name__, True, False, type(e).__name__
+            except httpx.TransportError as e:
+                # Timeout de leitura / conexão interrompida depois do envio: a Meta pode ter
+                # entregue. Não reenvia (mensagem em dobro); o resultado fica marcado como incerto
+                error, retryable, throttled, reason = str(e) or type(e).__name__, False, False, type(e).__name__
+                delivery_unknown = True
+            else:
                 if response.status_code == 200:
-                    result_data = response.json()
-                    results.append({
+                    pacer.record_success()
+                    result_data = json_loads(response.content)
+                    result = {
                         "contact_id": contact.get("id"),
                         "phone": contact.get("cleanedPhone"),
                         "success": True,
                         "messageId": result_data.get("messages", [{}])[0].get("id"),
                         "timestamp": datetime.utcnow().isoformat()
-                    })
-                else:
-                    results.append({
-                        "contact_id": contact.get("id"),
-                        "phone": contact.get("cleanedPhone"),
-                        "success": False,
-                        "error": response.text,
-                        "timestamp": datetime.utcnow().isoformat()
-                    })
-                
-            except Exception as e:
-                results.append({
-                    "contact_id": contact.get("id"),
-                    "phone": contact.get("cleanedPhone"),
-                    "success": False,
-                    "error": str(e),
-                    "timestamp": datetime.utcnow().isoformat()
-                })
-    
-    return results
+                    }
+                    if attempt > 1:
+                        result["attempts"] = attempt
+                    return result
+                code = graph_error_code(response)
+                retryable, throttled = classify_graph_error(response.status_code, code)
+                error, reason = response.text, str(code or response.status_code)
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+            if throttled:
+                pacer.record_throttle()
+            # Retry-After além do teto: desiste agora (o lote não fica parado esperando)
+            if not retryable or attempt >= Config.WHATSAPP_RETRY_MAX_ATTEMPTS or (retry_after or 0) > Config.WHATSAPP_RETRY_MAX_DELAY:
+                break
+            WHATSAPP_RETRIES.inc(reason=reason)
+            # Espera fora do slot: os outros contatos seguem no ritmo (já reduzido)
+            await asyncio.sleep(retry_delay(attempt, retry_after))
+
+        result = {
+            "contact_id": contact.get("id"),
+            "phone": contact.get("cleanedPhone"),
+            "success": False,
+            "error": error,
+            "retryable": retryable, # True: esgotou as tentativas (o /resume com retry_failed reenvia)
+            "attempts": attempt,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        if delivery_unknown:
+            result["deliveryUnknown"] = True # Só o /resume com retry_unknown reenvia
+        return result
+        
+    except Exception as e:
+        return {
+            "contact_id": contact.get("id"),
+            "phone": contact.get("cleanedPhone"),
+            "success": False,
+            "error": str(e),
+            "timestamp": datetime.utcnow().isoformat()
+        }
 
 # Job status endpoint
+JOB_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_.-]+$")
+
 @app.get("/api/job-status/{job_id}")
-async def get_job_status(job_id: str):
-    """Get status of a WhatsApp sending job"""
+async def get_job_status(
+    job_id: str,
+    summary: bool = False,
+    cursor: Optional[int] = None,
+    since: Optional[int] = None,
+    limit: int = 500,
+    failures_only: bool = False,
+):
+    """Get status of a WhatsApp sending job
+
+    No options: counters + every result (legacy). `summary`: counters only.
+    `cursor`/`since`: one page of results from that position (`nextCursor`
+    feeds the next call). `failures_only`: page over the failures only.
+    """
     
     if not redis_client:
         # Se o Redis não estiver configurado, um trabalho de background deve ser tratado de forma diferente
@@ -891,27 +3274,260 @@ async def get_job_status(job_id: str):
         # COMENTÁRIO DE SEGURANÇA (Anti-Hacking: Validação de Entrada)
         # Higieniza o job_id para prevenir ataques (ex: Redis injection)
         # Embora o risco seja baixo, é boa prática.
-        if not re.match(r"^[a-zA-Z0-9_.-]+$", job_id):
+        if not JOB_ID_PATTERN.match(job_id):
              logging.warning(f"Tentativa de acesso a job com ID malicioso: {job_id}")
              raise HTTPException(status_code=400, detail="Job ID inválido")
 
-        job_data = redis_client.get(f"job:{job_id}")
+        if cursor is not None and since is not None:
+            raise HTTPException(status_code=400, detail="Use `cursor` ou `since`, não os dois")
+        cursor = since if since is not None else cursor
+        if (cursor is not None and cursor < 0) or not 1 <= limit <= 5000:
+            raise HTTPException(status_code=400, detail="Paginação inválida (cursor >= 0, limit entre 1 e 5000)")
+
+        if summary:
+            job_state = await load_job_page(job_id, None, limit, failures_only)
+        elif cursor is not None or failures_only:
+            job_state = await load_job_page(job_id, cursor or 0, limit, failures_only)
+        else:
+            job_state = await load_job_state(job_id)
         
-        if not job_data:
+        if not job_state:
             raise HTTPException(status_code=404, detail="Trabalho (Job) não encontrado")
         
-        return json.loads(job_data)
+        # Já são tipos JSON: a resposta direta pula o jsonable_encoder (caro com milhares de resultados)
+        return DefaultJSONResponse(job_state)
         
+    except HTTPException:
+        raise
     except Exception as e:
         # --- LGPD (Monitoramento) ---
         logging.error(f"Falha ao recuperar status do job {job_id}: {e}")
         # ------------------------------
         raise HTTPException(status_code=500, detail="Falha ao recuperar o status do trabalho")
 
+# --- Progresso do Job por Push (SSE) ---
+# O front fazia polling de /api/job-status a cada 3s, relendo e reenviando
+# todos os resultados a cada vez. Aqui cada lote gravado vira um evento
+# (delta de contadores + resultados novos) no stream `job:{id}:events`, e
+# /api/job-events entrega esses eventos assim que acontecem.
+#
+# Um único XREAD bloqueante por job e por processo (JobEventHub) alimenta
+# todas as conexões que acompanham aquele job: o tráfego no Redis não cresce
+# com o número de abas abertas.
+def _stream_id(entry_id: str) -> Tuple[int, int]:
+    milliseconds, sequence = entry_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+class JobEventHub:
+    """Fan-out of one job's event stream to every SSE watcher in this process"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.subscribers: set = set()
+        self.last_id = "0-0"
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        # Começa do último evento já existente: o que veio antes cada
+        # conexão lê sozinha (XRANGE), o que vier depois chega pela fila
+        latest = await redis_client.xrevrange(job_events_key(self.job_id), count=1)
+        self.last_id = latest[0][0] if latest else "0-0"
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        key = job_events_key(self.job_id)
+        try:
+            while True:
+                if not self.subscribers:
+                    # Sem `await` entre a checagem e a remoção: ninguém entra num hub morto
+                    job_event_hubs.pop(self.job_id, None)
+                    return
+                response = await redis_blocking_client.xread({key: self.last_id}, count=100, block=Config.JOB_EVENTS_BLOCK_MS)
+                for _, entries in response:
+                    for entry_id, fields in entries:
+                        self.last_id = entry_id
+                        for queue in self.subscribers:
+                            queue.put_nowait((entry_id, fields))
+        except Exception as e:
+            job_event_hubs.pop(self.job_id, None)
+            logging.error(f"Falha ao ler eventos do job {self.job_id} no Redis: {e}")
+            for queue in self.subscribers:
+                queue.put_nowait(None) # Encerra as conexões (o front volta ao polling)
+
+
+job_event_hubs: Dict[str, JobEventHub] = {}
+
+async def subscribe_job_events(job_id: str, queue: asyncio.Queue) -> JobEventHub:
+    hub = job_event_hubs.get(job_id)
+    if hub is None:
+        hub = JobEventHub(job_id)
+        job_event_hubs[job_id] = hub
+        hub.subscribers.add(queue)
+        await hub.start()
+    else:
+        hub.subscribers.add(queue)
+    return hub
+
+
+async def stream_job_events(job_id: str, job_hash: Dict[str, str], last_event_id: Optional[str]):
+    """Replay the job's events after `last_event_id`, then push new ones until `done`"""
+    queue: asyncio.Queue = asyncio.Queue()
+    hub = await subscribe_job_events(job_id, queue)
+    cursor = _stream_id(last_event_id) if last_event_id else (0, 0)
+    try:
+        # 1. O que já aconteceu (conexão nova: desde o início; reconexão: desde Last-Event-ID)
+        backlog = await redis_client.xrange(job_events_key(job_id), min=last_event_id or "-", max="+")
+        if not backlog and not last_event_id and job_hash.get("status") != "processing":
+            # Job anterior aos eventos (ou eventos expirados): só o resultado final
+            yield sse_event("done", {
+                "status": job_hash.get("status"),
+                "completed": int(job_hash.get("completed", 0)),
+                "failed": int(job_hash.get("failed", 0)),
+            })
+            return
+
+        pending = list(backlog)
+        while True:
+            for position, (entry_id, fields) in enumerate(pending):
+                if _stream_id(entry_id) <= cursor:
+                    continue # Já entregue (backlog e fila se sobrepõem)
+                cursor = _stream_id(entry_id)
+                if fields["event"] == "done" and position < len(pending) - 1:
+                    # `done` de uma execução anterior: o job foi retomado (/resume) depois dele
+                    continue
+                yield sse_event(fields["event"], fields["data"], event_id=entry_id)
+                if fields["event"] == "done":
+                    return
+
+            # 2. Eventos novos, com keep-alive para proxies não fecharem a conexão ociosa
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=Config.JOB_EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                pending = []
+                continue
+            if item is None:
+                yield sse_event("error", {"error": "Acompanhamento em tempo real interrompido. Use /api/job-status."})
+                return
+            pending = [item]
+    finally:
+        hub.subscribers.discard(queue)
+
+
+@app.get("/api/job-events/{job_id}")
+async def get_job_events(job_id: str, client_request: Request):
+    """Server-Sent Events with the job's counter deltas and new results"""
+    if not redis_client or not redis_blocking_client:
+        raise HTTPException(status_code=503, detail="Rastreamento de trabalho (Job tracking) não disponível sem Redis configurado.")
+    if not JOB_ID_PATTERN.match(job_id):
+        raise HTTPException(status_code=400, detail="Job ID inválido")
+
+    last_event_id = client_request.headers.get("last-event-id")
+    if last_event_id and not re.match(r"^\d+-\d+$", last_event_id):
+        raise HTTPException(status_code=400, detail="Last-Event-ID inválido")
+
+    try:
+        job_hash = await redis_client.hgetall(job_key(job_id))
+    except Exception as e:
+        logging.error(f"Falha ao recuperar status do job {job_id}: {e}")
+        raise HTTPException(status_code=500, detail="Falha ao recuperar o status do trabalho")
+    if not job_hash:
+        raise HTTPException(status_code=404, detail="Trabalho (Job) não encontrado")
+
+    return sse_response(stream_job_events(job_id, job_hash, last_event_id))
+
+@app.post("/api/job/{job_id}/resume")
+async def resume_job(job_id: str, request: JobResumeRequest, client_request: Request):
+    """Continue a stopped job from its checkpoint (optionally retrying failures)"""
+    client_ip = client_request.client.host
+
+    if not await check_rate_limit(client_ip, route="send"):
+        raise HTTPException(status_code=429, detail="Limite de taxa excedido. Tente novamente mais tarde.")
+    if not redis_client:
+        raise HTTPException(status_code=503, detail="Retomada de trabalho não disponível sem Redis configurado.")
+    if not JOB_ID_PATTERN.match(job_id):
+        raise HTTPException(status_code=400, detail="Job ID inválido")
+
+    # Trava curta: dois /resume simultâneos enviariam os pendentes em dobro
+    lock_key = f"job:{job_id}:resume_lock"
+    if not await redis_client.set(lock_key, client_ip, nx=True, ex=30):
+        raise HTTPException(status_code=409, detail="Este trabalho já está sendo retomado.")
+    try:
+        job_hash = await redis_client.hgetall(job_key(job_id))
+        if not job_hash:
+            raise HTTPException(status_code=404, detail="Trabalho (Job) não encontrado ou expirado")
+        if job_hash.get("status") == "processing" and not is_job_stale(job_hash):
+            raise HTTPException(status_code=409, detail="O trabalho ainda está em andamento.")
+
+        contacts = request.contacts
+        if len(contacts) != int(job_hash.get("total", 0)) or prepare_send_contacts(contacts) != job_hash.get("fingerprint"):
+            raise HTTPException(status_code=409, detail="A lista de contatos não é a mesma do envio original.")
+
+        # Só o que falta: índices sem resultado (+ os que falharam, se pedido)
+        outcomes = await redis_client.hgetall(job_outcomes_key(job_id))
+        retry_outcomes = {"0"} if request.retry_failed else set()
+        if request.retry_unknown:
+            retry_outcomes.add("2")
+        retry_indexes = [int(i) for i, ok in outcomes.items() if ok in retry_outcomes]
+        pending = [c for c in contacts if str(c["index"]) not in outcomes]
+        pending.extend(contacts[i] for i in retry_indexes)
+        pending.sort(key=lambda c: c["index"])
+
+        if not pending:
+            return {"jobId": job_id, "status": job_hash.get("status"), "resumedContacts": 0}
+
+        if retry_indexes:
+            # A lista de falhas só recebe RPUSH: sem isto, ?failures_only continuaria
+            # listando (e contando) contatos entregues na nova tentativa
+            retried = set(retry_indexes)
+            raw_failures = await redis_client.lrange(job_failures_key(job_id), 0, -1)
+            kept_failures = [raw for raw in raw_failures if decode_job_value(raw).get("index") not in retried]
+
+        async with redis_client.pipeline(transaction=True) as pipe:
+            if retry_indexes:
+                # As falhas voltam a ser "pendentes": o novo resultado substitui o antigo
+                pipe.hincrby(job_key(job_id), "failed", -len(retry_indexes))
+                pipe.hdel(job_outcomes_key(job_id), *retry_indexes)
+                pipe.delete(job_failures_key(job_id))
+                if kept_failures:
+                    pipe.rpush(job_failures_key(job_id), *kept_failures)
+                    pipe.expire(job_failures_key(job_id), Config.JOB_TTL)
+            # Marca a retomada depois do `done` anterior (o SSE ignora um `done` seguido de outros eventos)
+            add_job_event(pipe, job_id, "progress", {"completed": 0, "failed": -len(retry_indexes), "results": [], "resumed": len(pending)})
+            pipe.hset(job_key(job_id), mapping={"status": "processing", "updated_at": datetime.utcnow().isoformat()})
+            pipe.hincrby(job_key(job_id), "resumes", 1)
+            await pipe.execute()
+
+        credentials = request.credentials.dict()
+        send_contacts = dedupe_send_contacts(pending, request.merge_names) if request.dedupe else pending
+        if job_hash.get("mode") == "queue" or Config.SEND_EXECUTION_MODE == "queue":
+            await enqueue_send_job(job_id, send_contacts, request.message, credentials, resume=True, force_resend=request.force_resend)
+        else:
+            asyncio.create_task(process_whatsapp_batch(
+                job_id, send_contacts, request.message, credentials, prepared=True, force_resend=request.force_resend
+            ))
+    finally:
+        await redis_client.delete(lock_key)
+
+    # --- LGPD (Monitoramento) ---
+    logging.info(f"Job de Envio Retomado (IP: {client_ip}): {job_id} com {len(pending)} contatos pendentes.")
+    # ------------------------------
+
+    send_rate = get_send_pacer(request.credentials.phoneNumberId).bucket.rate / send_rate_share
+    return {
+        "jobId": job_id,
+        "status": "processing",
+        "resumedContacts": len(pending),
+        "messages": len(send_contacts),
+        "retriedFailures": len(retry_indexes),
+        "estimatedTime": len(send_contacts) / send_rate if send_rate > 0 else 0
+    }
+
 # Error handlers
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    return DefaultJSONResponse(
         status_code=exc.status_code,
         content={"error": exc.detail, "status_code": exc.status_code}
     )
@@ -921,7 +3537,7 @@ async def general_exception_handler(request: Request, exc: Exception):
     # --- LGPD (Monitoramento / Resposta a Incidentes) ---
     logging.critical(f"Erro 500 Inesperado: {exc} na Rota: {request.url}")
     # --------------------------------------------------
-    return JSONResponse(
+    return DefaultJSONResponse(
         status_code=500,
         content={"error": "Internal server error", "detail": str(exc)}
     )
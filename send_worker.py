@@ -0,0 +1,109 @@
+"""
+WhatsApp Bulk Contact Manager - Send Queue Workers
+Consumes the send chunks queued by /api/send-whatsapp-batch when
+SEND_EXECUTION_MODE=queue. Runs separately from the API process and can be
+started on as many hosts as needed (all of them share one consumer group).
+
+Usage: python send_worker.py [--workers N] [--metrics-port PORT]
+
+SEND_WORKER_TOTAL must be the number of worker processes across ALL hosts:
+the per-number send rate is split evenly between them.
+
+With a metrics port, worker i serves its own Prometheus metrics on PORT + i
+(any path), since each process keeps separate counters.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+import proxy_server
+from proxy_server import Config
+
+
+async def serve_metrics(port: int) -> asyncio.AbstractServer:
+    """Minimal HTTP endpoint returning this process's metrics"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+            authorization = ""
+            for line in head.split("\r\n")[1:]:
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "authorization":
+                    authorization = value.strip()
+            if Config.METRICS_TOKEN and authorization != f"Bearer {Config.METRICS_TOKEN}":
+                status, body = "401 Unauthorized", b"Token de metricas invalido\n"
+            else:
+                await proxy_server.refresh_metrics()
+                status, body = "200 OK", proxy_server.render_metrics().encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host="0.0.0.0", port=port)
+
+
+async def worker_main(consumer: str, metrics_port: int = 0) -> None:
+    """Run one consumer until SIGTERM/SIGINT, sharing the HTTP pools of this process"""
+    if not proxy_server.redis_client:
+        raise SystemExit("send_worker: RATE_LIMIT_REDIS_URL precisa apontar para um Redis.")
+
+    # Cada processo envia só a sua fração do ritmo do número
+    proxy_server.send_rate_share = 1.0 / max(Config.SEND_WORKER_TOTAL, 1)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # Termina o lote atual e sai; o que não foi confirmado volta para a fila
+        loop.add_signal_handler(sig, stop.set)
+
+    proxy_server.open_http_clients()
+    metrics_server = await serve_metrics(metrics_port) if metrics_port else None
+    logging.info(f"Worker de envio {consumer} iniciado (grupo {Config.SEND_QUEUE_GROUP}).")
+    try:
+        # Retorna no máximo SEND_QUEUE_BLOCK_MS depois do sinal (ou ao fim do lote atual)
+        await proxy_server.run_send_queue_consumer(consumer, stop)
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        await proxy_server.close_http_clients()
+        for client in (proxy_server.redis_client, proxy_server.redis_blocking_client):
+            if client:
+                await client.aclose()
+        logging.info(f"Worker de envio {consumer} encerrado.")
+
+
+def run_process(index: int, metrics_port: int = 0) -> None:
+    consumer = f"{socket.gethostname()}-{os.getpid()}-{index}"
+    asyncio.run(worker_main(consumer, metrics_port + index if metrics_port else 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consome a fila de envio do WhatsApp (Redis Streams).")
+    parser.add_argument("--workers", type=int, default=Config.SEND_WORKER_COUNT, help="processos neste host")
+    parser.add_argument("--metrics-port", type=int, default=Config.SEND_WORKER_METRICS_PORT,
+                        help="porta das métricas do primeiro processo (0 = desativado)")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        run_process(0, args.metrics_port)
+    else:
+        processes = [multiprocessing.Process(target=run_process, args=(i, args.metrics_port)) for i in range(args.workers)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
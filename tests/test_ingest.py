@@ -0,0 +1,27 @@
+from fastapi.testclient import TestClient
+
+import proxy_server
+
+SHEET = (
+    "Aluno;Responsável;Turma;Telefone\n"
+    "Ana Souza;Maria Souza;3A;(11) 3456-7890\n"
+    "Pedro Lima;João Lima;3B;(11) 8765-4321\n"
+    "Bia Rocha;Carla Rocha;3A;(11) 98765-4322\n"
+)
+
+
+def test_ingest_keeps_landlines_and_adds_the_ninth_digit_to_old_mobiles():
+    # Diferente do NumberCleaner do main.js (sempre +55 DDD 9...), o servidor
+    # não transforma um fixo de 8 dígitos em celular
+    rows = [line.split(";") for line in SHEET.splitlines()[1:]]
+    positions = {"aluno": 0, "responsavel": 1, "turma": 2, "telefone": 3}
+    contacts = proxy_server.build_ingest_contacts(rows, positions, first_id=1)
+
+    assert [c["telefone"] for c in contacts] == ["+551134567890", "+5511987654321", "+5511987654322"]
+    assert all(c["status"] == "valid" for c in contacts)
+
+    with TestClient(proxy_server.app) as client:
+        response = client.post("/api/ingest", files={"file": ("lista.csv", SHEET.encode(), "text/csv")})
+    assert response.status_code == 200
+    assert (response.json()["validContacts"], response.json()["invalidContacts"]) == (3, 0)
+    assert response.json()["columns"]["telefone"] == "Telefone"
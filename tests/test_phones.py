@@ -0,0 +1,14 @@
+from fastapi.testclient import TestClient
+
+import proxy_server
+
+
+def test_normalize_endpoint_accepts_excel_float():
+    with TestClient(proxy_server.app) as client:
+        response = client.post("/api/phones/normalize", json={"phones": [5511987654321.0, 5511987654321, "(11) 98765-4321"]})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [r["e164"] for r in body["results"]] == ["+5511987654321"] * 3
+    assert body["valid"] == 3
+    assert proxy_server.normalize_phones([5511987654321.0]) == body["results"][:1]
@@ -0,0 +1,41 @@
+import asyncio
+
+import httpx
+from fastapi.testclient import TestClient
+
+import proxy_server
+
+CREDENTIALS = {"phoneNumberId": "123456", "accessToken": "t" * 12}
+CONTACTS = [
+    {"id": 1, "name": "Ana", "cleanedPhone": "+5511987654321"},
+    {"id": 2, "name": "Pedro", "cleanedPhone": "(11) 98765-4321"},
+]
+
+
+def send(payload):
+    bodies = []
+
+    def graph(request):
+        bodies.append(proxy_server.json_loads(request.content)["text"]["body"])
+        return httpx.Response(200, json={"messages": [{"id": f"wamid.{len(bodies)}"}]})
+
+    with TestClient(proxy_server.app) as client:
+        proxy_server.http_clients[proxy_server.GRAPH_POOL] = httpx.AsyncClient(transport=httpx.MockTransport(graph))
+        response = client.post("/api/send-whatsapp-batch", json={
+            "contacts": CONTACTS, "message": "Olá {name}", "credentials": CREDENTIALS, **payload
+        })
+        client.portal.call(asyncio.sleep, 0.2)
+    assert response.status_code == 200
+    return response.json(), sorted(bodies)
+
+
+def test_duplicate_numbers_are_sent_separately_by_default():
+    job, bodies = send({})
+    assert (job["messages"], job["deduplicated"]) == (2, 0)
+    assert bodies == ["Olá Ana", "Olá Pedro"]
+
+
+def test_dedupe_merges_contacts_with_the_same_number():
+    job, bodies = send({"dedupe": True})
+    assert (job["messages"], job["deduplicated"]) == (1, 1)
+    assert bodies == ["Olá Ana e Pedro"]